@@ -0,0 +1,125 @@
+import atexit
+import os
+import time
+
+import metrics
+from cache_utils import read_json_file, write_json_atomic
+
+# Catalogue of the files in every asset folder, kept in memory and persisted to the cache folder.
+# A folder is only re-listed when its own mtime changes (files added, removed or renamed),
+# so repeated queries cost one os.stat per folder instead of one glob per extension.
+ASSET_INDEX_VERSION = 1
+ASSET_INDEX_FILENAME = "asset_index.json"
+
+# Directory mtimes on some (network) filesystems have coarse granularity. A listing taken less than
+# this many seconds after the folder's mtime is not trusted, since a later change could keep the same mtime.
+MTIME_SETTLE_SECONDS = 2.0
+
+_index_file = None  # Path of the on-disk index, None keeps the catalogue in memory only
+_folders = {}       # abs folder path -> {'mtime_ns': int, 'scanned_at_ns': int, 'files': [names]}
+_dirty = False
+_atexit_registered = False
+
+
+def configure(index_file):
+    """
+    Points the asset index at an on-disk catalogue file and loads it.
+    Passing None keeps the catalogue in memory for the lifetime of the process only.
+    """
+    global _index_file, _dirty, _atexit_registered
+    if index_file and _index_file and os.path.abspath(index_file) == _index_file:
+        return  # Already configured, keep the warm in-memory catalogue
+    if _index_file and _dirty:
+        save()
+    _index_file = os.path.abspath(index_file) if index_file else None
+    _folders.clear()
+    _dirty = False
+    if _index_file:
+        data = read_json_file(_index_file, default={})
+        if data.get("version") == ASSET_INDEX_VERSION:
+            _folders.update(data.get("folders", {}))
+        if not _atexit_registered:
+            atexit.register(save)
+            _atexit_registered = True
+
+
+def index_file_for_config(config):
+    """Returns the asset index path for a loaded project config, or None if caching is disabled."""
+    cache_folder = config.get("cache_folder")
+    if not cache_folder:
+        return None
+    return os.path.join(cache_folder, ASSET_INDEX_FILENAME)
+
+
+def save():
+    """Writes folders re-listed by this process to the on-disk catalogue, merging with other writers."""
+    global _dirty
+    if not _index_file or not _dirty:
+        return
+    data = read_json_file(_index_file, default={})
+    merged = data.get("folders", {}) if data.get("version") == ASSET_INDEX_VERSION else {}
+    for folder, record in _folders.items():
+        if folder not in merged or merged[folder].get('scanned_at_ns', 0) < record['scanned_at_ns']:
+            merged[folder] = record
+    if write_json_atomic(_index_file, {"version": ASSET_INDEX_VERSION, "folders": merged}):
+        _dirty = False
+
+
+def _list_folder(abs_folder):
+    """Returns the (sorted) names of regular, non-hidden files in abs_folder, re-listing only if it changed."""
+    global _dirty
+    try:
+        mtime_ns = os.stat(abs_folder).st_mtime_ns
+    except OSError:
+        return []
+
+    record = _folders.get(abs_folder)
+    if record and record['mtime_ns'] == mtime_ns and \
+            record['scanned_at_ns'] - mtime_ns > MTIME_SETTLE_SECONDS * 1e9:
+        return record['files']
+
+    try:
+        with metrics.stage("scan"), os.scandir(abs_folder) as it:
+            names = sorted(entry.name for entry in it
+                           if not entry.name.startswith('.') and entry.is_file())
+    except OSError:
+        return []
+    _folders[abs_folder] = {'mtime_ns': mtime_ns, 'scanned_at_ns': time.time_ns(), 'files': names}
+    _dirty = True
+    return names
+
+
+def list_files(folder_path, extensions):
+    """
+    Returns the files in folder_path matching any of the given extensions, grouped by extension
+    in the order given (like one glob.glob(f"*{ext}") per extension, but sorted by name).
+    Paths are joined onto folder_path as passed in. Returns an empty list if the folder is missing.
+    """
+    if not folder_path or not os.path.isdir(folder_path):
+        return []
+    names = _list_folder(os.path.abspath(folder_path))
+    found_files = []
+    for ext in extensions:
+        found_files.extend(os.path.join(folder_path, name) for name in names if name.endswith(ext))
+    return found_files
+
+
+def asset_folders_for_config(config):
+    """Returns every asset folder a project config selects media from."""
+    folders = []
+    for key in ("voiceover_folder", "intro_folder", "outro_folder", "bgm_folder"):
+        if config.get(key):
+            folders.append(config[key])
+    for key in ("main_clips_videos_folders", "main_clips_images_folder"):
+        value = config.get(key) or []
+        folders.extend(value if isinstance(value, list) else [value])
+    return folders
+
+
+def build_index(config):
+    """Catalogues (or refreshes) every asset folder of a project up front. Returns the number of files indexed."""
+    total = 0
+    for folder in asset_folders_for_config(config):
+        if os.path.isdir(folder):
+            total += len(_list_folder(os.path.abspath(folder)))
+    return total
@@ -1,7 +1,10 @@
+import hashlib
 import os
 import random
-import glob
 import json # For the main block test config
+import asset_index
+import probe_cache
+import render_manifest
 from video_engine import get_video_info
 
 # Supported media file extensions
@@ -9,53 +12,85 @@ VIDEO_EXTENSIONS = ['.mp4', '.mov', '.avi', '.mkv', '.webm']
 IMAGE_EXTENSIONS = ['.jpg', '.jpeg', '.png', '.webp']
 AUDIO_EXTENSIONS = ['.mp3', '.wav', '.aac', '.m4a']
 
+# When filling a target duration, a last clip shorter than this is not worth a cut; an image is stretched instead.
+MIN_TRIMMED_CLIP_SECONDS = 0.5
+
 def _scan_folder_for_files(folder_path, extensions):
-    """Scans a folder for files with given extensions."""
-    found_files = []
-    if not os.path.isdir(folder_path):
-        # print(f"Warning: Folder not found or not a directory: {folder_path}") # Less verbose
-        return found_files
-    for ext in extensions:
-        found_files.extend(glob.glob(os.path.join(folder_path, f"*{ext}")))
-    return found_files
+    """
+    Scans a folder for files with given extensions.
+    Listings come from the in-memory asset index, which only re-reads a folder when its mtime changes.
+    """
+    # print(f"Warning: Folder not found or not a directory: {folder_path}") # Less verbose
+    return asset_index.list_files(folder_path, extensions)
 
 def _get_file_basename(file_path):
     """Returns the basename of a file without its extension."""
     return os.path.splitext(os.path.basename(file_path))[0]
 
-def select_voiceover(config):
-    """
-    Selects a random voiceover from the configured folder.
-    Skips voiceovers if a video with the same name already exists in the output folder.
-    Returns the path to the selected voiceover file, or None if none can be selected.
-    """
+def list_voiceovers(config):
+    """Lists every voiceover in the configured folder, sorted by path, whether or not its video is up to date."""
     voiceover_folder = config.get("voiceover_folder")
-    output_folder = config.get("output_folder")
-
     if not voiceover_folder or not os.path.isdir(voiceover_folder):
-        # print(f"Error: Voiceover folder not found or not specified: {voiceover_folder}")
-        return None
-
-    available_voiceovers = _scan_folder_for_files(voiceover_folder, AUDIO_EXTENSIONS)
-    if not available_voiceovers:
-        # print(f"No voiceovers found in {voiceover_folder}")
-        return None
-
-    random.shuffle(available_voiceovers)
+        return []
+    return sorted(_scan_folder_for_files(voiceover_folder, AUDIO_EXTENSIONS))
 
-    for vo_path in available_voiceovers:
-        vo_basename = _get_file_basename(vo_path)
-        potential_output_video = os.path.join(output_folder, f"{vo_basename}.mp4")
-        # Added configurable skip for existing output
-        if os.path.exists(potential_output_video) and config.get("skip_existing_output", True):
-            # print(f"Skipping voiceover {vo_path}, output video {potential_output_video} already exists.")
-            continue
+def list_pending_voiceovers(config):
+    """
+    Lists the voiceovers in the configured folder that still need a video, sorted by path.
+    Skips voiceovers whose video in the output folder is up to date: its render manifest still matches
+    the config, engine and input files (see render_manifest.check_output). With skip_existing_output
+    set to false every voiceover is listed.
+    """
+    voiceovers = list_voiceovers(config)
+    if not voiceovers:
+        return []
+    config_hash = render_manifest.config_fingerprint(config)
+    return [vo_path for vo_path in voiceovers if voiceover_needs_render(config, vo_path, config_hash)]
 
-        # print(f"Selected voiceover: {vo_path}")
-        return vo_path
+def voiceover_needs_render(config, vo_path, config_hash=None):
+    """
+    True unless the voiceover's video in the output folder is up to date (see list_pending_voiceovers).
+    config_hash is the config's render_manifest.config_fingerprint, computed if not given.
+    """
+    potential_output_video = os.path.join(config.get("output_folder"), f"{_get_file_basename(vo_path)}.mp4")
+    # Added configurable skip for existing output
+    if config.get("skip_existing_output", True) and os.path.exists(potential_output_video):
+        up_to_date, reason = render_manifest.check_output(potential_output_video,
+                                                          config_hash or render_manifest.config_fingerprint(config))
+        if up_to_date:
+            # print(f"Skipping voiceover {vo_path}, output video {potential_output_video} is up to date.")
+            return False
+        print(f"Re-rendering {potential_output_video}: {reason}.")
+    return True
+
+def selection_rng(config, voiceover_path=None, purpose=""):
+    """
+    Returns the random generator for one selection step ('voiceover', 'intro', 'outro', 'main', 'bgm') of a
+    voiceover's timeline. It is seeded from config["seed"] (or the project name if no seed is set), the
+    voiceover's name and the purpose, so the same project, voiceover and assets always give the same
+    timeline, and enabling e.g. an intro does not change which main clips are picked.
+    """
+    seed = config.get("seed")
+    if seed is None:
+        seed = config.get("project_name", "")
+    voiceover_name = _get_file_basename(voiceover_path) if voiceover_path else ""
+    digest = hashlib.sha256(f"{seed}|{voiceover_name}|{purpose}".encode('utf8')).hexdigest()
+    return random.Random(int(digest[:16], 16))
+
+def select_voiceover(config, rng=None, include_up_to_date=False):
+    """
+    Selects a random voiceover from the configured folder (with rng, by default the project's 'voiceover' RNG).
+    Skips voiceovers whose video in the output folder is up to date (see list_pending_voiceovers) unless
+    include_up_to_date is set (previews).
+    Returns the path to the selected voiceover file, or None if none can be selected.
+    """
+    pending_voiceovers = list_voiceovers(config) if include_up_to_date else list_pending_voiceovers(config)
+    if not pending_voiceovers:
+        # print("No suitable voiceover found (all might be processed or folder empty).")
+        return None
 
-    # print("No suitable voiceover found (all might be processed or folder empty).")
-    return None
+    # print(f"Selected voiceover: {vo_path}")
+    return (rng or selection_rng(config, purpose="voiceover")).choice(pending_voiceovers)
 
 def get_media_duration_seconds(file_path):
     """
@@ -76,10 +111,140 @@ def get_media_duration_seconds(file_path):
     return 0.0
 
 
-def get_main_clips_data(config, target_duration_seconds=None):
+def _video_mode_spans(duration, config, rng):
+    """
+    Returns the (start, duration) spans of a video clip to use according to config["video_mode"]:
+        full_clip:      the whole clip
+        start_random:   one subclip_duration piece starting at a random point
+        split_subclips: up to max_subclips_per_clip random pieces of subclip_duration, in source order
+        tiny_subclips:  the same with tiny_subclip_duration pieces
+    Clips shorter than the piece length are used whole.
+    """
+    video_mode = config.get("video_mode", "full_clip")
+    if video_mode == "start_random":
+        piece = min(config.get("subclip_duration", 4.0), duration)
+        return [(round(rng.uniform(0, duration - piece), 3), piece)]
+    if video_mode in ("split_subclips", "tiny_subclips"):
+        piece = config.get("subclip_duration", 4.0) if video_mode == "split_subclips" else config.get("tiny_subclip_duration", 1.0)
+        num_pieces = int(duration // piece) if piece > 0 else 0
+        if num_pieces <= 1:
+            return [(0.0, duration)]
+        chosen = sorted(rng.sample(range(num_pieces), min(num_pieces, config.get("max_subclips_per_clip", 3))))
+        return [(round(i * piece, 3), piece) for i in chosen]
+    if video_mode != "full_clip":
+        print(f"Warning: Unknown video_mode '{video_mode}', using full clips.")
+    return [(0.0, duration)]
+
+def _video_clips(vid_path, config, rng):
+    """Returns the clip dicts a video contributes to the timeline (see _video_mode_spans), or [] if it has no duration."""
+    duration = get_media_duration_seconds(vid_path)
+    if duration <= 0:
+        return []
+    clips = []
+    for start, span in _video_mode_spans(duration, config, rng):
+        clip = {'path': vid_path, 'type': 'video', 'duration': span}
+        if start > 0:
+            clip['start'] = start
+            clip['snap'] = True # Random start: the engine may move it to a keyframe to stream-copy the clip
+        clips.append(clip)
+    return clips
+
+def _order_subclips_by_source(clips):
+    """
+    Reorders the subclips of each file (keeping the slots they occupy in the timeline) so they play in
+    source order. The engine can then cut them from one opened input without buffering frames.
+    """
+    slots = {}
+    for index, clip in enumerate(clips):
+        if clip['type'] == 'video':
+            slots.setdefault(clip['path'], []).append(index)
+    for indexes in slots.values():
+        ordered = sorted((clips[i] for i in indexes), key=lambda c: c.get('start', 0))
+        for i, clip in zip(indexes, ordered):
+            clips[i] = clip
+    return clips
+
+def _clip_pool(file_paths, reuse, rng):
+    """Yields the (already shuffled) files once, or forever in fresh random orders if reuse is allowed."""
+    while file_paths:
+        yield from file_paths
+        if not reuse:
+            return
+        file_paths = rng.sample(file_paths, len(file_paths))
+
+def _video_clip_pool(video_files, reuse, config, rng):
+    """
+    Yields the clips of the videos (see _video_clips) in _clip_pool order. Videos that yield no clip
+    (unreadable, or probed at 0s) are left out of later passes, so a reusing pool runs dry instead of
+    cycling forever once no usable video is left.
+    """
+    while video_files:
+        usable = []
+        for vid_path in video_files:
+            clips = _video_clips(vid_path, config, rng)
+            if clips:
+                usable.append(vid_path)
+                yield from clips
+        if not reuse:
+            return
+        video_files = rng.sample(usable, len(usable))
+
+def _select_clips_for_duration(video_files, image_files, target_duration, image_share, unique_assets, image_duration, config, rng):
+    """
+    Picks clips until their (probed) durations add up to target_duration, keeping about image_share
+    of the clips (by count) images. The clip that crosses the target is shortened to end exactly on it
+    and placed last, after the shuffled others. Videos are only probed once they are picked, and
+    contribute one clip per subclip of the configured video_mode.
+    """
+    video_pool = _video_clip_pool(video_files, not unique_assets, config, rng)
+    image_pool = _clip_pool(image_files, not unique_assets, rng)
+    selected_clips = []
+    total_duration = 0.0
+    num_images = 0
+
+    while total_duration < target_duration - 1e-3:
+        want_image = image_share > 0 and num_images < image_share * (len(selected_clips) + 1)
+        clip = None
+        for clip_type in (('image', 'video') if want_image else ('video', 'image')):
+            if clip_type == 'image':
+                img_path = next(image_pool, None)
+                if img_path:
+                    clip = {'path': img_path, 'type': 'image', 'duration': image_duration}
+            else:
+                clip = next(video_pool, None)
+            if clip:
+                break
+        if not clip:
+            print(f"Warning: Main clips only cover {total_duration:.2f}s of the {target_duration:.2f}s target " +
+                  ("(set unique_assets to false to allow reusing clips)." if unique_assets else
+                   "(no readable video or image left to reuse)."))
+            break
+        selected_clips.append(clip)
+        total_duration += clip['duration']
+        num_images += clip['type'] == 'image'
+
+    if not selected_clips or total_duration < target_duration - 1e-3:
+        rng.shuffle(selected_clips) # Library too small: use everything at full length
+        return _order_subclips_by_source(selected_clips)
+    last_clip = selected_clips.pop()
+    remaining = target_duration - sum(c['duration'] for c in selected_clips)
+    rng.shuffle(selected_clips)
+    images = [c for c in selected_clips if c['type'] == 'image']
+    if remaining < MIN_TRIMMED_CLIP_SECONDS and images:
+        images[-1]['duration'] += remaining # Avoid a flash-frame last clip, show an image a bit longer instead
+    else:
+        last_clip['duration'] = round(remaining, 3)
+        selected_clips.append(last_clip)
+    return _order_subclips_by_source(selected_clips)
+
+def get_main_clips_data(config, target_duration_seconds=None, rng=None):
     """
     Selects main video and image clips based on the configuration.
+    With target_duration_seconds the clips fill exactly that much time (see _select_clips_for_duration);
+    otherwise num_main_clips_target clips are selected at their full length.
+    All random choices come from rng (by default the project's 'main' RNG, see selection_rng).
     """
+    rng = rng or selection_rng(config, purpose="main")
     video_folders = config.get("main_clips_videos_folders", [])
     image_folders = config.get("main_clips_images_folder", [])
     image_percentage_target = config.get("image_percentage", 0) / 100.0
@@ -102,8 +267,15 @@ def get_main_clips_data(config, target_duration_seconds=None):
         # print("Warning: No video or image files found in specified main_clips folders.")
         return []
 
-    random.shuffle(all_video_files)
-    random.shuffle(all_image_files)
+    rng.shuffle(all_video_files)
+    rng.shuffle(all_image_files)
+
+    if target_duration_seconds and target_duration_seconds > 0:
+        if unique_assets: # The same folder may be listed twice
+            all_video_files = list(dict.fromkeys(all_video_files))
+            all_image_files = list(dict.fromkeys(all_image_files))
+        return _select_clips_for_duration(all_video_files, all_image_files, target_duration_seconds,
+                                          image_percentage_target, unique_assets, default_image_display_duration, config, rng)
 
     selected_clips = []
     used_assets = set()
@@ -154,12 +326,40 @@ def get_main_clips_data(config, target_duration_seconds=None):
             selected_clips.append({'path': img_path, 'type': 'image', 'duration': default_image_display_duration})
             if unique_assets: used_assets.add(img_path)
 
-    random.shuffle(selected_clips)
+    # Each selected video contributes the subclips of the configured video_mode
+    selected_clips = [sub_clip for clip in selected_clips
+                      for sub_clip in (_video_clips(clip['path'], config, rng) if clip['type'] == 'video' else [clip])]
+    rng.shuffle(selected_clips)
+    selected_clips = _order_subclips_by_source(selected_clips)
     # print(f"Selected {len(selected_clips)} main clips ({sum(1 for c in selected_clips if c['type'] == 'image')} images, {sum(1 for c in selected_clips if c['type'] == 'video')} videos).")
     return selected_clips
 
-def select_bgm(config):
-    """Selects a random BGM from the configured folder."""
+def get_loudnorm_params(file_path, config):
+    """
+    Returns loudnorm filter options that bring file_path to the configured loudness ("loudnorm" targets)
+    in a single linear pass, using the measurement stored in the probe cache (taken once per file).
+    Returns None if normalization is disabled or the file cannot be measured (e.g. digital silence).
+    """
+    settings = config.get("loudnorm") or {}
+    if not file_path or not settings.get("enabled"):
+        return None
+    integrated, true_peak, loudness_range = settings.get("I", -16.0), settings.get("TP", -1.5), settings.get("LRA", 11.0)
+    measured = probe_cache.get_loudness(file_path, integrated, true_peak, loudness_range)
+    if not measured:
+        return None
+    try:
+        values = [float(measured[key]) for key in ('input_i', 'input_tp', 'input_lra', 'input_thresh', 'target_offset')]
+    except ValueError:
+        return None
+    if any(abs(v) == float('inf') for v in values): # Silent files measure -inf
+        return None
+    measured_i, measured_tp, measured_lra, measured_thresh, offset = values
+    return {'I': integrated, 'TP': true_peak, 'LRA': loudness_range,
+            'measured_I': measured_i, 'measured_TP': measured_tp, 'measured_LRA': measured_lra,
+            'measured_thresh': measured_thresh, 'offset': offset, 'linear': 'true'}
+
+def select_bgm(config, rng=None):
+    """Selects a random BGM from the configured folder (with rng, by default the project's 'bgm' RNG)."""
     bgm_folder = config.get("bgm_folder")
     if not bgm_folder or not os.path.isdir(bgm_folder):
         # print(f"Warning: BGM folder not found or not specified: {bgm_folder}")
@@ -170,7 +370,7 @@ def select_bgm(config):
         # print(f"No BGM files found in {bgm_folder}")
         return None
 
-    selected_bgm_path = random.choice(available_bgm)
+    selected_bgm_path = (rng or selection_rng(config, purpose="bgm")).choice(available_bgm)
     # print(f"Selected BGM: {selected_bgm_path}")
     return selected_bgm_path
 
@@ -1,92 +1,294 @@
 import argparse
 import os
+import io
+import sys
 import json
 import time
-import random
+import threading
+import contextlib
+import functools
+import signal
+from concurrent.futures import ProcessPoolExecutor, as_completed, wait, FIRST_COMPLETED
 import ffmpeg # Added for __main__ block's dummy asset creation
 from config_loader import load_config, DEFAULT_CONFIG
 
-from asset_manager import (select_voiceover, get_main_clips_data,
+from asset_manager import (select_voiceover, list_voiceovers, list_pending_voiceovers, get_main_clips_data,
                            get_media_duration_seconds, _scan_folder_for_files,
-                           select_bgm,
+                           select_bgm, get_loudnorm_params, selection_rng, voiceover_needs_render,
                            AUDIO_EXTENSIONS, VIDEO_EXTENSIONS, _get_file_basename)
-from video_engine import combine_videos_and_watermark, get_video_info
-
-
-def process_project(project_config_path):
-    print(f"\nProcessing project: {project_config_path}")
+from video_engine import (combine_videos_and_watermark, plan_render, get_video_info,
+                          set_progress_callback, get_last_render_stats, _parse_resolution)
+import probe_cache
+import asset_index
+import segment_cache
+import render_manifest
+import metrics
+import ffmpeg_capabilities
+import calibrate
+import watcher
+
+PLAN_VERSION = 1
+# Config keys a replayed plan needs to find the caches the plan was made with
+PLAN_CACHE_SETTINGS = ["cache_folder", "segment_cache", "keyframe_index"]
+
+
+def _project_result(project_label, status, output_path=None, seconds=0.0, stats=None):
+    """
+    Builds the per-render result record collected for the end-of-batch summary.
+    stats is the engine's record of a finished render (see video_engine.get_last_render_stats).
+    """
+    return {'project': project_label, 'status': status, 'output': output_path, 'seconds': seconds, 'stats': stats}
+
+
+def _finished_render_result(project_label, output_path, seconds):
+    """Result of a successful render, with the engine's encode stats (also printed as one line)."""
+    stats = get_last_render_stats()
+    if stats:
+        print(f"Encode stats: {stats['route']}, {stats['duration']:.2f}s of video in {stats['wall_seconds']:.2f}s "
+              f"({stats['speed']}x realtime), {stats['frames']} frame(s) at {stats['fps']} fps, "
+              f"{len(stats['commands'])} ffmpeg command(s)")
+    return _project_result(project_label, 'success', output_path, seconds, stats)
+
+
+_progress_lock = threading.Lock()
+_running_commands = {} # output path -> latest progress stats
+
+
+def _show_progress(stats):
+    """
+    Progress callback for interactive runs: keeps one status line summing up the ffmpeg commands
+    currently running (several while chunks are encoded in parallel).
+    """
+    with _progress_lock:
+        if stats['done']:
+            _running_commands.pop(stats['output'], None)
+        else:
+            _running_commands[stats['output']] = stats
+        running = list(_running_commands.values())
+        line = ""
+        if running:
+            etas = [s['eta'] for s in running if s['eta'] is not None]
+            speeds = [s['speed'] for s in running if s['speed']]
+            line = (f"  ffmpeg: {len(running)} running, frame {sum(s['frame'] for s in running)}, "
+                    f"{sum(s['fps'] or 0 for s in running):.0f} fps"
+                    + (f", {min(speeds):.2f}x" if speeds else "")
+                    + (f", ETA {max(etas):.0f}s" if etas else ""))
+        sys.stdout.write("\r" + line.ljust(79) + ("" if running else "\r"))
+        sys.stdout.flush()
+
+
+def _configure_caches(config):
+    """Points the probe cache (and its keyframe index), asset index and segment cache at the project's cache folder."""
+    probe_cache.configure(probe_cache.cache_file_for_config(config))
+    probe_cache.set_keyframe_index_enabled(config.get("keyframe_index", True))
+    asset_index.configure(asset_index.index_file_for_config(config))
+    segment_cache.configure_for_config(config)
+
+
+def _load_project(project_config_path, seed=None):
+    """
+    Loads a project config and warms the probe cache and asset index for it.
+    seed, if given, overrides the config's "seed" (see asset_manager.selection_rng).
+    Returns (config, project_name), or (None, project_name) if the config could not be loaded.
+    """
+    project_name = _get_file_basename(project_config_path)
     try:
-        config = load_config(project_config_path)
-        project_name = config.get("project_name", _get_file_basename(project_config_path))
-        print(f"Successfully loaded configuration for: {project_name}")
+        with metrics.stage("config"):
+            config = load_config(project_config_path)
+            if seed is not None:
+                config["seed"] = seed
+            project_name = config.get("project_name", _get_file_basename(project_config_path))
+            print(f"Successfully loaded configuration for: {project_name}")
+            # Settle the encoder before any selection or probing work, instead of failing at the first encode
+            encoder_profile = ffmpeg_capabilities.resolve_encoder_profile(config["final"])
+            if encoder_profile is None:
+                print(f"Error: None of the encoder profiles of {project_name} can be used with this ffmpeg. Skipping project.")
+                return None, project_name
+            if encoder_profile != config["final"].get("selected_encoder_profile"):
+                print(f"Using encoder profile '{encoder_profile}' instead of '{config['final'].get('selected_encoder_profile')}'.")
+                config["final"]["selected_encoder_profile"] = encoder_profile
+            _configure_caches(config)
+        asset_index.build_index(config) # Listing the folders is recorded as "scan"
     except FileNotFoundError:
         print(f"Error: Config file not found {project_config_path}")
-        return
+        return None, project_name
     except Exception as e:
         print(f"Error loading configuration {project_config_path}: {e}")
         import traceback
         traceback.print_exc()
-        return
+        return None, project_name
+    return config, project_name
+
+
+def _voiceovers_to_render(config, all_voiceovers=False, max_videos=None, include_up_to_date=False):
+    """
+    Returns the voiceovers to render for a loaded project: one randomly selected voiceover by default,
+    or every pending voiceover (capped at max_videos) in batch mode. include_up_to_date (previews) also
+    counts voiceovers whose video is up to date.
+    """
+    if not all_voiceovers and not max_videos:
+        selected_vo_path = select_voiceover(config, include_up_to_date=include_up_to_date)
+        return [selected_vo_path] if selected_vo_path else []
+    pending = list_voiceovers(config) if include_up_to_date else list_pending_voiceovers(config)
+    return pending[:max_videos] if max_videos else pending
+
+
+def process_project(project_config_path, encoder_threads=None, all_voiceovers=False, max_videos=None, parallel_chunks=None,
+                    plan_only=False, seed=None, preview=None):
+    """
+    Renders a project config: one video for a randomly selected voiceover, or with all_voiceovers
+    (or max_videos) one video per pending voiceover, in sequence. The config, asset listings and
+    probe data are loaded once and shared by all renders.
+    encoder_threads overrides final.threads (used by the worker pool to split the CPU budget),
+    parallel_chunks overrides the config's "parallel_chunks". With plan_only, a plan is written
+    for each video instead of rendering it (see render_voiceover). seed overrides the config's "seed".
+    With preview (a dict of overrides of the config's "preview" settings, possibly empty) a low-resolution
+    preview of each video is rendered instead (see _preview_render_args).
+    Returns a list of result dicts with 'project', 'status' ('success', 'skipped' or 'failed'), 'output' and 'seconds'.
+    """
+    print(f"\nProcessing project: {project_config_path}")
+    config, project_name = _load_project(project_config_path, seed)
+    if config is None:
+        return [_project_result(project_name, 'failed')]
 
-    selected_vo_path = select_voiceover(config)
-    if not selected_vo_path:
+    voiceovers = _voiceovers_to_render(config, all_voiceovers, max_videos, include_up_to_date=preview is not None)
+    if not voiceovers:
         print(f"No suitable voiceover found for {project_name}, or project already processed. Skipping project.")
-        return
+        return [_project_result(project_name, 'skipped')]
+    if len(voiceovers) > 1:
+        print(f"Rendering {len(voiceovers)} pending voiceover(s) for {project_name}.")
+
+    return [render_voiceover(config, project_name, vo_path, encoder_threads=encoder_threads, parallel_chunks=parallel_chunks,
+                             plan_only=plan_only, preview=preview)
+            for vo_path in voiceovers]
+
+
+def _plan_path_for_output(output_path):
+    """Plans are written next to the video they describe: output/<voiceover>.plan.json."""
+    return os.path.splitext(output_path)[0] + ".plan.json"
+
+
+def render_voiceover(config, project_name, selected_vo_path, encoder_threads=None, parallel_chunks=None, plan_only=False,
+                     preview=None):
+    """
+    Selects the timeline for one voiceover of a loaded project and renders it.
+    With plan_only nothing is encoded: the selection and the compiled ffmpeg commands are written to a
+    JSON plan (see write_plan) that replay_plan can render later without selecting again.
+    With preview (see process_project) the same selection is rendered as a preview; previews get no manifest.
+    Returns a result dict (see _project_result); a written plan has status 'planned' and the plan as 'output'.
+    """
+    with metrics.stage("select"):
+        render_args = _select_render_args(config, selected_vo_path, encoder_threads, parallel_chunks)
+        if render_args is not None and preview is not None:
+            render_args = _preview_render_args(config, render_args, preview)
+    if render_args is None:
+        print(f"Nothing to render for {project_name}. Skipping.")
+        return _project_result(project_name, 'skipped')
+    output_video_path = render_args['output_path']
+
+    if plan_only:
+        plan_path = _plan_path_for_output(output_video_path)
+        try:
+            with metrics.stage("graph"):
+                write_plan(plan_path, config, project_name, selected_vo_path, render_args)
+        except Exception as e:
+            print(f"Error planning {project_name}: {e}")
+            import traceback
+            traceback.print_exc()
+            return _project_result(project_name, 'failed', plan_path)
+        return _project_result(project_name, 'planned', plan_path)
+
+    start_time = time.time()
+    try:
+        with metrics.stage("graph"): # Encoding and muxing inside are charged to their own stages
+            combine_videos_and_watermark(**render_args)
+        end_time = time.time()
+        if preview is None:
+            render_manifest.write_manifest(output_video_path, render_args, render_manifest.config_fingerprint(config))
+        print(f"Project {project_name} processed successfully in {end_time - start_time:.2f} seconds.")
+        return _finished_render_result(project_name, output_video_path, end_time - start_time)
+    except Exception as e:
+        print(f"Error during processing {project_name}: {e}")
+        import traceback
+        traceback.print_exc()
+        return _project_result(project_name, 'failed', output_video_path, time.time() - start_time)
+
 
+def _select_render_args(config, selected_vo_path, encoder_threads=None, parallel_chunks=None):
+    """
+    Selects the intro, main clips, outro, watermark and BGM for one voiceover and resolves the output
+    settings. Returns the combine_videos_and_watermark arguments, or None if there is nothing to render.
+    Every choice is drawn from RNGs seeded per project and voiceover (see asset_manager.selection_rng),
+    so the same config, voiceover and asset folders always give the same timeline.
+    """
     vo_duration = get_media_duration_seconds(selected_vo_path)
     if vo_duration <= 0:
         print(f"Warning: Voiceover {selected_vo_path} has zero or invalid duration. Processing may be unpredictable.")
 
-    # The selected_vo_path is primarily for output naming and to ensure it's processed.
-    # Actual audio from selected_vo_path is NOT automatically the main audio track unless it's part of a video.
-    # The video_engine's combine_videos_and_watermark function takes audio from the video segments.
-    # If selected_vo_path is an audio-only file, it should be explicitly handled:
-    # e.g. by making it the first item in timeline_segments_for_engine IF video_engine can handle audio-only inputs as primary audio,
-    # or by a dedicated parameter in video_engine.
-    # For now, let's assume that if a voiceover is critical, it's part of one of the main video clips,
-    # or it will be handled by a more advanced audio mixing strategy later.
-    # The current video_engine primarily concatenates audio from video sources and then optionally adds BGM.
-
-    main_clips_list = get_main_clips_data(config, target_duration_seconds=vo_duration)
-    if not main_clips_list:
-        print(f"No main clips selected for {project_name}. Skipping project.")
-        return
-
-    timeline_segments_for_engine = []
+    # The selected_vo_path names the output and sets its length. Its audio is mixed into the soundtrack
+    # (over the clips' own audio and the BGM) when ENABLE_VOICEOVER_AUDIO is on.
 
+    # Intro and outro are picked first, so the main clips can fill exactly the rest of the voiceover
+    chosen_intro = None
     if config.get("ENABLE_INTRO", False):
         intro_folder = config.get("intro_folder")
         if intro_folder and os.path.isdir(intro_folder):
             intro_files = _scan_folder_for_files(intro_folder, VIDEO_EXTENSIONS)
             if intro_files:
-                chosen_intro = random.choice(intro_files)
-                timeline_segments_for_engine.append(chosen_intro)
+                chosen_intro = selection_rng(config, selected_vo_path, "intro").choice(intro_files)
                 print(f"Added intro: {chosen_intro}")
             else:
                 print(f"Warning: ENABLE_INTRO is true, but no intro files found in {intro_folder}")
         else:
             print(f"Warning: ENABLE_INTRO is true, but intro_folder '{intro_folder}' is not valid or not found.")
 
-
-    # Add Main Clips (both videos and images are now handled by video_engine via the list of dicts/paths)
-    timeline_segments_for_engine.extend(main_clips_list)
-
+    chosen_outro = None
     if config.get("ENABLE_OUTRO", False):
         outro_folder = config.get("outro_folder")
         if outro_folder and os.path.isdir(outro_folder):
             outro_files = _scan_folder_for_files(outro_folder, VIDEO_EXTENSIONS)
             if outro_files:
-                chosen_outro = random.choice(outro_files)
-                timeline_segments_for_engine.append(chosen_outro)
+                chosen_outro = selection_rng(config, selected_vo_path, "outro").choice(outro_files)
                 print(f"Added outro: {chosen_outro}")
             else:
                 print(f"Warning: ENABLE_OUTRO is true, but no outro files found in {outro_folder}")
         else:
              print(f"Warning: ENABLE_OUTRO is true, but outro_folder '{outro_folder}' is not valid or not found.")
 
+    main_target_duration = None
+    if vo_duration > 0:
+        bookends_duration = sum(get_media_duration_seconds(p) for p in (chosen_intro, chosen_outro) if p)
+        main_target_duration = vo_duration - bookends_duration
+        if main_target_duration <= 0:
+            print(f"Warning: Intro and outro ({bookends_duration:.2f}s) already cover the voiceover ({vo_duration:.2f}s). "
+                  f"Falling back to num_main_clips_target.")
+            main_target_duration = None
+
+    main_clips_list = get_main_clips_data(config, target_duration_seconds=main_target_duration,
+                                          rng=selection_rng(config, selected_vo_path, "main"))
+    if not main_clips_list:
+        print(f"No main clips selected for {selected_vo_path}.")
+        return None
+
+    timeline_segments_for_engine = []
+    if chosen_intro:
+        # Intros are reused across renders, so let the engine cache their normalized form
+        timeline_segments_for_engine.append({'path': chosen_intro, 'type': 'video', 'cache': True})
+
+    # Add Main Clips (both videos and images are now handled by video_engine via the list of dicts/paths)
+    # Stills are cheap to pre-render and recur across projects, so they are cached by default;
+    # main video clips only when configured (caching a clip used once costs an extra encode)
+    cache_settings = config.get("segment_cache") or {}
+    cached_clip_types = {t for t, key in (('image', 'images'), ('video', 'main_clips')) if cache_settings.get(key)}
+    main_clips_list = [dict(clip, cache=True) if clip['type'] in cached_clip_types else clip for clip in main_clips_list]
+    timeline_segments_for_engine.extend(main_clips_list)
+
+    if chosen_outro:
+        timeline_segments_for_engine.append({'path': chosen_outro, 'type': 'video', 'cache': True})
+
     if not timeline_segments_for_engine:
-        print(f"No video/image segments (intro, main, outro) to process for {project_name}. Skipping.")
-        return
+        print(f"No video/image segments (intro, main, outro) to process for {selected_vo_path}.")
+        return None
 
     output_basename = _get_file_basename(selected_vo_path)
     output_video_path = os.path.join(config["output_folder"], f"{output_basename}.mp4")
@@ -104,7 +306,7 @@ def process_project(project_config_path):
     bgm_file_path = None
     bgm_vol = config.get("bgm_volume", 0.25) # Default BGM volume from config or hardcoded
     if config.get("ENABLE_BGM", False): # Defaulting to False unless specified
-        bgm_file_path = select_bgm(config)
+        bgm_file_path = select_bgm(config, selection_rng(config, selected_vo_path, "bgm"))
         if bgm_file_path and not os.path.exists(bgm_file_path):
             print(f"Warning: BGM file selected '{bgm_file_path}' but not found. No BGM will be added.")
             bgm_file_path = None
@@ -137,12 +339,22 @@ def process_project(project_config_path):
     # Order of precedence: project_specific_final_config > project_profile > default_profile
     profile_keys = ['crf', 'preset', 'tune', 'cq', 'vquality'] # Removed 'extra_args' for special handling
     for key in profile_keys:
+        option = ffmpeg_capabilities.PROFILE_OPTION_NAMES.get(key, key) # e.g. vquality is -global_quality
         if key in final_config_params: # Direct override in final config
-             output_render_params[key] = final_config_params[key]
+            output_render_params[option] = final_config_params[key]
         elif key in project_profile_params: # From project's chosen profile
-            output_render_params[key] = project_profile_params[key]
+            output_render_params[option] = project_profile_params[key]
         elif key in base_profile_params: # From default config's chosen profile
-            output_render_params[key] = base_profile_params[key]
+            output_render_params[option] = base_profile_params[key]
+    # This host's calibrated x264 preset (see calibrate.py) replaces the profile's, unless final.preset is set
+    preset = calibrate.calibrated_preset(final_config_params, output_render_params.get('vcodec'))
+    if preset:
+        output_render_params['preset'] = preset
+
+    # Encoder threads: the worker pool's share of the CPU takes precedence over final.threads
+    threads = encoder_threads or final_config_params.get('threads', default_final_config.get('threads'))
+    if threads:
+        output_render_params['threads'] = threads
 
     # Handle extra_args from the profile carefully (project or default)
     # Project profile extra_args take precedence over default profile extra_args
@@ -152,79 +364,493 @@ def process_project(project_config_path):
     # For this specific structure, let's assume project_extra_args is complete if provided.
     effective_extra_args = project_extra_args if project_extra_args else default_extra_args
 
-    for arg in effective_extra_args:
-        if arg.startswith("-x264-params"):
-            # Ensure there's a space before splitting, otherwise value might be lost
-            if " " in arg:
-                output_render_params['x264-params'] = arg.split(" ", 1)[1]  # Use hyphenated key
-            else: # Handle cases like "-x264-params" without a value, if that's ever valid (unlikely)
-                output_render_params['x264-params'] = ""
-        elif arg.startswith("-movflags"):
-            if " " in arg:
-                output_render_params['movflags'] = arg.split(" ", 1)[1]
-            else:
-                output_render_params['movflags'] = "" # e.g. if it was just "-movflags"
-        elif arg.startswith("-pix_fmt"):
-            # This is usually handled by the main 'pix_fmt' key, but if present in extra_args
-            if " " in arg:
-                output_render_params['pix_fmt'] = arg.split(" ", 1)[1]
-        # Add more specific handlers if other extra_args are common
-        else:
-            parts = arg.split(" ", 1)
-            if len(parts) == 2 and parts[0].startswith("-"):
-                # ffmpeg-python often uses the option name without '-' as kwarg
-                # This is a general guess and might not work for all ffmpeg options.
-                # Example: -tune film -> tune='film' (already handled by profile_keys)
-                # Example: -profile:v high -> profile_v='high' (needs manual mapping)
-                # For safety, only add known/tested ones or provide a more robust parser.
-                # For now, this is a placeholder for expansion.
-                print(f"Warning: Unhandled extra_arg '{arg}' may not be correctly applied.")
-            elif parts[0].startswith("-"): # Flag without value
-                 # output_render_params[parts[0][1:]] = True # Or some other indicator
-                 print(f"Warning: Unhandled valueless extra_arg '{arg}' may not be correctly applied.")
+    # Every option reaches ffmpeg as-is, e.g. "-rc:v vbr" as rc:v='vbr' (see ffmpeg_capabilities.extra_args_to_params)
+    output_render_params.update(ffmpeg_capabilities.extra_args_to_params(effective_extra_args))
 
 
     print(f"Timeline segments for engine: {timeline_segments_for_engine}")
     print(f"Output video: {output_video_path}")
     print(f"Watermark: {watermark_file_path if watermark_file_path else 'No'}")
     print(f"BGM: {bgm_file_path if bgm_file_path else 'No'}, Volume: {bgm_vol if bgm_file_path else 'N/A'}")
+    voiceover_audio_path = selected_vo_path if config.get("ENABLE_VOICEOVER_AUDIO", True) else None
+    voiceover_vol = config.get("voiceover_volume", 1.0)
+    print(f"Voiceover audio: {'Yes' if voiceover_audio_path else 'No'}, Volume: {voiceover_vol if voiceover_audio_path else 'N/A'}")
     print(f"Output parameters: {output_render_params}")
-
+    chunks = parallel_chunks or config.get("parallel_chunks", 1)
+    if chunks > 1:
+        print(f"Parallel chunks: {chunks}")
+
+    renditions = []
+    for rendition in final_config_params.get("renditions") or []:
+        name = rendition.get("name")
+        if not name:
+            print(f"Warning: Rendition without a name skipped: {rendition}")
+            continue
+        rendition_params = {k: v for k, v in rendition.items() if k != "name"}
+        rendition_params['output_path'] = os.path.join(config["output_folder"], f"{output_basename}.{name}.mp4")
+        renditions.append(rendition_params)
+    if renditions:
+        print(f"Renditions: {', '.join(r['output_path'] for r in renditions)}")
+
+    # Everything the engine needs; a plan stores exactly these arguments
+    return dict(
+        video_files_and_image_specs=timeline_segments_for_engine,
+        output_path=output_video_path,
+        watermark_path=watermark_file_path,
+        watermark_params=config.get("watermark_params"), # Pass full watermark_params dict
+        output_params=output_render_params,
+        bgm_path=bgm_file_path,
+        bgm_volume=bgm_vol,
+        parallel_chunks=chunks,
+        voiceover_path=voiceover_audio_path,
+        voiceover_volume=voiceover_vol,
+        bgm_loudnorm=get_loudnorm_params(bgm_file_path, config),
+        voiceover_loudnorm=get_loudnorm_params(voiceover_audio_path, config),
+        renditions=renditions
+    )
+
+
+def _scale_pixel_value(value, scale):
+    """Scales a plain pixel value (50, "10") by scale; ffmpeg expressions such as "W-w-10" are returned unchanged."""
+    try:
+        return str(max(1, round(float(value) * scale)))
+    except (TypeError, ValueError):
+        return value
+
+
+def _cap_timeline(specs, max_seconds):
+    """Returns the timeline specs that start within the first max_seconds, the last one shortened to end there."""
+    capped, elapsed = [], 0.0
+    for item in specs:
+        if elapsed >= max_seconds:
+            break
+        spec = {'type': 'video', 'path': item} if isinstance(item, str) else item
+        duration = spec.get('duration') or get_media_duration_seconds(spec['path'])
+        if elapsed + duration > max_seconds:
+            item = dict(spec, duration=round(max_seconds - elapsed, 3))
+        capped.append(item)
+        elapsed += duration
+    return capped
+
+
+def _preview_render_args(config, render_args, preview):
+    """
+    Turns the render arguments of a video into those of its preview: the same timeline, watermark and
+    soundtrack, scaled down by the config's "preview" settings (resolution and fps fractions, ultrafast x264),
+    cut after max_seconds if set, reading the clips from cached low-resolution proxies and written to
+    <output_folder>/previews/. preview overrides the config's settings (e.g. max_seconds from --preview-seconds).
+    """
+    settings = dict(DEFAULT_CONFIG["preview"], **(config.get("preview") or {}))
+    settings.update({k: v for k, v in preview.items() if v is not None})
+    scale = float(settings["scale"])
+    params = render_args['output_params']
+    width, height = _parse_resolution(params.get('resolution'))
+    if not (width and height): # Final videos then keep their sources' size; previews get a fraction of the default one
+        width, height = DEFAULT_CONFIG["final"]["resolution"]
+    output_params = {'vcodec': 'libx264', 'preset': 'ultrafast', 'crf': settings["crf"], 'pix_fmt': 'yuv420p',
+                     'fps': max(1, round(float(params.get('fps') or DEFAULT_CONFIG["final"]["fps"]) * float(settings["fps_scale"])))}
+    output_params['resolution'] = [max(2, int(width * scale) // 2 * 2), max(2, int(height * scale) // 2 * 2)]
+    output_params.update({k: params[k] for k in ('acodec', 'audio_bitrate', 'threads') if k in params})
+
+    # Pixel sizes and offsets of the watermark shrink with the video (100px is the engine's default width)
+    watermark_params = dict(render_args.get('watermark_params') or {})
+    if not watermark_params.get('width_is_fraction_of_video'):
+        watermark_params.setdefault('fixed_width', 100)
+    for key in ('fixed_width', 'position_x', 'position_y'):
+        if key in watermark_params:
+            watermark_params[key] = _scale_pixel_value(watermark_params[key], scale)
+
+    specs = render_args['video_files_and_image_specs']
+    if settings.get("max_seconds"):
+        specs = _cap_timeline(specs, float(settings["max_seconds"]))
+    preview_folder = os.path.join(config["output_folder"], "previews")
+    os.makedirs(preview_folder, exist_ok=True)
+    print(f"Preview: {output_params.get('resolution')} at {output_params['fps']} fps"
+          f"{', first ' + str(settings['max_seconds']) + 's' if settings.get('max_seconds') else ''}")
+    return dict(render_args, video_files_and_image_specs=specs, watermark_params=watermark_params,
+                output_path=os.path.join(preview_folder, os.path.basename(render_args['output_path'])),
+                output_params=output_params, parallel_chunks=1, renditions=[],
+                preview_proxies=bool(settings.get("proxies", True)))
+
+
+def write_plan(plan_path, config, project_name, voiceover_path, render_args):
+    """
+    Builds the render graph for render_args without encoding (see video_engine.plan_render) and writes the
+    plan as JSON: the engine arguments ('render', replayed as-is), the cache settings, the segments as they
+    would be cut, the compiled ffmpeg commands, expected duration, number of inputs and filter nodes, and the
+    estimated encode time. Returns the plan.
+    """
+    graph = plan_render(**render_args)
+    plan = {
+        'plan_version': PLAN_VERSION,
+        'project': project_name,
+        'voiceover': voiceover_path,
+        'created': time.strftime("%Y-%m-%dT%H:%M:%S"),
+        'render': render_args,
+        'caches': {key: config.get(key) for key in PLAN_CACHE_SETTINGS},
+        'config_hash': render_manifest.config_fingerprint(config), # Recorded in the render manifest on replay
+        **graph
+    }
+    os.makedirs(os.path.dirname(os.path.abspath(plan_path)), exist_ok=True)
+    with open(plan_path, 'w') as f:
+        json.dump(plan, f, indent=2)
+    print(f"Plan written: {plan_path} ({graph['route']}, {graph['expected_duration']:.2f}s, {len(graph['commands'])} ffmpeg command(s), "
+          f"{graph['inputs']} input(s), {graph['filter_nodes']} filter node(s), ~{graph['estimated_encode_seconds']:.0f}s to encode)")
+    return plan
+
+
+def replay_plan(plan_path, encoder_threads=None, parallel_chunks=None):
+    """
+    Renders a plan written by --plan with exactly its selection and settings. encoder_threads and
+    parallel_chunks override the planned values (e.g. when the farm machine differs from the planning one).
+    Returns a result dict (see _project_result).
+    """
+    print(f"\nReplaying plan: {plan_path}")
     try:
-        start_time = time.time()
-        combine_videos_and_watermark(
-            video_files_and_image_specs=timeline_segments_for_engine,
-            output_path=output_video_path,
-            watermark_path=watermark_file_path,
-            watermark_params=config.get("watermark_params"), # Pass full watermark_params dict
-            output_params=output_render_params,
-            bgm_path=bgm_file_path,
-            bgm_volume=bgm_vol
-        )
+        with open(plan_path, 'r') as f:
+            plan = json.load(f)
+        if plan.get('plan_version') != PLAN_VERSION:
+            raise ValueError(f"unsupported plan version {plan.get('plan_version')} (expected {PLAN_VERSION})")
+    except (OSError, ValueError) as e:
+        print(f"Error: Could not read plan {plan_path}: {e}")
+        return _project_result(plan_path, 'failed')
+
+    project_name = plan.get('project', _get_file_basename(plan_path))
+    _configure_caches(plan.get('caches') or {})
+    render_args = plan['render']
+    if encoder_threads:
+        render_args['output_params']['threads'] = encoder_threads
+    if parallel_chunks:
+        render_args['parallel_chunks'] = parallel_chunks
+
+    start_time = time.time()
+    try:
+        with metrics.stage("graph"):
+            combine_videos_and_watermark(**render_args)
         end_time = time.time()
-        print(f"Project {project_name} processed successfully in {end_time - start_time:.2f} seconds.")
+        render_manifest.write_manifest(render_args['output_path'], render_args, plan.get('config_hash'))
+        print(f"Plan {plan_path} rendered successfully in {end_time - start_time:.2f} seconds.")
+        return _finished_render_result(project_name, render_args['output_path'], end_time - start_time)
     except Exception as e:
-        print(f"Error during processing {project_name}: {e}")
+        print(f"Error replaying plan {plan_path}: {e}")
         import traceback
         traceback.print_exc()
+        return _project_result(project_name, 'failed', render_args['output_path'], time.time() - start_time)
+
+
+def _metrics_record(label, results, wall_seconds):
+    """One line of the metrics JSONL: a project (or work unit), its render results and its stage totals."""
+    return {
+        'project': label,
+        'finished': time.strftime("%Y-%m-%dT%H:%M:%S"),
+        'wall_seconds': round(wall_seconds, 3),
+        'results': [{k: r[k] for k in ('project', 'status', 'output', 'seconds')} for r in results],
+        'stages': metrics.snapshot(),
+    }
+
+
+def _run_in_worker(log_name, log_dir, project_label, func, *args, **kwargs):
+    """
+    Pool entry point: runs func (process_project or render_voiceover) with stdout/stderr captured,
+    so logs of concurrent renders do not interleave. Returns (results, log_text, metrics_record); the log
+    is also written to <log_dir>/<log_name>.log if log_dir is given.
+    """
+    metrics.reset()
+    start_time = time.time()
+    log_buffer = io.StringIO()
+    with contextlib.redirect_stdout(log_buffer), contextlib.redirect_stderr(log_buffer):
+        try:
+            results = func(*args, **kwargs)
+            if isinstance(results, dict):
+                results = [results]
+        except Exception: # func handles its own errors; this is a last resort
+            import traceback
+            traceback.print_exc()
+            results = [_project_result(project_label, 'failed')]
+        probe_cache.save()
+        asset_index.save()
+    log_text = log_buffer.getvalue()
+    if log_dir:
+        os.makedirs(log_dir, exist_ok=True)
+        with open(os.path.join(log_dir, f"{log_name}.log"), 'w') as f:
+            f.write(log_text)
+    return results, log_text, _metrics_record(project_label, results, time.time() - start_time)
+
+
+def _collect_worker_result(future, label):
+    """
+    Returns (results, metrics_record) of a finished _run_in_worker future and prints its captured log under
+    a header with the render statuses. A worker process that died (e.g. killed by the OOM killer) or was
+    interrupted counts as a failed render.
+    """
+    try:
+        results, log_text, metrics_record = future.result()
+    except (Exception, KeyboardInterrupt) as e: # The future is done: this is the worker's error, not ours
+        results = [_project_result(label, 'failed')]
+        log_text = f"Worker for {label} failed: {e}\n"
+        metrics_record = {'project': label, 'results': results, 'stages': {}}
+    print(f"===== {label} [{', '.join(r['status'] for r in results)}] =====")
+    print(log_text.rstrip())
+    print("-" * 50)
+    return results, metrics_record
+
+
+def _render_voiceover_in_worker(config, project_name, vo_path, encoder_threads, parallel_chunks=None, preview=None):
+    """Renders one voiceover of an already loaded project inside a pool worker."""
+    _configure_caches(config)
+    return render_voiceover(config, project_name, vo_path, encoder_threads=encoder_threads, parallel_chunks=parallel_chunks,
+                            preview=preview)
+
+
+def _print_batch_summary(results, wall_seconds):
+    """Prints counts of successful, planned, skipped and failed projects plus total wall time."""
+    by_status = {'success': [], 'planned': [], 'skipped': [], 'failed': []}
+    for result in results:
+        by_status.setdefault(result['status'], []).append(result)
+    print("\nBatch summary:")
+    print(f"  Succeeded: {len(by_status['success'])}")
+    if by_status['planned']:
+        print(f"  Planned:   {len(by_status['planned'])}")
+    print(f"  Skipped:   {len(by_status['skipped'])}")
+    print(f"  Failed:    {len(by_status['failed'])}")
+    for result in by_status['failed']:
+        print(f"    - {result['project']}" + (f" ({result['output']})" if result['output'] else ""))
+    render_seconds = sum(r['seconds'] for r in by_status['success'])
+    print(f"  Wall time: {wall_seconds:.2f}s (encode time of successful renders: {render_seconds:.2f}s)")
+
+
+def _list_project_configs(folder):
+    """The project configs (.json files) in folder, sorted by name."""
+    return sorted(os.path.join(folder, name) for name in os.listdir(folder) if name.lower().endswith(".json"))
+
+
+def watch_projects(input_path, jobs=1, encoder_threads=None, parallel_chunks=None, seed=None, log_dir=None,
+                   poll_seconds=watcher.DEFAULT_POLL_SECONDS, settle_seconds=watcher.DEFAULT_SETTLE_SECONDS,
+                   metrics_jsonl=None, metrics_prom=None):
+    """
+    Daemon mode (--watch): keeps the projects of input_path (a config file, or a folder of them that is
+    re-listed on every poll) loaded, and renders each voiceover arriving in their voiceover folders as soon
+    as the file is complete (see watcher.poll) and its video is not up to date. Voiceovers already there
+    when watching starts are handled the same way. A config that changes is reloaded and all of its
+    voiceovers are checked again. With jobs == 1 renders run in this process, keeping asset listings and
+    probe data in memory between them; with jobs > 1 they run in a long-lived worker pool (which reads
+    both from the cache files) while polling goes on. Metrics are written after every render. Runs until Ctrl+C or SIGTERM, then waits for running renders and prints the summary.
+    """
+    signal.signal(signal.SIGTERM, signal.default_int_handler) # Stop like on Ctrl+C, e.g. under systemd
+    projects = {} # config path -> {'mtime_ns', 'config', 'name'}
+    queue = []    # (config path, voiceover path) ready to render, in arrival order
+    running = {}  # future -> (config path, voiceover path)
+    results = []
+    metrics_records = []
+    start_time = time.time()
+    # Workers keep the default SIGTERM action: a render they are running is finished before the daemon stops
+    executor = ProcessPoolExecutor(max_workers=jobs, initializer=signal.signal,
+                                   initargs=(signal.SIGTERM, signal.SIG_DFL)) if jobs > 1 else None
+
+    def finish(unit_results, record):
+        results.extend(unit_results)
+        metrics_records.append(record)
+        if metrics_jsonl:
+            metrics.append_jsonl(metrics_jsonl, record)
+        if metrics_prom:
+            metrics.write_prometheus(metrics_prom, metrics_records, time.time() - start_time)
+
+    def collect(futures):
+        for future in futures:
+            path, vo_path = running.pop(future)
+            finish(*_collect_worker_result(future, f"{path} / {os.path.basename(vo_path)}"))
+
+    print(f"Watching {input_path} for voiceovers (polling every {poll_seconds:g}s, a file is complete after "
+          f"{settle_seconds:g}s without changes). Press Ctrl+C to stop.")
+    try:
+        while True:
+            config_files = _list_project_configs(input_path) if os.path.isdir(input_path) else [input_path]
+            for path in [p for p in projects if p not in config_files]:
+                print(f"Project config removed, no longer watching it: {path}")
+                del projects[path]
+            folders = {} # abs voiceover folder -> config paths watching it
+            for path in config_files:
+                try:
+                    mtime_ns = os.stat(path).st_mtime_ns
+                except OSError:
+                    continue
+                project = projects.get(path)
+                if project is None or project['mtime_ns'] != mtime_ns:
+                    print(f"\n{'Reloading' if project else 'Loading'} project: {path}")
+                    metrics.reset()
+                    config, project_name = _load_project(path, seed)
+                    projects[path] = project = {'mtime_ns': mtime_ns, 'config': config, 'name': project_name}
+                    if config and not config.get("voiceover_folder"):
+                        print(f"Warning: {project_name} has no voiceover_folder, nothing to watch.")
+                    elif config: # A changed config can make every video stale: check all voiceovers again
+                        watcher.forget(config["voiceover_folder"])
+                if project['config'] and project['config'].get("voiceover_folder"):
+                    folders.setdefault(os.path.abspath(project['config']["voiceover_folder"]), []).append(path)
+
+            for folder, paths in folders.items():
+                _configure_caches(projects[paths[0]]['config']) # The folder is listed through the asset index
+                for vo_path in watcher.poll([folder], AUDIO_EXTENSIONS, settle_seconds):
+                    for path in paths:
+                        item = (path, vo_path)
+                        if item not in queue and item not in running.values() and \
+                                voiceover_needs_render(projects[path]['config'], vo_path):
+                            print(f"Queued {os.path.basename(vo_path)} for {projects[path]['name']}.")
+                            queue.append(item)
+
+            if executor is None:
+                if queue:
+                    path, vo_path = queue.pop(0)
+                    if path in projects and projects[path]['config']:
+                        config, project_name = projects[path]['config'], projects[path]['name']
+                        _configure_caches(config)
+                        metrics.reset()
+                        render_start_time = time.time()
+                        result = render_voiceover(config, project_name, vo_path, encoder_threads=encoder_threads,
+                                                  parallel_chunks=parallel_chunks)
+                        probe_cache.save()
+                        asset_index.save()
+                        finish([result], _metrics_record(f"{path} / {os.path.basename(vo_path)}", [result],
+                                                         time.time() - render_start_time))
+                        print("-" * 50)
+                    continue # Poll again right away, the queue may hold more
+                time.sleep(poll_seconds)
+            else:
+                while queue and len(running) < jobs:
+                    path, vo_path = queue.pop(0)
+                    if path in projects and projects[path]['config']:
+                        config, project_name = projects[path]['config'], projects[path]['name']
+                        _configure_caches(config)
+                        probe_cache.save() # Let the worker start from the listings and probes gathered while polling
+                        asset_index.save()
+                        log_name = f"{_get_file_basename(path)}_{_get_file_basename(vo_path)}"
+                        running[executor.submit(_run_in_worker, log_name, log_dir, f"{path} / {os.path.basename(vo_path)}",
+                                                _render_voiceover_in_worker, config, project_name, vo_path,
+                                                encoder_threads=encoder_threads, parallel_chunks=parallel_chunks)] = (path, vo_path)
+                if running:
+                    collect(wait(running, timeout=poll_seconds, return_when=FIRST_COMPLETED).done)
+                else:
+                    time.sleep(poll_seconds)
+    except KeyboardInterrupt:
+        signal.signal(signal.SIGTERM, signal.SIG_IGN) # Already stopping; only Ctrl+C skips the wait below
+        print(f"\nStopping watch mode{f', waiting for {len(running)} running render(s)' if running else ''}...")
+    finally:
+        if executor is not None:
+            try:
+                collect(wait(running).done)
+            except KeyboardInterrupt: # A second Ctrl+C stops without waiting
+                pass
+            executor.shutdown(wait=False, cancel_futures=True)
+        probe_cache.save()
+        asset_index.save()
+    _print_batch_summary(results, time.time() - start_time)
+    return results
 
 
 def main():
     parser = argparse.ArgumentParser(description="Batch Video Processor")
     parser.add_argument("input_path",
-                        help="Path to a single project JSON config file or a directory containing multiple .json config files.")
+                        help="Path to a single project JSON config file or a directory containing multiple .json config files "
+                             "(with --replay: a .plan.json file or a directory of them).")
+    parser.add_argument("--jobs", "-j", type=int,
+                        help="Number of projects to render concurrently (default: this host's calibration, see calibrate.py, or 1).")
+    parser.add_argument("--threads-total", type=int,
+                        help="Encoder thread budget shared by all workers when --jobs > 1 (default: CPU count). "
+                             "Giving --jobs or --threads-total turns off the calibrated job and thread counts.")
+    parser.add_argument("--log-dir",
+                        help="With --jobs > 1, also write each render's log to <log-dir>/<config name>[_<voiceover>].log.")
+    parser.add_argument("--all-voiceovers", action="store_true",
+                        help="Render every pending voiceover of each project instead of one random voiceover.")
+    parser.add_argument("--max-videos", type=int,
+                        help="Render at most this many pending voiceovers per project (implies --all-voiceovers).")
+    parser.add_argument("--chunks", type=int,
+                        help="Encode each video as this many chunks in parallel (overrides the config's parallel_chunks).")
+    parser.add_argument("--plan", action="store_true",
+                        help="Select assets and build the ffmpeg commands without encoding; writes <output>/<voiceover>.plan.json per video.")
+    parser.add_argument("--replay", action="store_true",
+                        help="Render previously written plans (input_path) without selecting assets again.")
+    parser.add_argument("--preview", action="store_true",
+                        help="Render low-resolution previews of the selected timelines into <output_folder>/previews "
+                             "(scaled by the config's \"preview\" settings) instead of the final videos.")
+    parser.add_argument("--preview-seconds", type=float,
+                        help="Cut previews after this many seconds (implies --preview).")
+    parser.add_argument("--watch", action="store_true",
+                        help="Daemon mode: keep running and render voiceovers as they arrive in the projects' voiceover folders "
+                             "(a new .json file in an input directory is picked up as a new project).")
+    parser.add_argument("--poll-seconds", type=float, default=watcher.DEFAULT_POLL_SECONDS,
+                        help=f"With --watch, how often to check the voiceover folders (default: {watcher.DEFAULT_POLL_SECONDS:g}).")
+    parser.add_argument("--settle-seconds", type=float, default=watcher.DEFAULT_SETTLE_SECONDS,
+                        help="With --watch, how long a voiceover's size and modification time must stay the same before "
+                             f"it counts as complete (default: {watcher.DEFAULT_SETTLE_SECONDS:g}).")
+    parser.add_argument("--seed",
+                        help="Seed for asset selection, overriding each config's \"seed\" (default: the project name).")
+    parser.add_argument("--metrics-jsonl",
+                        help="Append per-project stage timings (wall, CPU, peak RSS) to this JSON lines file.")
+    parser.add_argument("--metrics-prom",
+                        help="Write the batch's stage timings as a Prometheus textfile (for node_exporter's textfile collector).")
     args = parser.parse_args()
 
     if not os.path.exists(args.input_path):
         print(f"Error: Input path does not exist: {args.input_path}")
         return
 
+    preview = {'max_seconds': args.preview_seconds} if args.preview or args.preview_seconds else None
+    if preview is not None and args.replay:
+        print("Error: --preview cannot be combined with --replay (plan a preview with --plan --preview instead).")
+        return
+    if args.plan and args.replay:
+        print("Error: --plan and --replay cannot be combined.")
+        return
+    if args.watch and (args.plan or args.replay or preview is not None):
+        print("Error: --watch renders final videos; it cannot be combined with --plan, --replay or --preview.")
+        return
+    if args.plan and (args.jobs or 1) > 1:
+        print("Planning does not encode; ignoring --jobs and planning projects one after another.")
+        args.jobs = 1
+
+    # Job and encoder thread counts measured to be fastest on this host (python calibrate.py), unless given
+    calibration = calibrate.load_recommendation() if args.jobs is None and args.threads_total is None and not args.plan else None
+    if calibration:
+        print(f"Using this host's calibration: {calibration['jobs']} job(s) with {calibration['threads']} encoder thread(s) each, "
+              f"x264 preset {calibration['preset']} ({calibration['output_seconds_per_hour']:.0f} output seconds per hour measured).")
+        args.jobs = calibration['jobs']
+    args.jobs = args.jobs or 1
+    args.threads_total = args.threads_total or os.cpu_count() or 1
+
+    missing_filters = ffmpeg_capabilities.missing_filters()
+    if missing_filters:
+        print(f"Warning: This ffmpeg lacks filter(s) the renders use: {', '.join(missing_filters)}. Renders needing them will fail.")
+
+    if args.jobs <= 1 and sys.stdout.isatty():
+        set_progress_callback(_show_progress) # Workers log to buffers, so only sequential runs show live progress
+
+    if args.watch:
+        if not os.path.isdir(args.input_path) and not args.input_path.lower().endswith(".json"):
+            print("Error: Input path must be a .json file or a directory containing .json files.")
+            return
+        if args.all_voiceovers or args.max_videos:
+            print("Note: --watch renders every pending voiceover; --all-voiceovers and --max-videos do not apply.")
+        encoder_threads = max(1, args.threads_total // args.jobs) if args.jobs > 1 else None
+        if calibration:
+            encoder_threads = calibration['threads']
+        watch_projects(args.input_path, jobs=args.jobs, encoder_threads=encoder_threads, parallel_chunks=args.chunks,
+                       seed=args.seed, log_dir=args.log_dir, poll_seconds=args.poll_seconds,
+                       settle_seconds=args.settle_seconds, metrics_jsonl=args.metrics_jsonl, metrics_prom=args.metrics_prom)
+        return
+
     project_files_to_process = []
-    if os.path.isdir(args.input_path):
+    if args.replay:
+        if os.path.isdir(args.input_path):
+            project_files_to_process = sorted(os.path.join(args.input_path, name) for name in os.listdir(args.input_path)
+                                              if name.lower().endswith(".plan.json"))
+        else:
+            project_files_to_process.append(args.input_path)
+        if not project_files_to_process:
+            print(f"No .plan.json files found in directory: {args.input_path}")
+            return
+        print(f"Found {len(project_files_to_process)} plan(s) to replay.")
+    elif os.path.isdir(args.input_path):
         print(f"Scanning directory for project JSON files: {args.input_path}")
-        for filename in os.listdir(args.input_path):
-            if filename.lower().endswith(".json"):
-                project_files_to_process.append(os.path.join(args.input_path, filename))
+        project_files_to_process = _list_project_configs(args.input_path)
         if not project_files_to_process:
             print(f"No .json configuration files found in directory: {args.input_path}")
             return
@@ -235,11 +861,103 @@ def main():
         print("Error: Input path must be a .json file or a directory containing .json files.")
         return
 
-    for project_config_file in project_files_to_process:
-        process_project(project_config_file)
-        print("-" * 50)
+    batch_start_time = time.time()
+    results = []
+    metrics_records = []
+    all_voiceovers = args.all_voiceovers or bool(args.max_videos)
+    if args.jobs <= 1:
+        encoder_threads = calibration['threads'] if calibration else None
+        for project_config_file in project_files_to_process:
+            metrics.reset()
+            project_start_time = time.time()
+            if args.replay:
+                project_results = [replay_plan(project_config_file, encoder_threads=encoder_threads, parallel_chunks=args.chunks)]
+            else:
+                project_results = process_project(project_config_file, encoder_threads=encoder_threads, all_voiceovers=all_voiceovers,
+                                                  max_videos=args.max_videos, parallel_chunks=args.chunks, plan_only=args.plan,
+                                                  seed=args.seed, preview=preview)
+            results.extend(project_results)
+            metrics_records.append(_metrics_record(project_config_file, project_results, time.time() - project_start_time))
+            probe_cache.save() # Persist new probe results even if a later project crashes the run
+            asset_index.save()
+            print("-" * 50)
+    else:
+        # Work units: whole projects, or in batch mode one unit per pending voiceover, so a single
+        # project with many voiceovers also spreads across the pool.
+        # Each unit: (label, log name, func, args)
+        work_units = []
+        for project_config_file in project_files_to_process:
+            config_basename = _get_file_basename(project_config_file)
+            if args.replay:
+                work_units.append((project_config_file, config_basename, replay_plan, (project_config_file,)))
+                continue
+            if not all_voiceovers:
+                work_units.append((project_config_file, config_basename, functools.partial(process_project, seed=args.seed, preview=preview),
+                                   (project_config_file,)))
+                continue
+            print(f"\nPlanning project: {project_config_file}")
+            metrics.reset()
+            planning_start_time = time.time()
+            config, project_name = _load_project(project_config_file, args.seed)
+            voiceovers = _voiceovers_to_render(config, True, args.max_videos, include_up_to_date=preview is not None) if config else []
+            metrics_records.append(_metrics_record(f"{project_config_file} (planning)", [], time.time() - planning_start_time))
+            if config is None:
+                results.append(_project_result(project_name, 'failed'))
+                continue
+            if not voiceovers:
+                print(f"No pending voiceovers for {project_name}. Skipping project.")
+                results.append(_project_result(project_name, 'skipped'))
+                continue
+            print(f"Queued {len(voiceovers)} pending voiceover(s) for {project_name}.")
+            for vo_path in voiceovers:
+                work_units.append((f"{project_config_file} / {os.path.basename(vo_path)}",
+                                   f"{config_basename}_{_get_file_basename(vo_path)}",
+                                   functools.partial(_render_voiceover_in_worker, preview=preview), (config, project_name, vo_path)))
+        probe_cache.save() # Let workers start from the probes and listings gathered while planning
+        asset_index.save()
+
+        jobs = max(1, min(args.jobs, len(work_units)))
+        # x264 stops scaling long before a large box runs out of cores, so split the thread
+        # budget across workers instead of giving every encode all cores.
+        encoder_threads = max(1, args.threads_total // jobs)
+        if calibration and jobs == calibration['jobs']:
+            encoder_threads = calibration['threads']
+        if calibration and len(work_units) == 1:
+            # The calibrated pool pays off for several renders only: a single one runs in this process,
+            # with all encoder threads and the live progress line
+            label, _, func, func_args = work_units[0]
+            print(f"A single render: running it in this process with {encoder_threads} encoder thread(s).")
+            if sys.stdout.isatty():
+                set_progress_callback(_show_progress)
+            metrics.reset()
+            unit_start_time = time.time()
+            unit_results = func(*func_args, encoder_threads=encoder_threads, parallel_chunks=args.chunks)
+            unit_results = [unit_results] if isinstance(unit_results, dict) else unit_results
+            results.extend(unit_results)
+            metrics_records.append(_metrics_record(label, unit_results, time.time() - unit_start_time))
+            probe_cache.save()
+            asset_index.save()
+        elif work_units:
+            print(f"Rendering {len(work_units)} job(s) with {jobs} workers, {encoder_threads} encoder thread(s) each.")
+            with ProcessPoolExecutor(max_workers=jobs) as executor:
+                futures = {executor.submit(_run_in_worker, log_name, args.log_dir, label, func, *func_args,
+                                           encoder_threads=encoder_threads, parallel_chunks=args.chunks): label
+                           for label, log_name, func, func_args in work_units}
+                for future in as_completed(futures):
+                    unit_results, metrics_record = _collect_worker_result(future, futures[future])
+                    results.extend(unit_results)
+                    metrics_records.append(metrics_record)
 
     print("\nBatch processing finished.")
+    batch_wall_seconds = time.time() - batch_start_time
+    _print_batch_summary(results, batch_wall_seconds)
+    if args.metrics_jsonl:
+        for record in metrics_records:
+            metrics.append_jsonl(args.metrics_jsonl, record)
+        print(f"Stage metrics appended to {args.metrics_jsonl}")
+    if args.metrics_prom:
+        metrics.write_prometheus(args.metrics_prom, metrics_records, batch_wall_seconds)
+        print(f"Prometheus metrics written to {args.metrics_prom}")
 
 if __name__ == "__main__":
     # This ensures that main() is called when the script is executed directly.
@@ -0,0 +1,322 @@
+import argparse
+import contextlib
+import hashlib
+import json
+import multiprocessing
+import os
+import platform
+import random
+import subprocess
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import ffmpeg
+
+# Reproducible end-to-end benchmarks: each scenario describes a synthetic asset library (generated once
+# with ffmpeg's lavfi sources and kept under <out>/assets) and the project settings to render it with.
+# Every scenario runs batch_processor in a fresh process with a fixed seed and records per-stage timings
+# (see metrics.py), throughput in output seconds per wall second and peak memory. Results are saved as
+# JSON under <out>/results so runs on different commits or machines can be compared with --compare.
+DEFAULT_OUT_DIR = "benchmarks"
+DEFAULT_SEED = 1234
+
+# Video groups: count, resolution, fps, duration range [min, max] in seconds and encoder.
+# Images: count, resolution and format. Voiceovers: count and duration. 'config' overrides project settings.
+SCENARIOS = {
+    "many_small_clips": {
+        "description": "80 short 720p clips: per-clip overhead (probing, opening inputs, concat) dominates.",
+        "videos": [{"count": 80, "resolution": [1280, 720], "fps": 30, "duration": [1.0, 2.0], "codec": "libx264"}],
+        "images": [],
+        "voiceovers": {"count": 2, "duration": 60},
+        "config": {"image_percentage": 0},
+    },
+    "long_timeline": {
+        "description": "A few long 1080p clips filling a 5 minute voiceover: raw encode throughput.",
+        "videos": [{"count": 12, "resolution": [1920, 1080], "fps": 30, "duration": [20.0, 40.0], "codec": "libx264"}],
+        "images": [],
+        "voiceovers": {"count": 1, "duration": 300},
+        "config": {"image_percentage": 0},
+    },
+    "image_heavy": {
+        "description": "Mostly stills (large JPEGs and PNGs) with a few clips: image rasterizing and the segment cache.",
+        "videos": [{"count": 6, "resolution": [1280, 720], "fps": 30, "duration": [3.0, 6.0], "codec": "libx264"}],
+        "images": [{"count": 40, "resolution": [1080, 1350], "format": "jpg"},
+                   {"count": 10, "resolution": [2000, 2000], "format": "png"}],
+        "voiceovers": {"count": 2, "duration": 60},
+        "config": {"image_percentage": 70},
+    },
+    "mixed_resolution": {
+        "description": "Clips in several resolutions, frame rates and codecs: scaling, padding and fps conversion.",
+        "videos": [{"count": 8, "resolution": [1920, 1080], "fps": 30, "duration": [3.0, 8.0], "codec": "libx264"},
+                   {"count": 8, "resolution": [720, 1280], "fps": 25, "duration": [3.0, 8.0], "codec": "libx265"},
+                   {"count": 8, "resolution": [640, 480], "fps": 24, "duration": [3.0, 8.0], "codec": "mpeg4"}],
+        "images": [{"count": 8, "resolution": [1200, 800], "format": "jpg"}],
+        "voiceovers": {"count": 2, "duration": 60},
+        "config": {"image_percentage": 20},
+    },
+    "copy_ready": {
+        "description": "Clips already in the output format and no watermark: the stream-copy fast path.",
+        "videos": [{"count": 20, "resolution": [1080, 1920], "fps": 30, "duration": [3.0, 8.0], "codec": "libx264"}],
+        "images": [],
+        "voiceovers": {"count": 2, "duration": 60},
+        "config": {"image_percentage": 0, "ENABLE_WATERMARK": False},
+    },
+    "repeated_segments": {
+        "description": "Few clips and stills reused across a long timeline with BGM: repeated segments must keep "
+                       "the soundtrack as long as the video (renders fail if it is cut short).",
+        "videos": [{"count": 3, "resolution": [1280, 720], "fps": 30, "duration": [2.0, 4.0], "codec": "libx264"}],
+        "images": [{"count": 2, "resolution": [1200, 800], "format": "jpg"}],
+        "voiceovers": {"count": 1, "duration": 40},
+        "config": {"image_percentage": 50},
+    },
+}
+BGM_DURATION_SECONDS = 120
+
+
+def _spec_hash(spec):
+    return hashlib.sha256(json.dumps(spec, sort_keys=True).encode('utf8')).hexdigest()[:12]
+
+
+def _scaled_spec(spec, scale):
+    """Scales clip/image counts and voiceover durations (for quick runs); other parameters stay as they are."""
+    scaled = json.loads(json.dumps(spec))
+    for group in scaled["videos"] + scaled["images"]:
+        group["count"] = max(1, int(round(group["count"] * scale)))
+    scaled["voiceovers"]["duration"] = max(5, int(round(scaled["voiceovers"]["duration"] * scale)))
+    return scaled
+
+
+def _run_generate(node, path):
+    node.run(overwrite_output=True, capture_stdout=True, capture_stderr=True)
+    return path
+
+
+def _generate_video(path, width, height, fps, duration, codec, index):
+    """A testsrc2 clip with a sine tone (AAC stereo, 48 kHz); index shifts pattern and pitch so every file differs."""
+    video = ffmpeg.input(f"testsrc2=size={width}x{height}:rate={fps}", format='lavfi', ss=index * 0.37, t=duration)
+    audio = ffmpeg.input(f"sine=frequency={200 + index * 7}:sample_rate=48000", format='lavfi', t=duration)
+    params = {'vcodec': codec, 'pix_fmt': 'yuv420p', 'g': int(fps * 2), 'acodec': 'aac', 'ac': 2, 'ar': 48000}
+    if codec in ('libx264', 'libx265'):
+        params['preset'] = 'veryfast'
+    return _run_generate(ffmpeg.output(video, audio, path, **params), path)
+
+
+def _generate_image(path, width, height, index):
+    still = ffmpeg.input(f"testsrc2=size={width}x{height}:rate=1", format='lavfi', ss=index)
+    return _run_generate(ffmpeg.output(still, path, vframes=1), path)
+
+
+def _generate_tone(path, duration, frequency):
+    tone = ffmpeg.input(f"sine=frequency={frequency}:sample_rate=48000", format='lavfi', t=duration)
+    return _run_generate(ffmpeg.output(tone, path, ac=2), path)
+
+
+def generate_library(spec, library_dir, seed):
+    """
+    Generates the asset library described by spec into library_dir (videos/, images/, voiceovers/, audio/,
+    branding/), unless a complete library for the same spec is already there. Clip durations are drawn
+    from each group's range with random.Random(seed), so the same spec and seed give the same library.
+    """
+    marker_path = os.path.join(library_dir, ".complete")
+    if os.path.exists(marker_path):
+        return library_dir
+    for folder in ("videos", "images", "voiceovers", "audio", "branding"):
+        os.makedirs(os.path.join(library_dir, folder), exist_ok=True)
+    rng = random.Random(seed)
+    index = 0
+    for group in spec["videos"]:
+        width, height = group["resolution"]
+        for _ in range(group["count"]):
+            duration = round(rng.uniform(*group["duration"]), 2)
+            path = os.path.join(library_dir, "videos", f"clip_{index:04d}_{width}x{height}_{group['codec']}.mp4")
+            _generate_video(path, width, height, group["fps"], duration, group["codec"], index)
+            index += 1
+    for group in spec["images"]:
+        width, height = group["resolution"]
+        for _ in range(group["count"]):
+            _generate_image(os.path.join(library_dir, "images", f"image_{index:04d}_{width}x{height}.{group['format']}"),
+                            width, height, index)
+            index += 1
+    for vo_index in range(spec["voiceovers"]["count"]):
+        _generate_tone(os.path.join(library_dir, "voiceovers", f"vo_{vo_index:02d}.wav"),
+                       spec["voiceovers"]["duration"], 300 + vo_index * 40)
+    _generate_tone(os.path.join(library_dir, "audio", "bgm.wav"), BGM_DURATION_SECONDS, 110)
+    _generate_image(os.path.join(library_dir, "branding", "logo.png"), 200, 200, 0)
+    with open(marker_path, 'w') as f:
+        json.dump(spec, f, indent=2)
+    return library_dir
+
+
+def _scenario_config(name, spec, library_dir, run_dir, cache_dir, seed):
+    """Project config rendering every voiceover of the library into run_dir/output, selecting assets with seed."""
+    config = {
+        "project_name": f"benchmark {name}",
+        "assets_base_path": library_dir,
+        "output_folder": os.path.join(run_dir, "output"),
+        "cache_folder": cache_dir,
+        "main_clips_videos_folders": ["videos"],
+        "main_clips_images_folder": ["images"],
+        "voiceover_folder": "voiceovers",
+        "bgm_folder": "audio",
+        "watermark_path": "branding/logo.png",
+        "ENABLE_BGM": True,
+        "ENABLE_WATERMARK": True,
+        "unique_assets": False, # Scenarios with few clips must still fill every voiceover
+        "seed": seed,
+    }
+    config.update(spec.get("config", {}))
+    return config
+
+
+def _run_batch(config_path, log_path):
+    """
+    Benchmark process entry point: renders every voiceover of the project, logging to log_path.
+    Returns (results, stage totals, wall seconds, peak RSS, largest child's peak RSS).
+    """
+    import batch_processor # Imported here so the parent process does not pay for (or share) its module state
+    import metrics
+    import probe_cache
+    import asset_index
+    metrics.reset()
+    start_time = time.time()
+    with open(log_path, 'w') as log, contextlib.redirect_stdout(log), contextlib.redirect_stderr(log):
+        results = batch_processor.process_project(config_path, all_voiceovers=True)
+        probe_cache.save()
+        asset_index.save()
+    wall_seconds = time.time() - start_time
+    peak_rss = child_peak_rss = None
+    if metrics.resource is not None:
+        peak_rss = metrics.resource.getrusage(metrics.resource.RUSAGE_SELF).ru_maxrss * 1024
+        child_peak_rss = metrics.resource.getrusage(metrics.resource.RUSAGE_CHILDREN).ru_maxrss * 1024
+    return results, metrics.snapshot(), wall_seconds, peak_rss, child_peak_rss
+
+
+def run_scenario(name, spec, out_dir, run_dir, seed, warm=False):
+    """Generates (or reuses) the scenario's library, renders it in a fresh process and returns its result record."""
+    library_dir = os.path.abspath(os.path.join(out_dir, "assets", f"{name}-{_spec_hash(spec)}"))
+    print(f"[{name}] Preparing asset library {library_dir} ...")
+    generate_library(spec, library_dir, seed)
+
+    scenario_dir = os.path.abspath(os.path.join(run_dir, name))
+    os.makedirs(scenario_dir, exist_ok=True)
+    # Cold runs start with empty probe/segment caches; warm runs share them across runs of the same library
+    cache_dir = os.path.join(library_dir, ".cache") if warm else os.path.join(scenario_dir, "cache")
+    config_path = os.path.join(scenario_dir, "config.json")
+    with open(config_path, 'w') as f:
+        json.dump(_scenario_config(name, spec, library_dir, scenario_dir, cache_dir, seed), f, indent=2)
+
+    print(f"[{name}] Rendering ...")
+    # A fresh process per scenario, so peak RSS and module-level caches are the scenario's own
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+        results, stages, wall_seconds, peak_rss, child_peak_rss = executor.submit(
+            _run_batch, config_path, os.path.join(scenario_dir, "batch.log")).result()
+
+    statuses = {}
+    for result in results:
+        statuses[result['status']] = statuses.get(result['status'], 0) + 1
+    output_seconds = sum(r['stats']['duration'] for r in results if r['status'] == 'success' and r.get('stats'))
+    record = {
+        'scenario': name,
+        'description': spec.get('description', ''),
+        'spec': spec,
+        'renders': statuses,
+        'wall_seconds': round(wall_seconds, 3),
+        'output_seconds': round(output_seconds, 3),
+        'throughput': round(output_seconds / wall_seconds, 3) if wall_seconds else None,
+        'peak_rss_mb': round(peak_rss / 2**20, 1) if peak_rss else None,
+        'child_peak_rss_mb': round(child_peak_rss / 2**20, 1) if child_peak_rss else None,
+        'stages': stages,
+        'routes': sorted({r['stats']['route'] for r in results if r.get('stats')}),
+    }
+    print(f"[{name}] {record['output_seconds']:.1f}s of video in {record['wall_seconds']:.1f}s "
+          f"({record['throughput']}x realtime), peak RSS {record['peak_rss_mb']} MB (ffmpeg {record['child_peak_rss_mb']} MB), "
+          f"renders {statuses}")
+    return record
+
+
+def _machine_info():
+    try:
+        ffmpeg_version = subprocess.run(["ffmpeg", "-version"], capture_output=True, text=True).stdout.splitlines()[0]
+    except (OSError, IndexError):
+        ffmpeg_version = None
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {'platform': platform.platform(), 'python': platform.python_version(), 'cpu_count': os.cpu_count(),
+            'ffmpeg': ffmpeg_version, 'commit': commit}
+
+
+def compare(old_path, new_path):
+    """Prints throughput, wall time and per-stage wall time of two saved runs side by side."""
+    with open(old_path, 'r') as f:
+        old = {r['scenario']: r for r in json.load(f)['scenarios']}
+    with open(new_path, 'r') as f:
+        new = {r['scenario']: r for r in json.load(f)['scenarios']}
+
+    def change(a, b):
+        return f"{(b - a) / a * 100:+.1f}%" if a and b is not None else "n/a"
+
+    for name in [n for n in new if n in old]:
+        before, after = old[name], new[name]
+        if before['spec'] != after['spec']:
+            print(f"{name}: scenario spec differs between the runs, skipping.")
+            continue
+        print(f"{name}:")
+        print(f"  throughput   {before['throughput']:>9}x -> {after['throughput']:>9}x  {change(before['throughput'], after['throughput'])}")
+        print(f"  wall         {before['wall_seconds']:>9}s -> {after['wall_seconds']:>9}s  {change(before['wall_seconds'], after['wall_seconds'])}")
+        print(f"  peak RSS     {before['peak_rss_mb']:>8}MB -> {after['peak_rss_mb']:>8}MB")
+        for stage_name in sorted(set(before['stages']) | set(after['stages'])):
+            a = before['stages'].get(stage_name, {}).get('wall_seconds', 0.0)
+            b = after['stages'].get(stage_name, {}).get('wall_seconds', 0.0)
+            print(f"  {stage_name:<12} {a:>9}s -> {b:>9}s  {change(a, b)}")
+    for name in sorted(set(old) ^ set(new)):
+        print(f"{name}: only in {'the old' if name in old else 'the new'} run.")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark batch_processor on synthetic asset libraries.")
+    parser.add_argument("--scenarios", help=f"Comma-separated scenarios to run (default: all of {', '.join(SCENARIOS)}).")
+    parser.add_argument("--scale", type=float, default=1.0,
+                        help="Scale clip/image counts and voiceover durations, e.g. 0.1 for a quick run (default: 1.0).")
+    parser.add_argument("--seed", type=int, default=DEFAULT_SEED, help=f"Seed for libraries and selection (default: {DEFAULT_SEED}).")
+    parser.add_argument("--out", default=DEFAULT_OUT_DIR, help=f"Folder for libraries, runs and results (default: {DEFAULT_OUT_DIR}).")
+    parser.add_argument("--warm", action="store_true", help="Reuse probe/segment caches from earlier runs instead of starting cold.")
+    parser.add_argument("--list", action="store_true", help="List the scenarios and exit.")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="Compare two saved result files and exit.")
+    args = parser.parse_args()
+
+    if args.list:
+        for name, spec in SCENARIOS.items():
+            print(f"{name}: {spec['description']}")
+        return
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    names = args.scenarios.split(",") if args.scenarios else list(SCENARIOS)
+    unknown = [n for n in names if n not in SCENARIOS]
+    if unknown:
+        print(f"Error: Unknown scenario(s): {', '.join(unknown)}. Use --list to see the available ones.")
+        return
+
+    stamp = time.strftime("%Y%m%d-%H%M%S")
+    run_dir = os.path.join(args.out, "runs", stamp)
+    records = []
+    for name in names:
+        try:
+            records.append(run_scenario(name, _scaled_spec(SCENARIOS[name], args.scale), args.out, run_dir, args.seed, args.warm))
+        except ffmpeg.Error as e:
+            print(f"[{name}] Could not generate the asset library: {e.stderr.decode('utf8', errors='replace')[-2000:]}")
+
+    results_path = os.path.join(args.out, "results", f"{stamp}.json")
+    os.makedirs(os.path.dirname(results_path), exist_ok=True)
+    with open(results_path, 'w') as f:
+        json.dump({'created': stamp, 'seed': args.seed, 'scale': args.scale, 'warm': args.warm,
+                   'machine': _machine_info(), 'scenarios': records}, f, indent=2)
+    print(f"\nResults saved to {results_path} (compare runs with: python benchmark.py --compare OLD.json NEW.json)")
+
+
+if __name__ == "__main__":
+    main()
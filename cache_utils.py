@@ -0,0 +1,40 @@
+import json
+import os
+
+# Small helpers shared by the on-disk caches (probe cache, asset index, ...).
+
+
+def read_json_file(path, default=None):
+    """Reads a JSON file, returning default if it is missing or unreadable."""
+    if not path or not os.path.exists(path):
+        return default
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Warning: Could not read {path} ({e}). Ignoring it.")
+        return default
+
+
+def write_json_atomic(path, data, compact=True):
+    """
+    Writes data as JSON via a temporary file and os.replace, so readers (including
+    other worker processes) never see a half-written file. Returns True on success.
+    """
+    folder = os.path.dirname(path)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, 'w') as f:
+            if compact:
+                json.dump(data, f, separators=(',', ':'))
+            else:
+                json.dump(data, f, indent=2)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print(f"Warning: Could not write {path}: {e}")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return False
+    return True
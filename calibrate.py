@@ -0,0 +1,263 @@
+import argparse
+import itertools
+import os
+import socket
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import ffmpeg
+
+from benchmark import generate_library, _spec_hash
+from cache_utils import read_json_file, write_json_atomic
+from config_loader import load_config, DEFAULT_CONFIG
+from ffmpeg_capabilities import extra_args_to_params
+
+# Per-host encoder tuning: renders a short synthetic timeline through combine_videos_and_watermark for every
+# combination of x264 preset, encoder threads and concurrent jobs, and records which combination gives the
+# most output seconds per wall hour without letting files grow more than --max-size-increase over the
+# reference preset (the "none" profile's). The recommendation is kept next to the ffmpeg capabilities under
+# the user's cache folder, keyed by host name; batch_processor applies it when --jobs/--threads-total are not
+# given and to libx264 renders whose config does not set "final.preset" (see batch_processor.main).
+CALIBRATION_VERSION = 1
+CALIBRATION_FILE = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache"),
+                                "batch_video_editing", "calibration.json")
+DEFAULT_WORK_DIR = "calibration"
+DEFAULT_PRESETS = ["ultrafast", "superfast", "veryfast", "faster", "fast", "medium"]
+DEFAULT_SECONDS = 8
+DEFAULT_MAX_SIZE_INCREASE = 0.15
+# Combinations asking for more than this many encoder threads per core in total are not tried
+MAX_OVERSUBSCRIPTION = 2
+CALIBRATION_SEED = 1234
+
+_recommendation = None # Loaded recommendation of this host (False once looked up and absent)
+
+
+def _powers_of_two_up_to(limit):
+    values = [1]
+    while values[-1] * 2 <= limit:
+        values.append(values[-1] * 2)
+    if values[-1] != limit:
+        values.append(limit)
+    return values
+
+
+def _library_spec(seconds):
+    """A few 720p24 clips and one still filling seconds, so renders always take the re-encode route."""
+    return {
+        "videos": [{"count": 4, "resolution": [1280, 720], "fps": 24, "duration": [seconds / 5, seconds / 5], "codec": "libx264"}],
+        "images": [{"count": 1, "resolution": [1200, 800], "format": "jpg"}],
+        "voiceovers": {"count": 1, "duration": seconds},
+    }
+
+
+def _timeline(library_dir, seconds):
+    """The engine arguments of the calibration render: every clip of the library, the still, logo and tone."""
+    videos = sorted(os.listdir(os.path.join(library_dir, "videos")))
+    images = sorted(os.listdir(os.path.join(library_dir, "images")))
+    specs = [{'path': os.path.join(library_dir, "videos", name), 'type': 'video'} for name in videos]
+    specs += [{'path': os.path.join(library_dir, "images", name), 'type': 'image', 'duration': seconds / 5} for name in images]
+    return {
+        'video_files_and_image_specs': specs,
+        'watermark_path': os.path.join(library_dir, "branding", "logo.png"),
+        'watermark_params': DEFAULT_CONFIG["watermark_params"],
+        'voiceover_path': os.path.join(library_dir, "voiceovers", "vo_00.wav"),
+    }
+
+
+def _base_output_params(final_config):
+    """Output settings of the "none" (libx264) profile of a loaded config's "final" section, without preset and threads."""
+    profile = final_config.get("_encoding_profiles", {}).get("none", {})
+    params = {
+        'resolution': final_config.get('resolution'),
+        'fps': final_config.get('fps'),
+        'vcodec': profile.get('vcodec', 'libx264'),
+        'acodec': final_config.get('acodec', 'aac'),
+        'audio_bitrate': final_config.get('abr'),
+        'crf': profile.get('crf'),
+        'tune': profile.get('tune'),
+    }
+    params = {k: v for k, v in params.items() if v is not None}
+    params.update(extra_args_to_params(profile.get('extra_args')))
+    return params
+
+
+def _render_once(render_args, output_path, output_params):
+    """Calibration worker: one render, returning the output's size in bytes."""
+    import contextlib
+    import io
+    from video_engine import combine_videos_and_watermark
+    with contextlib.redirect_stdout(io.StringIO()):
+        ok = combine_videos_and_watermark(output_path=output_path, output_params=output_params, **render_args)
+    if not ok or not os.path.exists(output_path):
+        raise RuntimeError(f"calibration render failed: {output_path}")
+    size = os.path.getsize(output_path)
+    os.remove(output_path)
+    return size
+
+
+def measure(render_args, seconds, output_params, preset, threads, jobs, render_dir):
+    """
+    Renders the timeline jobs times concurrently (separate processes) with preset and threads encoder
+    threads each. Returns {'preset', 'threads', 'jobs', 'wall_seconds', 'output_seconds_per_hour', 'size_bytes'}.
+    """
+    params = dict(output_params, preset=preset, threads=threads)
+    outputs = [os.path.join(render_dir, f"{preset}_t{threads}_j{jobs}_{index}.mp4") for index in range(jobs)]
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        executor.submit(int).result() # Start the workers before the clock does
+        start_time = time.perf_counter()
+        sizes = list(executor.map(_render_once, [render_args] * jobs, outputs, [params] * jobs))
+        wall_seconds = time.perf_counter() - start_time
+    return {'preset': preset, 'threads': threads, 'jobs': jobs, 'wall_seconds': round(wall_seconds, 3),
+            'output_seconds_per_hour': round(jobs * seconds / wall_seconds * 3600, 1),
+            'size_bytes': int(sum(sizes) / len(sizes))}
+
+
+def recommend(grid, reference_preset, max_size_increase):
+    """
+    Picks the grid entry with the highest throughput among presets whose average file size stays within
+    max_size_increase of reference_preset's (all presets if the reference was not measured).
+    Returns (entry, size of its preset relative to the reference or None).
+    """
+    sizes = {}
+    for entry in grid:
+        sizes.setdefault(entry['preset'], []).append(entry['size_bytes'])
+    average = {preset: sum(values) / len(values) for preset, values in sizes.items()}
+    reference = average.get(reference_preset)
+    eligible = [entry for entry in grid if not reference or average[entry['preset']] <= reference * (1 + max_size_increase)]
+    best = max(eligible or grid, key=lambda entry: entry['output_seconds_per_hour'])
+    return best, round(average[best['preset']] / reference, 3) if reference else None
+
+
+def save_recommendation(recommendation):
+    data = read_json_file(CALIBRATION_FILE, {}) or {}
+    if data.get('version') != CALIBRATION_VERSION:
+        data = {'version': CALIBRATION_VERSION, 'hosts': {}}
+    data['hosts'][socket.gethostname()] = recommendation
+    write_json_atomic(CALIBRATION_FILE, data, compact=False)
+
+
+def load_recommendation():
+    """
+    Returns this host's calibration ({'preset', 'threads', 'jobs', ...}), or None if the host was never
+    calibrated or its CPU count changed since (e.g. a container with a different CPU limit).
+    """
+    global _recommendation
+    if _recommendation is None:
+        data = read_json_file(CALIBRATION_FILE, {}) or {}
+        entry = data.get('hosts', {}).get(socket.gethostname()) if data.get('version') == CALIBRATION_VERSION else None
+        if entry and entry.get('cpu_count') != os.cpu_count():
+            print(f"Warning: The calibration of this host was made with {entry.get('cpu_count')} CPUs, "
+                  f"now there are {os.cpu_count()}. Ignoring it (run calibrate.py again).")
+            entry = None
+        _recommendation = entry or False
+    return _recommendation or None
+
+
+def calibrated_preset(final_config, vcodec):
+    """
+    The calibrated x264 preset a render with a config's "final" section and vcodec gets on this host, or None
+    if the profile's preset applies (not libx264, "preset" set in "final", use_calibration off, not calibrated).
+    """
+    if vcodec != 'libx264' or 'preset' in final_config or not final_config.get("use_calibration", True):
+        return None
+    recommendation = load_recommendation()
+    return recommendation['preset'] if recommendation else None
+
+
+def _int_list(text):
+    return [int(value) for value in text.split(",") if value.strip()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Find the x264 preset, encoder threads and concurrent jobs with the "
+                                                 "best throughput on this machine, for batch_processor to apply.")
+    parser.add_argument("--config", help="Project config whose output settings (resolution, fps, crf) to calibrate with "
+                                         "(default: the built-in defaults).")
+    parser.add_argument("--presets", default=",".join(DEFAULT_PRESETS),
+                        help=f"Comma-separated x264 presets to try (default: {','.join(DEFAULT_PRESETS)}).")
+    parser.add_argument("--threads", help="Comma-separated encoder thread counts to try (default: powers of two up to the CPU count).")
+    parser.add_argument("--jobs", help="Comma-separated concurrent job counts to try (default: powers of two up to the CPU count).")
+    parser.add_argument("--seconds", type=float, default=DEFAULT_SECONDS,
+                        help=f"Length of the synthetic timeline in seconds (default: {DEFAULT_SECONDS}).")
+    parser.add_argument("--max-size-increase", type=float, default=DEFAULT_MAX_SIZE_INCREASE,
+                        help="Largest average file size increase over the reference preset a recommendation may cost, "
+                             f"as a fraction (default: {DEFAULT_MAX_SIZE_INCREASE}).")
+    parser.add_argument("--work-dir", default=DEFAULT_WORK_DIR,
+                        help=f"Folder for the synthetic library and temporary renders (default: {DEFAULT_WORK_DIR}).")
+    parser.add_argument("--dry-run", action="store_true", help="Measure and print the recommendation without saving it.")
+    parser.add_argument("--show", action="store_true", help="Print this host's saved calibration and exit.")
+    args = parser.parse_args()
+
+    if args.show:
+        recommendation = load_recommendation()
+        print(f"{CALIBRATION_FILE}:")
+        summary = {k: v for k, v in recommendation.items() if k != 'grid'} if recommendation else 'not calibrated'
+        print(f"  {socket.gethostname()}: {summary}")
+        return
+
+    final_config = load_config(args.config)["final"] if args.config else DEFAULT_CONFIG["final"]
+    output_params = _base_output_params(final_config)
+    reference_preset = final_config.get("_encoding_profiles", {}).get("none", {}).get("preset", "medium")
+    cpu_count = os.cpu_count() or 1
+    presets = [p.strip() for p in args.presets.split(",") if p.strip()]
+    if reference_preset not in presets:
+        presets.append(reference_preset) # File sizes are judged against it
+    threads_values = _int_list(args.threads) if args.threads else _powers_of_two_up_to(cpu_count)
+    jobs_values = _int_list(args.jobs) if args.jobs else _powers_of_two_up_to(cpu_count)
+    combinations = [(threads, jobs) for threads, jobs in itertools.product(threads_values, jobs_values)
+                    if threads * jobs <= cpu_count * MAX_OVERSUBSCRIPTION]
+    if not combinations:
+        print("Error: No thread/job combination fits this machine; pass smaller --threads/--jobs values.")
+        return
+
+    spec = _library_spec(args.seconds)
+    library_dir = os.path.abspath(os.path.join(args.work_dir, "assets", f"calibration-{_spec_hash(spec)}"))
+    render_dir = os.path.abspath(os.path.join(args.work_dir, "renders"))
+    os.makedirs(render_dir, exist_ok=True)
+    print(f"Preparing synthetic library {library_dir} ...")
+    try:
+        generate_library(spec, library_dir, CALIBRATION_SEED)
+    except ffmpeg.Error as e:
+        print(f"Error: Could not generate the calibration library: {e.stderr.decode('utf8', errors='replace')[-2000:]}")
+        return
+    render_args = _timeline(library_dir, args.seconds)
+
+    total = len(presets) * len(combinations)
+    print(f"Calibrating {len(presets)} preset(s) x {len(combinations)} thread/job combination(s) at "
+          f"{output_params.get('resolution')} {output_params.get('fps')} fps, crf {output_params.get('crf')} "
+          f"({total} measurement(s) of a {args.seconds:g}s timeline).")
+    grid = []
+    for preset in presets:
+        for threads, jobs in combinations:
+            try:
+                entry = measure(render_args, args.seconds, output_params, preset, threads, jobs, render_dir)
+            except Exception as e:
+                print(f"  {preset:<10} threads {threads:>3} jobs {jobs:>3}: failed ({e})")
+                continue
+            grid.append(entry)
+            print(f"  [{len(grid)}/{total}] {preset:<10} threads {threads:>3} jobs {jobs:>3}: "
+                  f"{entry['output_seconds_per_hour']:>9.0f} output s/h, {entry['size_bytes'] / 1024:.0f} KiB")
+    if not grid:
+        print("Error: Every calibration render failed.")
+        return
+
+    best, size_ratio = recommend(grid, reference_preset, args.max_size_increase)
+    recommendation = {
+        'preset': best['preset'], 'threads': best['threads'], 'jobs': best['jobs'],
+        'output_seconds_per_hour': best['output_seconds_per_hour'],
+        'size_vs_reference': size_ratio, 'reference_preset': reference_preset,
+        'max_size_increase': args.max_size_increase,
+        'resolution': output_params.get('resolution'), 'fps': output_params.get('fps'), 'crf': output_params.get('crf'),
+        'cpu_count': cpu_count, 'created': time.strftime("%Y-%m-%d %H:%M:%S"), 'grid': grid,
+    }
+    print(f"\nRecommendation: preset {best['preset']}, {best['threads']} encoder thread(s), {best['jobs']} job(s): "
+          f"{best['output_seconds_per_hour']:.0f} output seconds per hour"
+          + (f", files {size_ratio:.2f}x the size of '{reference_preset}'" if size_ratio else ""))
+    if args.dry_run:
+        return
+    save_recommendation(recommendation)
+    print(f"Saved to {CALIBRATION_FILE} for host {socket.gethostname()}; batch_processor applies it automatically.")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,4 @@
+import copy
 import json
 import os
 
@@ -28,16 +29,35 @@ DEFAULT_CONFIG = {
             "high": {"crf": 18, "vquality": 22, "cq": 21}
         },
         "quality": "balanced", # Default quality preset
-        "selected_encoder_profile": "none" # Default encoder profile (CPU-based libx264)
+        "selected_encoder_profile": "none", # Default encoder profile (CPU-based libx264)
+        # Profiles tried in order when the selected one's encoder is missing or has no hardware, e.g. ["qsv", "none"]
+        "encoder_profile_fallbacks": ["none"],
+        # Use the x264 preset measured to be fastest on this host (python calibrate.py) instead of the profile's;
+        # setting "preset" here directly also takes precedence over the calibration
+        "use_calibration": True,
+        # Extra outputs encoded from the same decode pass, e.g. {"name": "preview", "resolution": [1280, 720], "crf": 28}.
+        # Each is written as <voiceover>.<name>.mp4; keys besides "name" override the output settings above.
+        "renditions": []
     },
     "assets_base_path": "./assets", # Base path for all assets
     "output_folder": "./output",
+    "cache_folder": ".cache", # Probe cache and other derived data (relative to assets_base_path); null disables persistence
+    # Cache of clips pre-transcoded to the output format, so repeated renders only concat them.
+    # Intros/outros are cached when enabled; image stills if "images" is true; main video clips if "main_clips" is true.
+    "segment_cache": {"enabled": True, "max_mb": 10240, "images": True, "main_clips": False},
+    # --preview renders: resolution and fps as fractions of "final", ultrafast x264 at crf, optionally cut after
+    # max_seconds, reading clips from low-resolution proxies kept in the segment cache (when it is enabled)
+    "preview": {"scale": 0.33, "fps_scale": 0.5, "crf": 30, "max_seconds": None, "proxies": True},
+    # Split a full re-encode into this many chunks encoded concurrently and stitched by stream copy.
+    # Helps long timelines on machines where one x264 process cannot use all cores; 1 disables it.
+    "parallel_chunks": 1,
 
     # Feature flags (can be overridden by project config)
     "ENABLE_INTRO": False,
     "ENABLE_OUTRO": False,
     "ENABLE_WATERMARK": True,
     "ENABLE_BGM": True,
+    "ENABLE_VOICEOVER_AUDIO": True, # Mix the voiceover into the soundtrack
     # ... other flags from requirments_and_rules.txt can be added here ...
     "ENABLE_SUBTITLE": True, # For emotion detection later
     "ENABLE_GIFS": False, # Tied to emotion detection
@@ -55,7 +75,18 @@ DEFAULT_CONFIG = {
     # Settings from requirments_and_rules.txt
     "image_percentage": 40,
     "unique_assets": True,
-    "video_mode": "full_clip", # "full_clip", "start_random", "split_subclips", "tiny_subclips
+    # Seed for selecting the voiceover, clips, intro/outro and BGM. Each voiceover gets its own RNG seeded from
+    # (seed, voiceover name), so re-runs pick the same timeline; None uses the project name. Override with --seed.
+    "seed": None,
+    "video_mode": "full_clip", # "full_clip", "start_random", "split_subclips", "tiny_subclips"
+    # Subclip lengths for the video modes: start_random takes one subclip_duration piece from a random start,
+    # split_subclips / tiny_subclips take up to max_subclips_per_clip pieces of subclip_duration / tiny_subclip_duration
+    "subclip_duration": 4.0,
+    "tiny_subclip_duration": 1.0,
+    "max_subclips_per_clip": 3,
+    # Index the keyframes of clips used as subclips (kept in the probe cache), so subclips can be
+    # stream-copied from a keyframe and nearby subclips of one file can share a decoder
+    "keyframe_index": True,
 
     "watermark_params": {
         "position_x": "W-w-10", # FFmpeg expression for top-right
@@ -63,6 +94,10 @@ DEFAULT_CONFIG = {
         "width": "W*0.08" # FFmpeg expression for width (e.g., 8% of main video width)
     },
     "bgm_volume": 0.25,
+    "voiceover_volume": 1.1, # From requirments_and_rules.txt
+    # EBU R128 targets voiceovers and BGM are normalized to before bgm_volume / voiceover_volume apply.
+    # Each file is measured once (stored in the probe cache); renders apply a single linear loudnorm pass.
+    "loudnorm": {"enabled": True, "I": -16.0, "TP": -1.5, "LRA": 11.0},
 
     # Placeholder for subtitle-related settings for emotion detection (if used)
     "subtitle_folder_to_use_for_sentiment_analysis": "subtitles/full_sentence_subtitle",
@@ -108,8 +143,9 @@ def load_config(project_config_path):
     with open(project_config_path, 'r') as f:
         project_specific_config = json.load(f)
 
-    # Start with a copy of the default config
-    config = DEFAULT_CONFIG.copy()
+    # Start with a deep copy of the default config, so overrides of nested dicts (e.g. "final")
+    # do not leak into DEFAULT_CONFIG and from there into the next project loaded by this process
+    config = copy.deepcopy(DEFAULT_CONFIG)
 
     # Deep update with project-specific settings
     config = deep_update(config, project_specific_config)
@@ -132,7 +168,8 @@ def load_config(project_config_path):
 
     path_keys_folders = [
         "intro_folder", "outro_folder", "bgm_folder", "voiceover_folder",
-        "subtitle_folder_to_use_for_sentiment_analysis", "gif_folder", "sticker_folder_path"
+        "subtitle_folder_to_use_for_sentiment_analysis", "gif_folder", "sticker_folder_path",
+        "cache_folder"
     ]
     path_keys_files = ["watermark_path"]
     path_keys_list_folders = ["main_clips_videos_folders", "main_clips_images_folder"]
@@ -155,16 +192,12 @@ def load_config(project_config_path):
 
     # Apply quality preset to encoding profile
     # This allows 'quality' to be a simple string like 'fast', 'balanced', 'high'
-    # which then sets CRF/CQ values in the chosen encoder profile.
+    # which then sets CRF/CQ values in the encoder profiles (every profile, as a fallback may be used
+    # instead of the selected one, see ffmpeg_capabilities.resolve_encoder_profile).
     quality_setting = config["final"].get("quality", "balanced")
-    encoder_profile_name = config["final"].get("selected_encoder_profile", "none")
-
-    if encoder_profile_name in config["final"]["_encoding_profiles"] and \
-       quality_setting in config["final"]["_quality_presets"]:
-
-        quality_values = config["final"]["_quality_presets"][quality_setting]
-        profile_to_update = config["final"]["_encoding_profiles"][encoder_profile_name]
+    quality_values = config["final"]["_quality_presets"].get(quality_setting, {})
 
+    for profile_to_update in config["final"]["_encoding_profiles"].values():
         if "crf" in profile_to_update and "crf" in quality_values: # For libx264
             profile_to_update["crf"] = quality_values["crf"]
         if "cq" in profile_to_update and "cq" in quality_values: # For nvenc
@@ -0,0 +1,163 @@
+import os
+import re
+import shlex
+import shutil
+import socket
+import subprocess
+
+from cache_utils import read_json_file, write_json_atomic
+
+# What the installed ffmpeg can do: its encoder and filter lists (ffmpeg -encoders / -filters) and, for
+# hardware encoders, whether a one-frame test encode works on this machine (a static ffmpeg lists NVENC
+# and QSV even where there is no GPU). Probed once per ffmpeg binary and host, and kept in a small JSON file
+# under the user's cache folder so later runs start without spawning ffmpeg at all.
+CAPABILITIES_VERSION = 1
+CAPABILITIES_FILE = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache"),
+                                 "batch_video_editing", "ffmpeg_capabilities.json")
+# Encoders that need no hardware: being listed by ffmpeg is enough
+SOFTWARE_ENCODERS = ['libx264', 'libx265', 'libvpx-vp9', 'libaom-av1', 'libsvtav1', 'mpeg4']
+# Filters the render graphs are built from; a missing one is reported when the batch starts
+REQUIRED_FILTERS = ['scale', 'pad', 'setsar', 'fps', 'overlay', 'concat', 'split', 'asplit', 'trim', 'atrim',
+                    'setpts', 'asetpts', 'apad', 'amix', 'alimiter', 'aformat', 'anullsrc', 'loudnorm']
+TEST_ENCODE_TIMEOUT_SECONDS = 30
+# Profile settings whose ffmpeg option has a different name
+PROFILE_OPTION_NAMES = {'vquality': 'global_quality'}
+
+_capabilities = None # {'signature', 'encoders', 'filters', 'working_encoders'} of the ffmpeg in use
+
+
+def _ffmpeg_signature():
+    """Identifies the ffmpeg binary on PATH and the host (hardware encoders depend on both), or None if there is none."""
+    ffmpeg_path = shutil.which('ffmpeg')
+    if not ffmpeg_path:
+        return None
+    st = os.stat(ffmpeg_path)
+    return f"{os.path.realpath(ffmpeg_path)}|{st.st_size}|{st.st_mtime_ns}|{socket.gethostname()}"
+
+
+def _list_ffmpeg(option, pattern):
+    """Runs ffmpeg -hide_banner <option> and returns the names its listing lines match (pattern group 1)."""
+    try:
+        output = subprocess.run(['ffmpeg', '-hide_banner', option], capture_output=True, text=True, check=True).stdout
+    except (OSError, subprocess.CalledProcessError) as e:
+        print(f"Warning: Could not list ffmpeg {option.lstrip('-')}: {e}")
+        return []
+    return [match.group(1) for match in (re.match(pattern, line) for line in output.splitlines()) if match]
+
+
+def _save():
+    data = read_json_file(CAPABILITIES_FILE, {}) or {}
+    if data.get('version') != CAPABILITIES_VERSION:
+        data = {'version': CAPABILITIES_VERSION, 'ffmpeg': {}}
+    data['ffmpeg'][_capabilities['signature']] = {k: v for k, v in _capabilities.items() if k != 'signature'}
+    write_json_atomic(CAPABILITIES_FILE, data, compact=False)
+
+
+def get_capabilities():
+    """
+    Returns {'encoders': [...], 'filters': [...], 'working_encoders': {name: bool}} for the ffmpeg on PATH,
+    from memory, the capabilities file, or by listing ffmpeg's encoders and filters (once).
+    """
+    global _capabilities
+    signature = _ffmpeg_signature()
+    if _capabilities is not None and _capabilities['signature'] == signature:
+        return _capabilities
+    if signature is None:
+        _capabilities = {'signature': None, 'encoders': [], 'filters': [], 'working_encoders': {}}
+        return _capabilities
+    data = read_json_file(CAPABILITIES_FILE, {}) or {}
+    cached = data.get('ffmpeg', {}).get(signature) if data.get('version') == CAPABILITIES_VERSION else None
+    if cached:
+        _capabilities = dict(cached, signature=signature)
+        return _capabilities
+    _capabilities = {
+        'signature': signature,
+        # " V....D libx264   libx264 H.264 ..." after the legend
+        'encoders': _list_ffmpeg('-encoders', r'^\s*[VAS][A-Z.]{5}\s+([^\s=]\S*)\s'),
+        # " ..C amix   N->A   Audio mixing."
+        'filters': _list_ffmpeg('-filters', r'^\s*[TSC.]{3}\s+(\S+)\s+\S+->\S+'),
+        'working_encoders': {},
+    }
+    _save()
+    return _capabilities
+
+
+def has_encoder(name):
+    return name in get_capabilities()['encoders']
+
+
+def has_filter(name):
+    return name in get_capabilities()['filters']
+
+
+def missing_filters(names=None):
+    """Returns the filters of names (default REQUIRED_FILTERS) that the installed ffmpeg lacks."""
+    available = get_capabilities()['filters']
+    return [name for name in (names or REQUIRED_FILTERS) if name not in available]
+
+
+def encoder_works(name):
+    """
+    True if ffmpeg has encoder name and, for hardware encoders, a short test encode with it succeeds.
+    The test result is cached with the capabilities.
+    """
+    if not has_encoder(name):
+        return False
+    if name in SOFTWARE_ENCODERS:
+        return True
+    capabilities = get_capabilities()
+    if name not in capabilities['working_encoders']:
+        args = ['ffmpeg', '-hide_banner', '-nostdin', '-f', 'lavfi', '-i', 'color=c=black:s=256x256:r=30',
+                '-frames:v', '3', '-c:v', name, '-f', 'null', '-']
+        try:
+            works = subprocess.run(args, capture_output=True, timeout=TEST_ENCODE_TIMEOUT_SECONDS).returncode == 0
+        except (OSError, subprocess.TimeoutExpired):
+            works = False
+        capabilities['working_encoders'][name] = works
+        _save()
+    return capabilities['working_encoders'][name]
+
+
+def resolve_encoder_profile(final_config):
+    """
+    Picks the encoding profile to use from a config's "final" section: selected_encoder_profile, then each
+    of encoder_profile_fallbacks in order, taking the first whose vcodec works on this machine (see
+    encoder_works). Prints why skipped profiles were passed over. Returns the profile name, or None.
+    """
+    profiles = final_config.get("_encoding_profiles", {})
+    candidates = [final_config.get("selected_encoder_profile", "none")] + list(final_config.get("encoder_profile_fallbacks") or [])
+    for name in dict.fromkeys(candidates): # Keep the order, drop repeats
+        vcodec = profiles.get(name, {}).get("vcodec")
+        if not vcodec:
+            print(f"Warning: Encoder profile '{name}' is not defined. Skipping it.")
+        elif not encoder_works(vcodec):
+            print(f"Warning: Encoder profile '{name}' ({vcodec}) is not available with this ffmpeg/hardware. Skipping it.")
+        else:
+            return name
+    return None
+
+
+def extra_args_to_params(extra_args):
+    """
+    Translates a profile's "extra_args" (ffmpeg command line fragments such as "-rc:v vbr", "-movflags +faststart"
+    or "-x264-params keyint=60:min-keyint=60") into ffmpeg-python output kwargs ({'rc:v': 'vbr', ...}).
+    An option followed by another option (or nothing) is a flag and maps to None, which ffmpeg-python
+    emits without a value. Tokens that are not options are reported and ignored.
+    """
+    params = {}
+    tokens = [token for arg in extra_args or [] for token in shlex.split(arg)]
+    index = 0
+    while index < len(tokens):
+        token = tokens[index]
+        if not token.startswith('-') or len(token) < 2:
+            print(f"Warning: Ignoring stray extra_arg value '{token}'.")
+            index += 1
+            continue
+        value = None
+        # Values may themselves start with '-' when they are numbers, e.g. "-qp_offset -2"
+        if index + 1 < len(tokens) and (not tokens[index + 1].startswith('-') or re.match(r'^-\d', tokens[index + 1])):
+            value = tokens[index + 1]
+            index += 1
+        params[token[1:]] = value
+        index += 1
+    return params
@@ -0,0 +1,147 @@
+import contextlib
+import json
+import os
+import threading
+import time
+
+try:
+    import resource # Not available on Windows: CPU time falls back to time.process_time, RSS is not reported
+except ImportError:
+    resource = None
+
+# Stage instrumentation: code wraps its phases in `with metrics.stage("encode"):` and the batch processor
+# collects the totals per project (reset / snapshot) and writes them as JSON lines or a Prometheus textfile.
+# Stages nest; each stage is charged only its exclusive time, e.g. probes run while selecting clips count
+# as "probe", not "select". Stages are recorded on the main thread only: work running in helper threads
+# (chunks encoded in parallel) is counted in the stage of the main thread waiting for it.
+# Stages used: config, scan (asset folder listings), probe (ffprobe, keyframe index, loudness, content hashes),
+# select, graph (building and planning the render), encode and mux (stream copies).
+PROMETHEUS_PREFIX = "batch_video"
+
+_stages = {} # name -> totals
+_stack = []  # Open stages of the main thread
+
+
+def _usage():
+    """(own CPU seconds, CPU seconds of finished child processes, own peak RSS bytes, largest child's peak RSS bytes)"""
+    if resource is None:
+        return time.process_time(), 0.0, None, None
+    own, children = resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN)
+    return (own.ru_utime + own.ru_stime, children.ru_utime + children.ru_stime,
+            own.ru_maxrss * 1024, children.ru_maxrss * 1024) # ru_maxrss is in KiB on Linux
+
+
+def reset():
+    """Starts a new collection (e.g. for the next project)."""
+    _stages.clear()
+    del _stack[:]
+
+
+@contextlib.contextmanager
+def stage(name):
+    """
+    Records the wall time, CPU time (of this process and of the ffmpeg/ffprobe processes it ran) and
+    peak RSS of the enclosed block under name. Peak RSS values are high-water marks of the process
+    (and of its largest child) at the end of the stage, as the OS only reports those.
+    """
+    if threading.current_thread() is not threading.main_thread():
+        yield
+        return
+    cpu, child_cpu, _, _ = _usage()
+    frame = {'wall': time.perf_counter(), 'cpu': cpu, 'child_cpu': child_cpu,
+             'nested_wall': 0.0, 'nested_cpu': 0.0, 'nested_child_cpu': 0.0}
+    _stack.append(frame)
+    try:
+        yield
+    finally:
+        _stack.pop()
+        cpu, child_cpu, peak_rss, child_peak_rss = _usage()
+        wall = time.perf_counter() - frame['wall']
+        cpu, child_cpu = cpu - frame['cpu'], child_cpu - frame['child_cpu']
+        if _stack: # The parent's exclusive time excludes this stage
+            parent = _stack[-1]
+            parent['nested_wall'] += wall
+            parent['nested_cpu'] += cpu
+            parent['nested_child_cpu'] += child_cpu
+        totals = _stages.setdefault(name, {'count': 0, 'wall_seconds': 0.0, 'cpu_seconds': 0.0, 'child_cpu_seconds': 0.0,
+                                           'peak_rss_bytes': None, 'child_peak_rss_bytes': None})
+        totals['count'] += 1
+        totals['wall_seconds'] += wall - frame['nested_wall']
+        totals['cpu_seconds'] += cpu - frame['nested_cpu']
+        totals['child_cpu_seconds'] += child_cpu - frame['nested_child_cpu']
+        if peak_rss is not None:
+            totals['peak_rss_bytes'] = max(totals['peak_rss_bytes'] or 0, peak_rss)
+            totals['child_peak_rss_bytes'] = max(totals['child_peak_rss_bytes'] or 0, child_peak_rss)
+
+
+def snapshot():
+    """Returns the stage totals collected since the last reset, {stage: {count, wall_seconds, cpu_seconds, ...}}."""
+    return {name: {k: round(v, 4) if isinstance(v, float) else v for k, v in totals.items()}
+            for name, totals in _stages.items()}
+
+
+def append_jsonl(path, record):
+    """Appends record as one JSON line to path."""
+    folder = os.path.dirname(path)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+    with open(path, 'a') as f:
+        f.write(json.dumps(record, default=str) + "\n")
+
+
+def _label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def write_prometheus(path, records, batch_wall_seconds):
+    """
+    Writes the stage totals of records (dicts with 'project', 'stages' and 'results') as a Prometheus
+    textfile (for node_exporter's textfile collector): per project and stage wall/CPU seconds and peak RSS,
+    render counts by status and the batch wall time. The file is replaced atomically.
+    """
+    metrics = [
+        ('stage_wall_seconds', 'Wall time spent in a stage (exclusive of nested stages).', 'wall_seconds'),
+        ('stage_cpu_seconds', 'CPU time of the batch process in a stage.', 'cpu_seconds'),
+        ('stage_child_cpu_seconds', 'CPU time of ffmpeg/ffprobe processes finished in a stage.', 'child_cpu_seconds'),
+        ('stage_peak_rss_bytes', 'Peak RSS of the batch process at the end of a stage.', 'peak_rss_bytes'),
+        ('stage_child_peak_rss_bytes', 'Peak RSS of the largest ffmpeg/ffprobe process at the end of a stage.', 'child_peak_rss_bytes'),
+    ]
+    lines = []
+    for metric, help_text, key in metrics:
+        lines.append(f"# HELP {PROMETHEUS_PREFIX}_{metric} {help_text}")
+        lines.append(f"# TYPE {PROMETHEUS_PREFIX}_{metric} gauge")
+        values = {}
+        for record in records:
+            for stage_name, totals in record.get('stages', {}).items():
+                if totals.get(key) is None:
+                    continue
+                labels = (record['project'], stage_name)
+                if key.startswith(('peak', 'child_peak')):
+                    values[labels] = max(values.get(labels, 0), totals[key])
+                else:
+                    values[labels] = values.get(labels, 0) + totals[key]
+        for (project, stage_name), value in sorted(values.items()):
+            lines.append(f'{PROMETHEUS_PREFIX}_{metric}{{project="{_label_value(project)}",stage="{stage_name}"}} {value}')
+
+    statuses = {}
+    for record in records:
+        for result in record.get('results', []):
+            statuses[result['status']] = statuses.get(result['status'], 0) + 1
+    lines.append(f"# HELP {PROMETHEUS_PREFIX}_renders Renders in the last batch by status.")
+    lines.append(f"# TYPE {PROMETHEUS_PREFIX}_renders gauge")
+    for status, count in sorted(statuses.items()):
+        lines.append(f'{PROMETHEUS_PREFIX}_renders{{status="{status}"}} {count}')
+    lines.append(f"# HELP {PROMETHEUS_PREFIX}_batch_wall_seconds Wall time of the last batch.")
+    lines.append(f"# TYPE {PROMETHEUS_PREFIX}_batch_wall_seconds gauge")
+    lines.append(f"{PROMETHEUS_PREFIX}_batch_wall_seconds {round(batch_wall_seconds, 3)}")
+    lines.append(f"# HELP {PROMETHEUS_PREFIX}_batch_finished_timestamp_seconds When the last batch finished.")
+    lines.append(f"# TYPE {PROMETHEUS_PREFIX}_batch_finished_timestamp_seconds gauge")
+    lines.append(f"{PROMETHEUS_PREFIX}_batch_finished_timestamp_seconds {round(time.time(), 3)}")
+
+    folder = os.path.dirname(path)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as f:
+        f.write("\n".join(lines) + "\n")
+    os.replace(tmp_path, path)
@@ -0,0 +1,358 @@
+import argparse
+import atexit
+import bisect
+import hashlib
+import json
+import os
+
+import ffmpeg
+
+import metrics
+from cache_utils import read_json_file, write_json_atomic
+
+# Persistent cache of ffprobe results, keyed by absolute path plus file size and mtime.
+# Only a compact summary of each probe is kept (duration, stream layout, codecs,
+# resolution, fps, audio presence) so the index stays small even for large libraries.
+PROBE_CACHE_VERSION = 3
+PROBE_CACHE_FILENAME = "probe_cache.json"
+
+_cache_file = None  # Path of the on-disk index, None keeps the cache in memory only
+_entries = {}       # abs path -> {'size': int, 'mtime_ns': int, 'summary': dict or None, optional 'sha256', 'keyframes', 'loudness'}
+_dirty_paths = set()
+_removed_paths = set()
+_atexit_registered = False
+_keyframe_index_enabled = True
+
+
+def configure(cache_file):
+    """
+    Points the probe cache at an on-disk index file and loads it.
+    Passing None keeps probe results in memory for the lifetime of the process only.
+    """
+    global _cache_file, _atexit_registered
+    if cache_file and _cache_file and os.path.abspath(cache_file) == _cache_file:
+        return  # Already configured, keep the warm in-memory entries
+    if _cache_file and _dirty_paths:
+        save()
+    _cache_file = os.path.abspath(cache_file) if cache_file else None
+    _entries.clear()
+    _dirty_paths.clear()
+    _removed_paths.clear()
+    if _cache_file:
+        _entries.update(_read_index(_cache_file))
+        if not _atexit_registered:
+            atexit.register(save)
+            _atexit_registered = True
+
+
+def set_keyframe_index_enabled(enabled):
+    """Turns the keyframe index on or off (get_keyframes returns None while it is off)."""
+    global _keyframe_index_enabled
+    _keyframe_index_enabled = bool(enabled)
+
+
+def cache_file_for_config(config):
+    """Returns the probe cache index path for a loaded project config, or None if caching is disabled."""
+    cache_folder = config.get("cache_folder")
+    if not cache_folder:
+        return None
+    return os.path.join(cache_folder, PROBE_CACHE_FILENAME)
+
+
+def _read_index(cache_file):
+    data = read_json_file(cache_file, default={})
+    if data.get("version") != PROBE_CACHE_VERSION:
+        return {}
+    return data.get("entries", {})
+
+
+def save():
+    """
+    Writes new and changed entries to the on-disk index.
+    Entries written by other processes in the meantime are merged in, not overwritten.
+    """
+    if not _cache_file or not (_dirty_paths or _removed_paths):
+        return
+    merged = _read_index(_cache_file)
+    for path in _removed_paths:
+        merged.pop(path, None)
+    for path in _dirty_paths:
+        if path in _entries:
+            merged[path] = _entries[path]
+
+    if not write_json_atomic(_cache_file, {"version": PROBE_CACHE_VERSION, "entries": merged}):
+        return
+    _dirty_paths.clear()
+    _removed_paths.clear()
+
+
+def _file_signature(file_path):
+    st = os.stat(file_path)
+    return st.st_size, st.st_mtime_ns
+
+
+def parse_frame_rate(rate):
+    """Parses an ffprobe frame rate such as '30000/1001' into a float (0.0 if unknown)."""
+    try:
+        num, _, den = str(rate).partition('/')
+        den = float(den) if den else 1.0
+        return round(float(num) / den, 3) if den else 0.0
+    except ValueError:
+        return 0.0
+
+
+def _summarize_probe(probe_data):
+    """Reduces a full ffprobe result to the fields the engine and asset manager rely on."""
+    fmt = probe_data.get('format', {})
+    streams = []
+    for s in probe_data.get('streams', []):
+        stream = {'index': s.get('index'), 'codec_type': s.get('codec_type'), 'codec_name': s.get('codec_name')}
+        if s.get('codec_type') == 'video':
+            stream.update({
+                'profile': s.get('profile'), 'width': s.get('width'), 'height': s.get('height'), 'pix_fmt': s.get('pix_fmt'),
+                'r_frame_rate': s.get('r_frame_rate'), 'avg_frame_rate': s.get('avg_frame_rate'),
+                'sample_aspect_ratio': s.get('sample_aspect_ratio'), 'has_b_frames': s.get('has_b_frames'),
+            })
+        elif s.get('codec_type') == 'audio':
+            stream.update({
+                'sample_rate': s.get('sample_rate'), 'channels': s.get('channels'),
+                'channel_layout': s.get('channel_layout'),
+            })
+        if 'duration' in s:
+            stream['duration'] = s['duration']
+        streams.append(stream)
+
+    video = next((s for s in streams if s['codec_type'] == 'video'), None)
+    audio = next((s for s in streams if s['codec_type'] == 'audio'), None)
+    try:
+        duration = float(fmt.get('duration', 0) or 0)
+    except ValueError:
+        duration = 0.0
+
+    return {
+        'duration': duration,
+        'format_name': fmt.get('format_name'),
+        'streams': streams,
+        'has_video': video is not None,
+        'has_audio': audio is not None,
+        'video_codec': video.get('codec_name') if video else None,
+        'width': video.get('width') if video else None,
+        'height': video.get('height') if video else None,
+        'fps': parse_frame_rate(video.get('r_frame_rate')) if video else 0.0,
+        'audio_codec': audio.get('codec_name') if audio else None,
+    }
+
+
+def _summary_to_probe(summary):
+    """Rebuilds an ffprobe-shaped dict from a cached summary so existing callers keep working."""
+    return {
+        'format': {'duration': str(summary['duration']), 'format_name': summary.get('format_name')},
+        'streams': [dict(s) for s in summary.get('streams', [])],
+    }
+
+
+def _lookup(file_path):
+    """Returns the cache record for file_path, probing it if missing or stale. None if the file is gone."""
+    abs_path = os.path.abspath(file_path)
+    try:
+        size, mtime_ns = _file_signature(abs_path)
+    except OSError:
+        return None
+
+    record = _entries.get(abs_path)
+    if record and record.get('size') == size and record.get('mtime_ns') == mtime_ns:
+        return record
+
+    summary = None
+    try:
+        with metrics.stage("probe"):
+            summary = _summarize_probe(ffmpeg.probe(abs_path))
+    except ffmpeg.Error as e:
+        print(f"Error probing video {file_path}: {e.stderr.decode('utf8', errors='replace')}")
+    # Failed probes are cached too, so a corrupt file is not re-probed on every run until it changes.
+    record = {'size': size, 'mtime_ns': mtime_ns, 'summary': summary}
+    _entries[abs_path] = record
+    _dirty_paths.add(abs_path)
+    _removed_paths.discard(abs_path)
+    return record
+
+
+def get_media_summary(file_path):
+    """
+    Returns the cached probe summary of a media file:
+    {'duration', 'streams', 'has_video', 'has_audio', 'video_codec', 'width', 'height', 'fps', 'audio_codec', ...}
+    Returns None if the file does not exist or cannot be probed.
+    """
+    record = _lookup(file_path)
+    return record['summary'] if record else None
+
+
+def get_content_hash(file_path):
+    """
+    Returns the SHA-256 of a file's contents, computed once per file version and kept in the cache
+    next to its probe summary. Returns None if the file does not exist.
+    """
+    record = _lookup(file_path)
+    if not record:
+        return None
+    if not record.get('sha256'):
+        digest = hashlib.sha256()
+        with metrics.stage("probe"), open(file_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(chunk)
+        record['sha256'] = digest.hexdigest()
+        _dirty_paths.add(os.path.abspath(file_path))
+    return record['sha256']
+
+
+def _probe_keyframes(file_path):
+    """Lists the keyframe timestamps of the first video stream by reading its packet headers (no decoding)."""
+    packets = ffmpeg.probe(file_path, select_streams='v:0', show_entries='packet=pts_time,flags').get('packets', [])
+    return sorted(round(float(p['pts_time']), 6) for p in packets
+                  if 'K' in p.get('flags', '') and p.get('pts_time') not in (None, 'N/A'))
+
+
+def get_keyframes(file_path):
+    """
+    Returns the sorted keyframe times (seconds) of a video file's first video stream, indexed once per
+    file version and kept in the cache next to its probe summary.
+    Returns None if the keyframe index is disabled, the file has no video or it cannot be read.
+    """
+    if not _keyframe_index_enabled:
+        return None
+    record = _lookup(file_path)
+    if not record or not record['summary'] or not record['summary']['has_video']:
+        return None
+    if 'keyframes' not in record:
+        keyframes = None
+        try:
+            with metrics.stage("probe"):
+                keyframes = _probe_keyframes(os.path.abspath(file_path))
+        except ffmpeg.Error as e:
+            print(f"Error indexing keyframes of {file_path}: {e.stderr.decode('utf8', errors='replace')}")
+        record['keyframes'] = keyframes
+        _dirty_paths.add(os.path.abspath(file_path))
+    return record['keyframes']
+
+
+def keyframe_at_or_before(file_path, time_seconds):
+    """Returns the time of the last keyframe at or before time_seconds, or None if unknown (see get_keyframes)."""
+    keyframes = get_keyframes(file_path)
+    if not keyframes:
+        return None
+    position = bisect.bisect_right(keyframes, time_seconds + 0.0005) - 1 # Tolerate rounding of the requested time
+    return keyframes[position] if position >= 0 else None
+
+
+def _measure_loudness(file_path, integrated, true_peak, loudness_range):
+    """Runs an EBU R128 loudnorm analysis pass over the file's audio and returns the measured values."""
+    analysis = ffmpeg.input(file_path).audio.filter('loudnorm', I=integrated, TP=true_peak, LRA=loudness_range, print_format='json')
+    _, stderr = ffmpeg.output(analysis, '-', format='null').run(capture_stdout=True, capture_stderr=True)
+    log = stderr.decode('utf8', errors='replace')
+    start = log.rfind('{') # The analysis is printed as the last JSON object of the log
+    measured = json.loads(log[start:log.index('}', start) + 1])
+    return {key: measured[key] for key in ('input_i', 'input_tp', 'input_lra', 'input_thresh', 'target_offset')}
+
+
+def get_loudness(file_path, integrated=-16.0, true_peak=-1.5, loudness_range=11.0):
+    """
+    Returns the EBU R128 loudness of a file's audio, as measured by the loudnorm filter for the given
+    targets: {'input_i', 'input_tp', 'input_lra', 'input_thresh', 'target_offset'} (strings, as printed).
+    Measured once per file version and target set, and kept in the cache next to the probe summary.
+    Returns None if the file has no audio or cannot be analysed.
+    """
+    record = _lookup(file_path)
+    if not record or not record['summary'] or not record['summary']['has_audio']:
+        return None
+    targets = f"I={integrated}:TP={true_peak}:LRA={loudness_range}"
+    measurements = record.setdefault('loudness', {})
+    if targets not in measurements:
+        measured = None
+        try:
+            with metrics.stage("probe"):
+                measured = _measure_loudness(os.path.abspath(file_path), integrated, true_peak, loudness_range)
+        except ffmpeg.Error as e:
+            print(f"Error measuring loudness of {file_path}: {e.stderr.decode('utf8', errors='replace')}")
+        except ValueError:
+            print(f"Error measuring loudness of {file_path}: no loudnorm analysis in the ffmpeg output.")
+        measurements[targets] = measured
+        _dirty_paths.add(os.path.abspath(file_path))
+    return measurements[targets]
+
+
+def get_probe(file_path):
+    """Returns an ffprobe-shaped dict ({'format': ..., 'streams': [...]}) for file_path, or None on failure."""
+    summary = get_media_summary(file_path)
+    return _summary_to_probe(summary) if summary else None
+
+
+def invalidate(paths=None):
+    """
+    Drops cache entries so they are re-probed on next use.
+    paths may contain files or folders (every entry below a folder is dropped); None drops everything.
+    Returns the number of entries removed.
+    """
+    if paths is None:
+        targets = list(_entries)
+    else:
+        prefixes = [os.path.abspath(p) for p in paths]
+        targets = [entry_path for entry_path in _entries
+                   if any(entry_path == p or entry_path.startswith(p.rstrip(os.sep) + os.sep) for p in prefixes)]
+    for entry_path in targets:
+        del _entries[entry_path]
+        _dirty_paths.discard(entry_path)
+        _removed_paths.add(entry_path)
+    return len(targets)
+
+
+def prune():
+    """Removes entries for files that no longer exist or have changed since they were probed. Returns the count."""
+    stale = []
+    for entry_path, record in _entries.items():
+        try:
+            signature = _file_signature(entry_path)
+        except OSError:
+            stale.append(entry_path)
+            continue
+        if signature != (record.get('size'), record.get('mtime_ns')):
+            stale.append(entry_path)
+    return invalidate(stale) if stale else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Inspect and maintain the persistent ffprobe cache.")
+    parser.add_argument("command", choices=["stats", "prune", "invalidate"],
+                        help="stats: show entry counts; prune: drop entries for missing/changed files; "
+                             "invalidate: drop entries for the given paths (or all entries if none are given).")
+    parser.add_argument("paths", nargs="*", help="Files or folders to invalidate (invalidate command only).")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--config", help="Project JSON config whose cache_folder holds the probe cache.")
+    source.add_argument("--cache-file", help="Path to the probe cache index file.")
+    args = parser.parse_args()
+
+    if args.config:
+        from config_loader import load_config  # Local import: config_loader is not needed for library use
+        cache_file = cache_file_for_config(load_config(args.config))
+        if not cache_file:
+            print("Probe caching is disabled for this config (no cache_folder set).")
+            return
+    else:
+        cache_file = args.cache_file
+
+    configure(cache_file)
+    if args.command == "stats":
+        failed = sum(1 for r in _entries.values() if r.get('summary') is None)
+        indexed = sum(1 for r in _entries.values() if r.get('keyframes'))
+        print(f"Probe cache: {cache_file}")
+        print(f"Entries: {len(_entries)} ({failed} failed probes, {indexed} with a keyframe index)")
+        return
+    if args.command == "prune":
+        removed = prune()
+    else:
+        removed = invalidate(args.paths or None)
+    save()
+    print(f"Removed {removed} entr{'y' if removed == 1 else 'ies'} from {cache_file}.")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+import hashlib
+import json
+import os
+
+import calibrate
+import probe_cache
+from video_engine import RENDER_ENGINE_VERSION
+from cache_utils import read_json_file, write_json_atomic
+
+# A manifest stored next to each rendered video (output/<voiceover>.manifest.json) records what the video
+# was made from: the engine version, a hash of the output-affecting config, the content hashes of every
+# input file and the selected segments. A re-run renders a voiceover again only when the engine, config or an
+# input changed, or when the video or one of its renditions is missing or was replaced (its size/mtime no longer
+# match the manifest). The segments are kept for reference only: checking a video does not run the selection
+# again, so clips added to the asset folders later do not make finished videos stale.
+RENDER_MANIFEST_VERSION = 1
+# Config keys that do not change the rendered video (where and how fast it is rendered)
+NON_OUTPUT_CONFIG_KEYS = ["project_name", "output_folder", "cache_folder", "segment_cache", "parallel_chunks",
+                          "keyframe_index", "skip_existing_output", "preview"]
+NON_OUTPUT_FINAL_KEYS = ["threads"]
+
+
+def manifest_path_for_output(output_path):
+    return os.path.splitext(output_path)[0] + ".manifest.json"
+
+
+def _hash_json(data):
+    return hashlib.sha256(json.dumps(data, sort_keys=True, default=str).encode('utf8')).hexdigest()
+
+
+def config_fingerprint(config):
+    """
+    Hash of the loaded config without the keys that cannot change the output (NON_OUTPUT_CONFIG_KEYS), plus
+    the encode settings this host adds to it: the calibrated x264 preset (see calibrate.calibrated_preset),
+    so a new calibration that changes the preset makes the videos stale. Thread counts, like final.threads,
+    are left out.
+    """
+    subset = {k: v for k, v in config.items() if k not in NON_OUTPUT_CONFIG_KEYS}
+    final = subset.get('final', {})
+    subset['final'] = {k: v for k, v in final.items() if k not in NON_OUTPUT_FINAL_KEYS}
+    profile = final.get('_encoding_profiles', {}).get(final.get('selected_encoder_profile', 'none'), {})
+    preset = calibrate.calibrated_preset(final, profile.get('vcodec', 'libx264'))
+    if preset: # Only when calibration applies, so fingerprints of other configs stay as they were
+        subset['final']['calibrated_preset'] = preset
+    return _hash_json(subset)
+
+
+def _input_files(render_args):
+    """Every file a render reads: clips, images, watermark, BGM and voiceover."""
+    paths = []
+    for item in render_args.get('video_files_and_image_specs', []):
+        paths.append(item if isinstance(item, str) else item.get('path'))
+    paths.extend(render_args.get(key) for key in ('watermark_path', 'bgm_path', 'voiceover_path'))
+    return sorted({p for p in paths if p})
+
+
+def _output_signature(output_path):
+    try:
+        st = os.stat(output_path)
+    except OSError:
+        return None
+    return {'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+
+
+def write_manifest(output_path, render_args, config_hash):
+    """
+    Records a finished render: render_args are the combine_videos_and_watermark arguments it was made with,
+    config_hash the project's config_fingerprint. Returns the manifest path.
+    """
+    segments = render_args.get('video_files_and_image_specs', [])
+    manifest = {
+        'version': RENDER_MANIFEST_VERSION,
+        'engine_version': RENDER_ENGINE_VERSION,
+        'config_hash': config_hash,
+        'inputs': {path: probe_cache.get_content_hash(path) for path in _input_files(render_args)},
+        'segments': segments,
+        'output': _output_signature(output_path),
+        'renditions': {r['output_path']: _output_signature(r['output_path']) for r in render_args.get('renditions') or []},
+    }
+    manifest_path = manifest_path_for_output(output_path)
+    write_json_atomic(manifest_path, manifest, compact=False)
+    return manifest_path
+
+
+def check_output(output_path, config_hash):
+    """
+    Returns (up_to_date, reason). An output is up to date if its manifest matches the current engine
+    version and config, all recorded inputs still have the recorded contents and the video file (and each
+    rendition) is the one the manifest was written for. The recorded segments are not compared (the
+    selection is not repeated here). Outputs rendered before manifests existed count as up to date if
+    they can be probed (a partial or corrupt file cannot).
+    """
+    if not os.path.exists(output_path):
+        return False, "no output"
+    manifest = read_json_file(manifest_path_for_output(output_path))
+    if manifest is None:
+        if probe_cache.get_media_summary(output_path):
+            return True, "existing output without manifest"
+        return False, "output cannot be read"
+    if manifest.get('version') != RENDER_MANIFEST_VERSION:
+        return False, "manifest format changed"
+    if manifest.get('output') != _output_signature(output_path):
+        return False, "output file changed since it was rendered"
+    for path, signature in manifest.get('renditions', {}).items():
+        if _output_signature(path) != signature:
+            return False, f"rendition missing or changed: {path}"
+    if manifest.get('engine_version') != RENDER_ENGINE_VERSION:
+        return False, "render engine changed"
+    if manifest.get('config_hash') != config_hash:
+        return False, "config changed"
+    for path, content_hash in manifest.get('inputs', {}).items():
+        if probe_cache.get_content_hash(path) != content_hash:
+            return False, f"input changed: {path}"
+    return True, "up to date"
@@ -0,0 +1,146 @@
+import hashlib
+import json
+import os
+import time
+import uuid
+
+# Content-addressed cache of rendered intermediates (e.g. clips pre-transcoded to a project's
+# resolution, fps, pixel format and audio layout). Entries are files named after a hash of their
+# inputs; the cache is bounded in size and evicts the least recently used entries first.
+# Entries are never evicted while in use: those returned in this process stay pinned until release() (called
+# at the end of each render), and entries used within EVICTION_GRACE_SECONDS (lookup refreshes their mtime) are
+# kept for renders running in other processes, e.g. --jobs workers. The cache can exceed its size limit by them.
+SEGMENT_CACHE_DIRNAME = "segments"
+DEFAULT_SEGMENT_CACHE_MAX_MB = 10240
+EVICTION_GRACE_SECONDS = 2 * 3600
+
+_cache_dir = None  # None disables the cache
+_max_bytes = DEFAULT_SEGMENT_CACHE_MAX_MB * 1024 * 1024
+_pinned = set()    # Entry paths returned since the last release()
+
+
+def configure(cache_dir, max_mb=DEFAULT_SEGMENT_CACHE_MAX_MB):
+    """Points the segment cache at a folder (created on first use). Passing None disables it."""
+    global _cache_dir, _max_bytes
+    _cache_dir = os.path.abspath(cache_dir) if cache_dir else None
+    _max_bytes = int(max_mb * 1024 * 1024)
+
+
+def cache_dir_for_config(config):
+    """Returns the segment cache folder for a loaded project config, or None if the cache is disabled."""
+    settings = config.get("segment_cache") or {}
+    if not settings.get("enabled") or not config.get("cache_folder"):
+        return None
+    return os.path.join(config["cache_folder"], SEGMENT_CACHE_DIRNAME)
+
+
+def configure_for_config(config):
+    """Configures the segment cache from a loaded project config."""
+    settings = config.get("segment_cache") or {}
+    configure(cache_dir_for_config(config), settings.get("max_mb", DEFAULT_SEGMENT_CACHE_MAX_MB))
+
+
+def is_enabled():
+    return _cache_dir is not None
+
+
+def make_key(*parts):
+    """Builds a cache key from JSON-serializable parts (source hashes, output parameters, ...)."""
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode('utf8')).hexdigest()
+
+
+def _entry_path(key, ext):
+    return os.path.join(_cache_dir, key[:2], f"{key}{ext}")
+
+
+def lookup(key, ext='.mp4'):
+    """Returns the path of a cached entry (marking it as recently used and pinning it), or None on a miss."""
+    if not _cache_dir:
+        return None
+    path = _entry_path(key, ext)
+    try:
+        os.utime(path) # LRU bookkeeping: eviction removes the entries with the oldest mtime
+    except OSError:
+        return None
+    _pinned.add(path)
+    return path
+
+
+def release():
+    """Unpins the entries returned so far (see lookup), once the render using them has finished."""
+    _pinned.clear()
+
+
+def get_or_create(key, produce, ext='.mp4'):
+    """
+    Returns the path of the cached entry for key, calling produce(tmp_path) to render it on a miss.
+    The entry is written under a temporary name unique to the call and moved into place atomically, so
+    concurrent workers (and chunk threads of one process) never read a half-written file or share a temporary
+    one. If another writer committed the entry in the meantime, that entry is used (even if this produce failed).
+    The entry is pinned (see lookup); old entries are evicted afterwards if the cache is over its size limit.
+    """
+    cached_path = lookup(key, ext)
+    if cached_path:
+        return cached_path
+    path = _entry_path(key, ext)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Keep ext so ffmpeg picks the muxer; '.tmp' in the name keeps it out of _list_entries
+    tmp_path = os.path.join(os.path.dirname(path), f"{key}.tmp{uuid.uuid4().hex}{ext}")
+    try:
+        try:
+            produce(tmp_path)
+        except Exception:
+            if lookup(key, ext): # Another writer produced the entry, e.g. while ours failed on a shared resource
+                return path
+            raise
+        if not lookup(key, ext):
+            os.replace(tmp_path, path)
+            _pinned.add(path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    evict()
+    return path
+
+
+def _list_entries():
+    """Returns [(mtime, size, path)] for every committed cache entry."""
+    entries = []
+    if not _cache_dir or not os.path.isdir(_cache_dir):
+        return entries
+    for root, _, names in os.walk(_cache_dir):
+        for name in names:
+            if '.tmp' in name:
+                continue
+            path = os.path.join(root, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+    return entries
+
+
+def evict(max_bytes=None):
+    """
+    Removes least recently used entries until the cache fits in max_bytes, skipping entries in use (pinned in
+    this process or used within EVICTION_GRACE_SECONDS). Returns the number removed.
+    """
+    limit = _max_bytes if max_bytes is None else max_bytes
+    entries = _list_entries()
+    total = sum(size for _, size, _ in entries)
+    removed = 0
+    for _, size, path in sorted(entries):
+        if total <= limit:
+            break
+        if path in _pinned:
+            continue
+        try:
+            if os.stat(path).st_mtime > time.time() - EVICTION_GRACE_SECONDS: # Re-checked: used since listing
+                continue
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+        removed += 1
+    return removed
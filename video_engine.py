@@ -1,62 +1,317 @@
+import collections
 import ffmpeg
+import math
 import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+import probe_cache
+import segment_cache
+
+try:
+    import resource # Not available on Windows: only the memory bound applies to concat groups there
+except ImportError:
+    resource = None
+
+# Bump when a change alters the videos rendered from the same inputs, so outputs recorded
+# in render manifests (see render_manifest.py) with an older version are rendered again
+RENDER_ENGINE_VERSION = 3
 
 # Default config for FPS is not directly available here without importing config_loader
 # Define a fallback or expect it from output_params
 DEFAULT_FALLBACK_FPS = 30
 
+# Codec produced by each supported encoder; a source clip can only be stream-copied into
+# the output if it already uses this codec (plus matching resolution, fps, pixel format and audio).
+ENCODER_CODEC_NAMES = {
+    'libx264': 'h264', 'h264_nvenc': 'h264', 'h264_qsv': 'h264',
+    'libx265': 'hevc', 'hevc_nvenc': 'hevc', 'hevc_qsv': 'hevc',
+}
+# Profile requested when intermediates are encoded without a source clip to match
+DEFAULT_CODEC_PROFILES = {'h264': 'High', 'hevc': 'Main'}
+DEFAULT_INTERMEDIATE_SAMPLE_RATE = 48000
+# Output options that never change the encoded result and are left out of cache keys
+NON_OUTPUT_AFFECTING_OPTIONS = ['threads']
+# Output options that still apply when both streams are copied
+CONTAINER_OUTPUT_OPTIONS = ['movflags']
+AUDIO_OUTPUT_OPTIONS = ['acodec', 'audio_bitrate', 'ar', 'ac']
+SILENT_AUDIO_SOURCE = 'anullsrc=channel_layout=stereo:sample_rate={sample_rate}'
+# Peak level (linear) the mixed soundtrack is limited to: about -1 dBFS, headroom for the AAC encode
+SOUNDTRACK_PEAK_LIMIT = 0.89
+# How much shorter than the timeline a soundtrack may come out (AAC priming and frame rounding)
+SOUNDTRACK_DURATION_TOLERANCE_SECONDS = 0.1
+# Share of the timeline (by duration) that must be copied as-is or served from segment cache intermediates for the
+# stream-copy route to be taken; below it a single filter graph beats normalizing most segments one process each
+STREAM_COPY_MIN_SHARE = 0.5
+# Subclips of one file that follow each other in the timeline are cut from a single opened input
+# when the part of the file between them is at most this long (decoding a short gap is cheaper than a new seek)
+SUBCLIP_MERGE_GAP_SECONDS = 2.0
+# Looped BGM beds are rendered in multiples of this length, so videos of similar length share a cached bed
+BGM_BED_BUCKET_SECONDS = 30
+# Rough encode throughput (output pixels per second) used to estimate plans: software encoders
+# per encoder thread at their default presets, hardware encoders per session
+ENCODE_PIXEL_RATES = {
+    'libx264': 18e6, 'libx265': 5e6,
+    'h264_nvenc': 500e6, 'hevc_nvenc': 400e6, 'h264_qsv': 300e6, 'hevc_qsv': 200e6,
+}
+SOFTWARE_ENCODERS = ['libx264', 'libx265']
+
+# Long timelines are rendered in groups of segments: each group's filter graph opens one input per segment
+# (plus subclip/silence sources), so a single graph for hundreds of segments runs out of file descriptors and
+# memory. Groups are encoded to intermediates that are joined by stream copy (see _concat_group_size).
+MAX_CONCAT_GROUP_SEGMENTS = 96
+MIN_CONCAT_GROUP_SEGMENTS = 8
+# Descriptors an opened input costs (file, plus a pipe for frame-threaded decoders) and a reserve per process
+DESCRIPTORS_PER_INPUT = 4
+RESERVED_DESCRIPTORS = 64
+# Decoded frames a video input holds in flight (decoder threads, reference frames, filter queues) and its fixed overhead
+DECODED_FRAMES_PER_INPUT = 12
+INPUT_OVERHEAD_BYTES = 16 * 1024 * 1024
+# Share of the available memory the concurrently running graphs may plan to use
+CONCAT_MEMORY_FRACTION = 0.5
+
+# Encoder settings of the low-resolution proxies previews read instead of the source clips (see _preview_proxy):
+# fast to write and decode, a keyframe every second so subclips seek exactly, audio in the usual intermediate format
+PREVIEW_PROXY_PARAMS = {'vcodec': 'libx264', 'preset': 'ultrafast', 'crf': 28, 'pix_fmt': 'yuv420p',
+                        'acodec': 'aac', 'ar': DEFAULT_INTERMEDIATE_SAMPLE_RATE, 'ac': 2}
+
+# ffmpeg's stderr is kept as a ring buffer of its last lines (shown if the command fails)
+STDERR_TAIL_LINES = 200
+
+# Called with a stats dict (see _progress_stats) whenever a running ffmpeg command reports progress
+_progress_callback = None
+# Final stats of each ffmpeg command of the current render, and the summary of the last finished one
+_command_stats = []
+_last_render_stats = None
+
+# Set by plan_render() while it traces a render: ffmpeg commands are recorded here instead of being run
+_plan_trace = None
+
 def get_video_info(file_path):
-    """Gets video information using ffmpeg.probe."""
+    """
+    Gets video information using ffmpeg.probe.
+    Results come from the persistent probe cache (see probe_cache.py) and are only re-probed
+    when the file's size or mtime changes. Returns None if the file cannot be probed.
+    """
+    return probe_cache.get_probe(file_path)
+
+def _parse_resolution(res):
+    """Returns (width, height) from a [w, h] list or a 'WxH' string, or (None, None)."""
+    if isinstance(res, str):
+        width, height = map(int, res.split('x'))
+        return width, height
+    if isinstance(res, (list, tuple)) and len(res) == 2:
+        return res[0], res[1]
+    return None, None
+
+def _translate_output_params(params):
+    """Translates config-style output params ('fps', 'resolution') to ffmpeg-python output kwargs ('r', 's')."""
+    translated = dict(params)
+    # Ensure 'fps' from config is translated to 'r' for ffmpeg-python output
+    if 'fps' in translated:
+        translated['r'] = translated.pop('fps')
+    # Ensure 'resolution' from config is translated to 's' (size) for ffmpeg-python output
+    if 'resolution' in translated:
+        res_val = translated.pop('resolution')
+        if isinstance(res_val, (list, tuple)) and len(res_val) == 2:
+            translated['s'] = f"{res_val[0]}x{res_val[1]}"
+        elif isinstance(res_val, str): # Allow "WxH" string format as well
+            translated['s'] = res_val
+    return translated
+
+def set_progress_callback(callback):
+    """
+    Registers callback(stats) to receive progress of every ffmpeg command the engine runs (None turns it off).
+    It is called from the threads that run the commands, so chunks encoded in parallel report concurrently.
+    """
+    global _progress_callback
+    _progress_callback = callback
+
+def get_last_render_stats():
+    """Returns the stats of the last finished combine_videos_and_watermark call (see _summarize_render_stats), or None."""
+    return _last_render_stats
+
+def _progress_number(value):
+    """Parses a -progress value such as '25.3', '1.52x' or '2345.6kbits/s'; None for 'N/A' or a missing key."""
     try:
-        return ffmpeg.probe(file_path)
-    except ffmpeg.Error as e:
-        print(f"Error probing video {file_path}: {e.stderr.decode('utf8')}")
+        return float((value or '').rstrip('x').replace('kbits/s', ''))
+    except ValueError:
         return None
 
-def combine_videos_and_watermark(video_files_and_image_specs, output_path, watermark_path=None, watermark_params=None, output_params=None, bgm_path=None, bgm_volume=0.25):
+def _progress_stats(progress, output_path, duration, started):
     """
-    Combines multiple video files and images (as video segments) into one,
-    optionally adds a watermark, and optionally mixes in background music.
+    Builds a stats dict from the latest -progress block of a command: 'output', 'frame', 'fps', 'speed' (x realtime),
+    'bitrate' (kbit/s), 'out_time' and 'duration' (seconds of media written / expected), 'eta' (seconds, None
+    while unknown), 'elapsed' (wall seconds) and 'done'.
+    """
+    out_time = (_progress_number(progress.get('out_time_us')) or 0) / 1e6
+    speed = _progress_number(progress.get('speed'))
+    eta = None
+    if duration and speed:
+        eta = max(0.0, (duration - out_time) / speed)
+    return {
+        'output': output_path, 'frame': int(_progress_number(progress.get('frame')) or 0),
+        'fps': _progress_number(progress.get('fps')), 'speed': speed, 'bitrate': _progress_number(progress.get('bitrate')),
+        'out_time': round(out_time, 3), 'duration': duration, 'eta': eta,
+        'elapsed': round(time.time() - started, 3), 'done': progress.get('progress') == 'end',
+    }
 
-    Args:
-        video_files_and_image_specs (list): List of either:
-            - strings (paths to video files)
-            - dicts {'path': 'path/to/image.png', 'type': 'image', 'duration': 3.0}
-        output_path (str): Path for the output video file.
-        watermark_path (str, optional): Path to the watermark image.
-        watermark_params (dict, optional): Parameters for watermark.
-        output_params (dict, optional): Parameters for output video encoding.
-        bgm_path (str, optional): Path to the background music audio file.
-        bgm_volume (float, optional): Volume for the background music (0.0 to 1.0+).
+def _run_ffmpeg(node, output_path, duration=None, stage="encode"):
     """
-    if not video_files_and_image_specs:
-        raise ValueError("No video files or image specifications provided.")
+    Runs a compiled ffmpeg-python node, printing the command and ffmpeg's output if it fails.
+    Its time is recorded under the metrics stage ("encode", or "mux" for stream copies).
+    ffmpeg reports its progress through -progress on stdout, which is parsed and passed on to the progress
+    callback (duration, the expected length of the output, gives the ETA); stderr is read concurrently into a
+    ring buffer of its last STDERR_TAIL_LINES lines instead of being held in memory in full.
+    While a render is being planned (see plan_render) the command is only recorded.
+    """
+    if _plan_trace is not None:
+        _plan_trace['commands'].append({'output': output_path, 'argv': node.compile(overwrite_output=True)})
+        return
+    args = node.compile(overwrite_output=True)
+    # For debugging: print("FFmpeg Command:", " ".join(args))
+    args = args[:1] + ['-nostdin', '-nostats', '-progress', 'pipe:1'] + args[1:]
+    started = time.time()
+    stderr_tail = collections.deque(maxlen=STDERR_TAIL_LINES)
+    with metrics.stage(stage):
+        process = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        stderr_reader = threading.Thread(target=stderr_tail.extend, args=(process.stderr,), daemon=True)
+        stderr_reader.start()
 
-    input_video_streams = []
-    input_audio_streams = [] # To hold audio from videos
+        progress, stats = {}, None
+        try:
+            for line in process.stdout:
+                key, _, value = line.decode('utf8', errors='replace').strip().partition('=')
+                progress[key] = value
+                if key == 'progress': # Last key of each progress block
+                    stats = _progress_stats(progress, output_path, duration, started)
+                    if _progress_callback:
+                        _progress_callback(stats)
+            process.wait()
+        finally:
+            # A command that fails (or is interrupted) never reports progress=end: close its entry anyway
+            if _progress_callback and not (stats and stats['done']):
+                _progress_callback(dict(_progress_stats(progress, output_path, duration, started), done=True))
+        stderr_reader.join()
 
-    # Default output parameters if not provided
-    final_output_params = {
-        'vcodec': 'libx264', 'acodec': 'aac', 'pix_fmt': 'yuv420p',
-        'threads': os.cpu_count() or 1 # Ensure at least 1 thread
+    if process.returncode != 0:
+        stderr = b''.join(stderr_tail)
+        print(f"Error during ffmpeg processing for {output_path}:")
+        print("FFmpeg command:", " ".join(args))
+        print(f"FFmpeg stderr (last {STDERR_TAIL_LINES} lines):", stderr.decode('utf8', errors='replace') or "N/A")
+        raise ffmpeg.Error('ffmpeg', None, stderr)
+    stats = stats or _progress_stats(progress, output_path, duration, started)
+    stats['elapsed'] = round(time.time() - started, 3)
+    _command_stats.append(stats)
+
+def _summarize_render_stats(route, wall_seconds, timeline_duration):
+    """
+    Per-render stats record: 'route', 'wall_seconds', 'duration' (of the video), 'speed' (x realtime over the
+    whole render), 'frames' encoded and average 'fps' across all commands, and the final stats of each command.
+    """
+    frames = sum(cmd['frame'] for cmd in _command_stats)
+    return {
+        'route': route, 'wall_seconds': round(wall_seconds, 3), 'duration': round(timeline_duration, 3),
+        'speed': round(timeline_duration / wall_seconds, 2) if wall_seconds else None,
+        'frames': frames, 'fps': round(frames / wall_seconds, 1) if wall_seconds else None,
+        'commands': list(_command_stats),
     }
-    if output_params:
-        final_output_params.update(output_params)
 
-    output_width, output_height = None, None
-    if 'resolution' in final_output_params:
-        res = final_output_params.get('resolution')
-        if isinstance(res, str):
-            output_width, output_height = map(int, res.split('x'))
-        elif isinstance(res, (list, tuple)):
-            output_width, output_height = res
+def _trace_encode(seconds, width, height, fps, final_output_params):
+    """While a render is being planned, adds the time to encode seconds of video at width x height to its estimate."""
+    if _plan_trace is None or not (width and height):
+        return
+    vcodec = final_output_params.get('vcodec', 'libx264')
+    pixel_rate = ENCODE_PIXEL_RATES.get(vcodec, ENCODE_PIXEL_RATES['libx264'])
+    if vcodec in SOFTWARE_ENCODERS:
+        pixel_rate *= int(final_output_params.get('threads') or 1)
+    _plan_trace['encode_seconds'] += seconds * float(fps) * width * height / pixel_rate
 
-    output_fps_val = final_output_params.get('fps', DEFAULT_FALLBACK_FPS)
+def _cached_entry(key, produce, ext='.mp4'):
+    """
+    segment_cache.get_or_create, except that while a render is being planned a missing entry is not
+    rendered: the command that would produce it is recorded against the entry's path instead.
+    """
+    if _plan_trace is None:
+        return segment_cache.get_or_create(key, produce, ext)
+    cached_path = segment_cache.lookup(key, ext)
+    if not cached_path:
+        cached_path = segment_cache._entry_path(key, ext)
+        produce(cached_path)
+    return cached_path
+
+def _preview_proxy(video_path, max_width, max_height, fps):
+    """
+    Returns a low-resolution proxy of a video file for preview renders: scaled to fit max_width x max_height,
+    converted to fps and encoded with PREVIEW_PROXY_PARAMS. Proxies are kept in the segment cache, so each
+    source is transcoded once per preview size; returns video_path itself if the cache is disabled or the
+    file cannot be probed.
+    """
+    info = probe_cache.get_media_summary(video_path)
+    if not segment_cache.is_enabled() or not info or not info['has_video']:
+        return video_path
+
+    def produce(proxy_path):
+        source = ffmpeg.input(video_path)
+        video = ffmpeg.filter(source.video, 'scale', max_width, max_height, force_original_aspect_ratio='decrease',
+                              force_divisible_by=2)
+        video = ffmpeg.filter(video, 'fps', fps=fps)
+        streams = [video, source.audio] if info['has_audio'] else [video]
+        params = PREVIEW_PROXY_PARAMS if info['has_audio'] else {k: v for k, v in PREVIEW_PROXY_PARAMS.items()
+                                                                 if k not in AUDIO_OUTPUT_OPTIONS}
+        _run_ffmpeg(ffmpeg.output(*streams, proxy_path, g=max(1, round(fps)), **params), proxy_path, info['duration'])
 
+    key = segment_cache.make_key('proxy', probe_cache.get_content_hash(video_path), max_width, max_height, fps,
+                                 PREVIEW_PROXY_PARAMS)
+    return _cached_entry(key, produce)
 
+def _proxy_spec(item, max_width, max_height, fps):
+    """
+    Returns a timeline spec with a video's path replaced by its preview proxy (images are left as they are).
+    Whole clips keep the source's duration, as frame rate conversion can make a proxy slightly longer.
+    """
+    if isinstance(item, str):
+        item = {'type': 'video', 'path': item}
+    elif not (isinstance(item, dict) and item.get('type') == 'video'):
+        return item
+    info = probe_cache.get_media_summary(item.get('path') or '')
+    if not info:
+        return item
+    spec = dict(item, path=_preview_proxy(item['path'], max_width, max_height, fps))
+    if not spec.get('duration'):
+        spec['duration'] = info['duration']
+    return spec
+
+def _silent_audio(duration, sample_rate=44100):
+    """Returns a lavfi anullsrc stereo audio stream of the given duration."""
+    return ffmpeg.input(SILENT_AUDIO_SOURCE.format(sample_rate=sample_rate), format='lavfi', t=duration).audio
+
+def _scale_and_pad(video_stream, output_width, output_height):
+    """Scales a stream to fit the output resolution (letterboxed with black) and sets SAR to 1."""
+    if output_width and output_height:
+        scaled = ffmpeg.filter(video_stream, 'scale', output_width, output_height, force_original_aspect_ratio='decrease')
+        video_stream = ffmpeg.filter(scaled, 'pad', output_width, output_height, '-1', '-1', 'black')
+    return ffmpeg.filter(video_stream, 'setsar', '1')
+
+def _resolve_segments(video_files_and_image_specs):
+    """
+    Turns the timeline specs into segment dicts
+    {'type': 'video'|'image', 'path', 'start', 'duration', 'trimmed', 'snap', 'has_audio', 'info', 'cache'} where
+    'info' is the cached probe summary of a video (None for images) and 'cache' marks specs ({'cache': True}) whose
+    normalized form may be kept in the segment cache. A video spec's 'start' and 'duration' select a
+    subclip of the file ('trimmed'); {'snap': True} allows moving its start back to the preceding keyframe.
+    Missing files and invalid items are skipped with a warning.
+    """
+    segments = []
     for item in video_files_and_image_specs:
         video_path = None
         item_duration = 0 # Will hold probed duration or spec duration for videos
+        item_start = 0.0
 
         if isinstance(item, str): # Simple video file path string
             video_path = item
@@ -65,25 +320,14 @@ def combine_videos_and_watermark(video_files_and_image_specs, output_path, water
             video_path = item.get('path')
             # Use spec's duration as fallback if probe fails or for initial silent audio length
             item_duration = item.get('duration', 0)
+            item_start = float(item.get('start', 0) or 0)
         elif isinstance(item, dict) and item.get('type') == 'image': # Image spec as dict
             img_path = item.get('path')
-            img_duration = item.get('duration', 3.0)
             if not img_path or not os.path.exists(img_path):
                 print(f"Warning: Image file not found or path is null: {img_path}. Skipping.")
                 continue
-
-            img_node = ffmpeg.input(img_path, loop=1, framerate=output_fps_val, t=img_duration)
-
-            processed_img_video = img_node.video
-            if output_width and output_height:
-                scaled_img_video = ffmpeg.filter(img_node.video, 'scale', output_width, output_height, force_original_aspect_ratio='decrease')
-                processed_img_video = ffmpeg.filter(scaled_img_video, 'pad', output_width, output_height, '-1', '-1', 'black')
-
-            processed_img_video = ffmpeg.filter(processed_img_video, 'setsar', '1') # Ensure SAR is 1 for image-videos
-            input_video_streams.append(processed_img_video)
-            # Images always get silent audio for their duration
-            silent_audio = ffmpeg.input(f'anullsrc=channel_layout=stereo:sample_rate=44100', format='lavfi', t=img_duration).audio
-            input_audio_streams.append(silent_audio)
+            segments.append({'type': 'image', 'path': img_path, 'duration': item.get('duration', 3.0), 'start': 0.0, 'trimmed': False, 'snap': False,
+                             'has_audio': False, 'info': None, 'cache': bool(item.get('cache'))})
             continue # Processed image, move to next item in the loop
         else: # Invalid item type
             print(f"Warning: Invalid item in video_files_and_image_specs: {item}. Skipping.")
@@ -91,161 +335,863 @@ def combine_videos_and_watermark(video_files_and_image_specs, output_path, water
 
         # Common logic for video files (whether from string or dict)
         if video_path and os.path.exists(video_path):
-            video_input_node = ffmpeg.input(video_path)
-
-
-            processed_video_stream = video_input_node.video
-            if output_width and output_height:
-                # Scale and pad to fit output resolution, similar to images
-                scaled_vid = ffmpeg.filter(processed_video_stream, 'scale', output_width, output_height, force_original_aspect_ratio='decrease')
-                processed_video_stream = ffmpeg.filter(scaled_vid, 'pad', output_width, output_height, '-1', '-1', 'black')
-
-            # Apply setsar=1 to actual video inputs too for consistency before concat
-            processed_video_stream = ffmpeg.filter(processed_video_stream, 'setsar', '1')
-            input_video_streams.append(processed_video_stream)
-
             probed_duration = 0.0
-            has_audio_stream = False
-            try:
-                probe_data = ffmpeg.probe(video_path)
-                probed_duration = float(probe_data.get('format', {}).get('duration', '0'))
-                if any(s.get('codec_type') == 'audio' for s in probe_data.get('streams', [])):
-                    has_audio_stream = True
-            except ffmpeg.Error as e:
-                 print(f"Warning: Probe failed for video {video_path} ({e.stderr.decode('utf8')}). Will use spec duration if available, or default for silent audio.")
+            info = probe_cache.get_media_summary(video_path)
+            if info:
+                probed_duration = info['duration']
+            else:
+                print(f"Warning: Probe failed for video {video_path}. Will use spec duration if available, or default for silent audio.")
+
+            if probed_duration > 0 and item_start >= probed_duration:
+                print(f"Warning: Start {item_start}s is past the end of {video_path}. Using the clip from the start.")
+                item_start = 0.0
+            available_duration = probed_duration - item_start
 
             # Determine effective duration for audio track (prefer probe, then spec, then default for videos)
-            effective_duration_for_audio = probed_duration if probed_duration > 0 else item_duration
-            if effective_duration_for_audio <= 0: # If still no duration from probe or spec
+            effective_duration = available_duration if probed_duration > 0 else item_duration
+            trimmed = item_start > 0 or 0 < item_duration < available_duration - 0.001
+            if 0 < item_duration < available_duration: # Spec asks for only item_duration seconds of the clip
+                effective_duration = item_duration
+            if effective_duration <= 0: # If still no duration from probe or spec
                 print(f"Warning: Video {video_path} has no determinable duration. Defaulting associated audio to 1s.")
-                effective_duration_for_audio = 1.0 # Default to 1s if all else fails
+                effective_duration = 1.0 # Default to 1s if all else fails
 
-            if has_audio_stream:
-                input_audio_streams.append(video_input_node.audio)
-            else:
-                # Video has no audio stream or probe failed to confirm, add silent audio for its effective duration
-                print(f"Video {video_path} has no audio stream or probe failed; adding silent audio for {effective_duration_for_audio}s.")
-                silent_audio = ffmpeg.input(f'anullsrc=channel_layout=stereo:sample_rate=44100', format='lavfi', t=effective_duration_for_audio).audio
-                input_audio_streams.append(silent_audio)
+            segments.append({'type': 'video', 'path': video_path, 'start': item_start, 'duration': effective_duration,
+                             'trimmed': trimmed, 'snap': isinstance(item, dict) and bool(item.get('snap')),
+                             'has_audio': bool(info and info['has_audio']), 'info': info,
+                             'cache': isinstance(item, dict) and bool(item.get('cache'))})
         elif video_path: # video_path was specified but file not found
             print(f"Warning: Video file not found: {video_path}. Skipping.")
-            # No need to continue here, as the outer loop will continue
-        # else: (item was invalid type, already handled by the first 'else' in the loop and continued)
+    return segments
 
-    if not input_video_streams:
-        raise ValueError("No valid video or image inputs to process after filtering.")
+def _open_video_input(segment):
+    """
+    Opens a video segment's file limited to the part the timeline uses: -ss before -i seeks to the
+    keyframe before the start (only frames from there on are decoded), -t stops reading after the end.
+    """
+    if not segment['trimmed']:
+        return ffmpeg.input(segment['path'])
+    if segment['start'] > 0:
+        return ffmpeg.input(segment['path'], ss=segment['start'], t=segment['duration'])
+    return ffmpeg.input(segment['path'], t=segment['duration'])
+
+def _subclip_follows(segment, last_end):
+    """
+    True if a subclip starting at segment['start'] is best cut from an input already decoding up to last_end:
+    the unused footage in between is at most SUBCLIP_MERGE_GAP_SECONDS, or a separate seek would have to
+    start decoding at a keyframe before last_end anyway (per the keyframe index).
+    """
+    gap = segment['start'] - last_end
+    if gap < 0:
+        return False
+    if gap <= SUBCLIP_MERGE_GAP_SECONDS:
+        return True
+    keyframe = probe_cache.keyframe_at_or_before(segment['path'], segment['start'])
+    return keyframe is not None and keyframe <= last_end
 
-    if len(input_video_streams) != len(input_audio_streams):
-        print(f"Critical Warning: Mismatch in video ({len(input_video_streams)}) and audio ({len(input_audio_streams)}) streams. This will likely cause concat to fail. Review stream generation logic.")
-        # This is a fatal issue for ffmpeg.concat if streams aren't 1:1 video to audio.
-        # Forcing a stop or trying to pad audio streams to match video streams count here is complex.
-        # The logic above for silent audio generation for images and videos without audio MUST ensure counts match.
-        # If this warning appears, there's a bug in that logic.
-        raise ValueError("Video and audio stream counts for concatenation do not match.")
-
-    # If v=1, a=0, concat itself should return the single video stream directly.
-    joined_video_node = ffmpeg.concat(*input_video_streams, v=1, a=0)
-    # Similarly for audio, if present.
-    joined_audio_node = ffmpeg.concat(*input_audio_streams, v=0, a=1) if input_audio_streams else None
-
-    # Resolution and FPS scaling (if not already done for images, or to ensure uniformity)
-    # Note: If images were already scaled&padded, this scale might be redundant for them but ensures uniformity for videos.
-    current_video_stream = joined_video_node
-    # Removing post-concat scale and pad for now, as images are pre-scaled/padded
-    # and videos will be handled by the final output node's scaling if dimensions differ.
-    # if output_width and output_height:
-    #      # Ensure final output resolution after concat, especially if videos had different ARs
-    #     # current_video_stream = ffmpeg.filter(current_video_stream, 'setsar', '1') # Normalize SAR - Removing this line as it causes issues
-    #     current_video_stream = ffmpeg.filter(current_video_stream, 'scale', output_width, output_height, eval='frame', force_original_aspect_ratio='decrease')
-    #     current_video_stream = ffmpeg.filter(current_video_stream, 'pad', output_width, output_height, '-1', '-1', 'black')
-
-    # Rely on output node to handle FPS based on final_output_params['fps']
-    # if 'fps' in final_output_params: # Applying FPS to the concatenated stream is usually safe
-    #     current_video_stream = ffmpeg.filter(current_video_stream, 'fps', fps=final_output_params['fps'], round='near')
-
-    streams_for_final_output = []
-    final_video_processing_stage = current_video_stream
-
-    if watermark_path and os.path.exists(watermark_path):
-        watermark_input_node = ffmpeg.input(watermark_path)
-        wm_params = watermark_params or {}
-        # wm_width_expr = wm_params.get('width', 'w*0.1') # This was an error, 'w' is not defined here for scale
-        # wm_height_expr = wm_params.get('height', '-1')
-
-        scaled_watermark_video = watermark_input_node.video
-        # Robust watermark scaling: Scale watermark relative to output video width if known
-        # Example: Scale watermark to be 10% of output video width, keep aspect ratio.
-        # The 'scale' filter refers to its own input dimensions with W/H, not the main video.
-        # Overlay is where you can reference main video width (main_w or W) and watermark input width (overlay_w or w).
-        # Simpler: Scale watermark to an absolute size or fraction of ITS OWN size first.
-        # For scaling relative to main video, it's more complex.
-        # Let's use a fixed_width from params or default, then overlay.
-        # Or, if output_width is known, scale it based on a fraction of that.
-        if wm_params.get('width_is_fraction_of_video', False) and output_width:
-            fraction = float(wm_params.get('width', '0.1')) # e.g. 0.1 for 10%
-            target_wm_width = int(output_width * fraction)
-            scaled_watermark_video = ffmpeg.filter(scaled_watermark_video, 'scale', target_wm_width, -1)
-        elif wm_params.get('fixed_width'):
-            scaled_watermark_video = ffmpeg.filter(scaled_watermark_video, 'scale', wm_params.get('fixed_width'), -1)
-        else: # Default: scale to 10% of its own width (no, this is not useful) -> let's use 100px width
-            scaled_watermark_video = ffmpeg.filter(scaled_watermark_video, 'scale', '100', -1)
-
-
-        pos_x = wm_params.get('position_x', 'W-w-10') # W is main video, w is watermark
-        pos_y = wm_params.get('position_y', '10')
-        final_video_processing_stage = ffmpeg.overlay(final_video_processing_stage, scaled_watermark_video, x=pos_x, y=pos_y)
-
-    streams_for_final_output.append(final_video_processing_stage)
-
-    main_audio_final_stage = joined_audio_node
-
-    if bgm_path and os.path.exists(bgm_path) and main_audio_final_stage:
-        bgm_input_node = ffmpeg.input(bgm_path, stream_loop=-1)
-        mixed_audio = ffmpeg.filter([main_audio_final_stage, bgm_input_node.audio], 'amix', inputs=2, duration='first', dropout_transition=0, weights=f"1 {bgm_volume}")
-        streams_for_final_output.append(mixed_audio)
-    elif main_audio_final_stage:
-        streams_for_final_output.append(main_audio_final_stage)
+def _group_subclips(segments):
+    """
+    Groups video segments that can share one opened input: subclips of the same file that appear in
+    the timeline in source order, close enough to decode straight through (see _subclip_follows).
+    Since the timeline consumes them in the order the file is decoded, no frames pile up between them.
+    Returns a list of groups (lists of segment indexes).
+    """
+    groups = []
+    open_groups = {} # path -> (group, source time where its last subclip ends)
+    for index, segment in enumerate(segments):
+        if segment['type'] != 'video':
+            continue
+        segment_end = segment['start'] + segment['duration']
+        group, last_end = open_groups.get(segment['path'], (None, None))
+        if group and _subclip_follows(segment, last_end):
+            group.append(index)
+        else:
+            group = [index]
+            groups.append(group)
+        open_groups[segment['path']] = (group, segment_end)
+    return groups
+
+def _open_video_segments(segments):
+    """
+    Opens the inputs of all video segments. Subclips grouped by _group_subclips are cut from one input
+    (seeked to the first, limited to the end of the last) with split/trim instead of opening the file again.
+    Returns {segment index: (video_stream, audio_stream or None if the segment has no audio)}; streams the
+    caller does not use are left out of the compiled graph.
+    """
+    opened = {}
+    for group in _group_subclips(segments):
+        if len(group) == 1:
+            segment = segments[group[0]]
+            node = _open_video_input(segment)
+            opened[group[0]] = (node.video, node.audio if segment['has_audio'] else None)
+            continue
+
+        first, last = segments[group[0]], segments[group[-1]]
+        span_start = first['start']
+        span = dict(first, duration=last['start'] + last['duration'] - span_start, trimmed=True)
+        node = _open_video_input(span)
+        video_parts = node.video.filter_multi_output('split', len(group))
+        audio_parts = node.audio.filter_multi_output('asplit', len(group)) if first['has_audio'] else None
+        for part, index in enumerate(group):
+            segment = segments[index]
+            offset = round(segment['start'] - span_start, 6) # Timestamps of a seeked input start at 0
+            video = ffmpeg.filter(video_parts.stream(part), 'trim', start=offset, duration=segment['duration'])
+            video = ffmpeg.filter(video, 'setpts', 'PTS-STARTPTS')
+            audio = None
+            if audio_parts:
+                audio = ffmpeg.filter(audio_parts.stream(part), 'atrim', start=offset, duration=segment['duration'])
+                audio = ffmpeg.filter(audio, 'asetpts', 'PTS-STARTPTS')
+            opened[index] = (video, audio)
+    return opened
+
+def _split_repeated_streams(streams, split_filter='split'):
+    """
+    ffmpeg-python merges identical inputs and filter chains (the same clip, image or silence used twice)
+    into one node, which cannot feed two concat inputs. Streams occurring more than once are fed through split.
+    """
+    counts = {}
+    for stream in streams:
+        counts[stream] = counts.get(stream, 0) + 1
+    splits = {stream: stream.filter_multi_output(split_filter, count) for stream, count in counts.items() if count > 1}
+    used = {}
+    result = []
+    for stream in streams:
+        if stream in splits:
+            used[stream] = used.get(stream, 0) + 1
+            stream = splits[stream].stream(used[stream] - 1)
+        result.append(stream)
+    return result
+
+def _build_concat_filter_streams(segments, output_width, output_height, output_fps_val, final_output_params):
+    """
+    Full filter-graph path for the video: one input per segment, each scaled/padded to the output resolution,
+    joined with the concat filter. Images marked as cacheable come from the segment cache as
+    pre-rendered clips (already scaled) instead of being rasterized in the graph.
+    The audio is rendered separately (see _render_soundtrack). Returns the joined video stream.
+    """
+    input_video_streams = []
+    image_reference = None
+    if segment_cache.is_enabled():
+        image_reference = _synthesized_reference(final_output_params, output_width, output_height, output_fps_val)
+
+    opened_videos = _open_video_segments(segments)
+
+    for index, segment in enumerate(segments):
+        if segment['type'] == 'image' and segment['cache'] and image_reference:
+            clip_node = ffmpeg.input(_cached_normalized_segment(segment, image_reference, final_output_params))
+            input_video_streams.append(ffmpeg.filter(clip_node.video, 'setsar', '1'))
+            continue
+        if segment['type'] == 'image':
+            img_node = ffmpeg.input(segment['path'], loop=1, framerate=output_fps_val, t=segment['duration'])
+            input_video_streams.append(_scale_and_pad(img_node.video, output_width, output_height))
+            continue
+        # Scale and pad to fit output resolution, similar to images
+        # Apply setsar=1 to actual video inputs too for consistency before concat
+        input_video_streams.append(_scale_and_pad(opened_videos[index][0], output_width, output_height))
+
+    # Post-concat scale/pad and fps filters are not needed: every segment is pre-scaled/padded above,
+    # and the output node converts the frame rate based on final_output_params['fps'].
+    return ffmpeg.concat(*_split_repeated_streams(input_video_streams), v=1, a=0)
+
+def _apply_watermark(video_stream, watermark_path, watermark_params, output_width):
+    """Overlays the watermark image on video_stream according to watermark_params."""
+    watermark_input_node = ffmpeg.input(watermark_path)
+    wm_params = watermark_params or {}
+
+    scaled_watermark_video = watermark_input_node.video
+    # The 'scale' filter refers to its own input dimensions with W/H, not the main video.
+    # Overlay is where you can reference main video width (main_w or W) and watermark input width (overlay_w or w).
+    # So the watermark is scaled to a fixed width, or to a fraction of the output width if that is known.
+    if wm_params.get('width_is_fraction_of_video', False) and output_width:
+        fraction = float(wm_params.get('width', '0.1')) # e.g. 0.1 for 10%
+        target_wm_width = int(output_width * fraction)
+        scaled_watermark_video = ffmpeg.filter(scaled_watermark_video, 'scale', target_wm_width, -1)
+    elif wm_params.get('fixed_width'):
+        scaled_watermark_video = ffmpeg.filter(scaled_watermark_video, 'scale', wm_params.get('fixed_width'), -1)
+    else: # Default: 100px wide watermark
+        scaled_watermark_video = ffmpeg.filter(scaled_watermark_video, 'scale', '100', -1)
+
+    pos_x = wm_params.get('position_x', 'W-w-10') # W is main video, w is watermark
+    pos_y = wm_params.get('position_y', '10')
+    return ffmpeg.overlay(video_stream, scaled_watermark_video, x=pos_x, y=pos_y)
+
+def _normalize_loudness(audio_stream, loudnorm_params, sample_rate):
+    """
+    Applies single-pass loudnorm with pre-measured values (see asset_manager.get_loudnorm_params), then
+    converts to stereo at sample_rate (loudnorm always outputs 192 kHz, and mono sources otherwise leave
+    the output's channel layout undecided). Returns audio_stream unchanged if loudnorm_params is None.
+    """
+    if not loudnorm_params:
+        return audio_stream
+    normalized = ffmpeg.filter(audio_stream, 'loudnorm', **loudnorm_params)
+    return ffmpeg.filter(normalized, 'aformat', sample_rates=sample_rate, channel_layouts='stereo')
+
+def _bgm_bed(bgm_path, min_duration, work_dir, loudnorm_params=None):
+    """
+    Returns a file holding bgm_path looped to at least min_duration seconds (loudness-normalized if
+    loudnorm_params are given). Beds are rounded up to whole BGM_BED_BUCKET_SECONDS and kept in the segment
+    cache (when enabled), so videos of similar length reuse one bed. Beds are FLAC, so looping adds no lossy generation.
+    """
+    bed_duration = math.ceil((min_duration + 1) / BGM_BED_BUCKET_SECONDS) * BGM_BED_BUCKET_SECONDS # +1s: loop joins can lose a few ms
+
+    def produce(bed_path):
+        looped = ffmpeg.input(bgm_path, stream_loop=-1).audio
+        looped = _normalize_loudness(looped, loudnorm_params, DEFAULT_INTERMEDIATE_SAMPLE_RATE)
+        _run_ffmpeg(ffmpeg.output(looped, bed_path, t=bed_duration, acodec='flac'), bed_path, bed_duration)
+
+    if segment_cache.is_enabled():
+        key = segment_cache.make_key('bgm_bed', probe_cache.get_content_hash(bgm_path), bed_duration, loudnorm_params)
+        return _cached_entry(key, produce, ext='.flac')
+    bed_path = os.path.join(work_dir, "bgm_bed.flac")
+    produce(bed_path)
+    return bed_path
+
+def _render_soundtrack(segments, soundtrack_path, final_output_params, work_dir, bgm_path=None, bgm_volume=0.25,
+                       voiceover_path=None, voiceover_volume=1.0, bgm_loudnorm=None, voiceover_loudnorm=None):
+    """
+    Audio pre-mix stage: renders the complete soundtrack of the timeline into one file, encoded with the
+    final audio settings so the video encode only has to mux it. It holds each segment's audio (silence
+    for images and silent clips), the BGM looped from a pre-rendered bed at bgm_volume and the voiceover
+    at voiceover_volume, mixed without renormalization (peaks limited) and ending with the timeline. BGM and voiceover
+    are first brought to a common loudness when loudnorm parameters (measured once per file) are given.
+    Raises RuntimeError if the rendered soundtrack is shorter than the timeline.
+    """
+    # The segments' audio always goes to a lossless intermediate first: a concat with asplit inputs (repeated
+    # clips, or images whose silence nodes ffmpeg-python merged) feeding amix directly stalls and cuts the
+    # mix short. Long timelines get one intermediate per group, in one common format (the concat demuxer
+    # cannot switch sample format or bit depth between files), joined by the concat demuxer.
+    group_size = _concat_group_size(segments, None, None, concurrent_graphs=2) # Alongside the video encode
+    group_paths = []
+    for index, group in enumerate(_split_into_groups(segments, group_size)):
+        group_path = os.path.join(work_dir, f"audio_group_{index:03d}.flac")
+        _run_ffmpeg(ffmpeg.output(_build_audio_track_stream(group), group_path, acodec='flac', ac=2,
+                                  ar=DEFAULT_INTERMEDIATE_SAMPLE_RATE, sample_fmt='s16'),
+                    group_path, sum(seg['duration'] for seg in group))
+        group_paths.append(group_path)
+    if len(group_paths) == 1:
+        audio_stream = ffmpeg.input(group_paths[0]).audio
     else:
-        if 'acodec' in final_output_params :
-             print("Warning: Audio codec specified but no audio streams (main or BGM) to output. Output might lack audio or fail if acodec is forced.")
-             del final_output_params['acodec']
-             if 'audio_bitrate' in final_output_params: del final_output_params['audio_bitrate']
-             if 'ar' in final_output_params: del final_output_params['ar']
+        list_path = os.path.join(work_dir, "audio_groups.txt")
+        _write_concat_list(group_paths, list_path)
+        audio_stream = ffmpeg.input(list_path, format='concat', safe=0).audio
+    timeline_duration = sum(seg['duration'] for seg in segments)
+    mix_inputs, weights = [audio_stream], ['1']
+    if bgm_path:
+        mix_inputs.append(ffmpeg.input(_bgm_bed(bgm_path, timeline_duration, work_dir, bgm_loudnorm)).audio)
+        weights.append(str(bgm_volume))
+    if voiceover_path:
+        sample_rate = final_output_params.get('ar', DEFAULT_INTERMEDIATE_SAMPLE_RATE)
+        mix_inputs.append(_normalize_loudness(ffmpeg.input(voiceover_path).audio, voiceover_loudnorm, sample_rate))
+        weights.append(str(voiceover_volume))
+    if len(mix_inputs) > 1:
+        audio_stream = ffmpeg.filter(mix_inputs, 'amix', inputs=len(mix_inputs), duration='first',
+                                     dropout_transition=0, weights=' '.join(weights), normalize=0)
+        # The sources are summed as they are (clip audio at 1, BGM at 0.25 and the voiceover at 1.1 by
+        # default), so loud clip audio under the voiceover would clip: a look-ahead limiter, its delay
+        # compensated and without auto-leveling, keeps peaks under SOUNDTRACK_PEAK_LIMIT and leaves the rest alone
+        audio_stream = ffmpeg.filter(audio_stream, 'alimiter', limit=SOUNDTRACK_PEAK_LIMIT, level=0, latency=1)
+    audio_params = {k: final_output_params[k] for k in AUDIO_OUTPUT_OPTIONS if k in final_output_params}
+    _run_ffmpeg(ffmpeg.output(audio_stream, soundtrack_path, **audio_params), soundtrack_path, timeline_duration)
+    if _plan_trace is None:
+        # Regression guard: a soundtrack cut short loses the audio of the last segments without any ffmpeg error
+        soundtrack_duration = float(ffmpeg.probe(soundtrack_path)['format']['duration'])
+        if soundtrack_duration < timeline_duration - SOUNDTRACK_DURATION_TOLERANCE_SECONDS:
+            raise RuntimeError(f"Soundtrack is {soundtrack_duration:.2f}s long, but the timeline is {timeline_duration:.2f}s.")
+    return soundtrack_path
+
+def _first_stream(info, codec_type):
+    return next((s for s in info.get('streams', []) if s.get('codec_type') == codec_type), None)
+
+def _copy_signature(info):
+    """
+    Returns the stream parameters that must be identical for files to be joined by the concat
+    demuxer with stream copy, or None if the file cannot take part (no audio, non-square pixels, ...).
+    """
+    if not info:
+        return None
+    video, audio = _first_stream(info, 'video'), _first_stream(info, 'audio')
+    if not video or not audio:
+        return None
+    if video.get('sample_aspect_ratio') not in (None, '1:1', '0:1'):
+        return None
+    return {
+        'codec': video.get('codec_name'), 'profile': video.get('profile'),
+        'width': video.get('width'), 'height': video.get('height'),
+        'fps': round(probe_cache.parse_frame_rate(video.get('r_frame_rate')), 2), 'pix_fmt': video.get('pix_fmt'),
+        'audio_codec': audio.get('codec_name'), 'sample_rate': str(audio.get('sample_rate')),
+        'channels': audio.get('channels'),
+    }
+
+def _matches_output_format(signature, final_output_params, output_width, output_height, output_fps_val):
+    """True if a file with this copy signature could have been produced by the configured encode."""
+    if not signature:
+        return False
+    if signature['codec'] != ENCODER_CODEC_NAMES.get(final_output_params.get('vcodec')):
+        return False
+    if output_width and output_height and (signature['width'], signature['height']) != (output_width, output_height):
+        return False
+    if abs(signature['fps'] - float(output_fps_val)) > 0.01:
+        return False
+    if signature['pix_fmt'] != final_output_params.get('pix_fmt', 'yuv420p'):
+        return False
+    if signature['audio_codec'] != final_output_params.get('acodec', 'aac') or signature['channels'] != 2:
+        return False
+    if final_output_params.get('ar') and signature['sample_rate'] != str(final_output_params['ar']):
+        return False
+    return True
+
+def _synthesized_reference(final_output_params, output_width, output_height, output_fps_val):
+    """Builds the copy signature our own encode of the configured output format produces, or None if unknown."""
+    codec = ENCODER_CODEC_NAMES.get(final_output_params.get('vcodec'))
+    if not codec or not (output_width and output_height) or final_output_params.get('acodec', 'aac') != 'aac':
+        return None
+    return {
+        'codec': codec, 'profile': DEFAULT_CODEC_PROFILES.get(codec),
+        'width': output_width, 'height': output_height, 'fps': round(float(output_fps_val), 2),
+        'pix_fmt': final_output_params.get('pix_fmt', 'yuv420p'),
+        'audio_codec': 'aac', 'sample_rate': str(final_output_params.get('ar', DEFAULT_INTERMEDIATE_SAMPLE_RATE)),
+        'channels': 2,
+    }
+
+def _copy_cut(segment):
+    """
+    Returns (start, duration) for stream-copying a segment, or None if it has to be re-encoded.
+    The start is the segment's own if that is 0 or a keyframe, else the preceding keyframe if the spec
+    allows snapping (the keyframe index is needed for subclips). The demuxer ends a cut file at the first
+    packet whose decoding timestamp reaches the outpoint, so the duration is rounded up to whole frames,
+    and a cut before the end of the file is only possible without B-frames (reordered frames displayed
+    after the cut would overlap the next clip).
+    """
+    video = _first_stream(segment['info'], 'video')
+    start, duration = segment['start'], segment['duration']
+    if not segment['trimmed']:
+        return start, duration
+    if start:
+        keyframe = probe_cache.keyframe_at_or_before(segment['path'], start)
+        if keyframe is None or (start - keyframe >= 0.001 and not segment['snap']):
+            return None
+        start = keyframe
+    if start + duration < segment['info']['duration'] - 0.001:
+        if (video.get('has_b_frames') or 0) > 0:
+            return None
+        fps = probe_cache.parse_frame_rate(video.get('r_frame_rate'))
+        if fps > 0:
+            duration = math.ceil(duration * fps - 0.001) / fps
+    return start, duration
+
+def _plan_stream_copy(segments, final_output_params, output_width, output_height, output_fps_val, watermark_path=None):
+    """
+    Decides whether the stream-copy (concat demuxer) path is worth taking.
+    The reference format is the most common copy signature among video segments that already match
+    the output format; if none match but cached intermediates can be used, it is the configured output format.
+    With a watermark the video is re-encoded anyway, so the path is only taken when every segment can be copied
+    as-is: normalized intermediates would be encoded a second time. Without one it is taken when segments copied
+    as-is or served from the segment cache cover at least STREAM_COPY_MIN_SHARE of the timeline.
+    Returns (reference_signature, [bool per segment: copy as-is]) or (None, None) to use the full filter graph.
+    """
+    signatures = [_copy_signature(seg['info']) if seg['type'] == 'video' else None for seg in segments]
+    candidates = [sig for sig in signatures
+                  if _matches_output_format(sig, final_output_params, output_width, output_height, output_fps_val)]
+    cacheable = [segment_cache.is_enabled() and seg['cache'] for seg in segments]
+    if candidates:
+        reference = max(candidates, key=candidates.count)
+    elif any(cacheable):
+        reference = _synthesized_reference(final_output_params, output_width, output_height, output_fps_val)
+    else:
+        reference = None
+    if not reference:
+        return None, None
+
+    # A subclip can only be copied from a keyframe on; others are re-encoded
+    copy_cuts = [_copy_cut(seg) if sig == reference else None for sig, seg in zip(signatures, segments)]
+    copy_flags = [cut is not None for cut in copy_cuts]
+    if watermark_path:
+        if not all(copy_flags):
+            return None, None
+    else:
+        reusable = sum(seg['duration'] for seg, copy, cached in zip(segments, copy_flags, cacheable) if copy or cached)
+        if reusable < STREAM_COPY_MIN_SHARE * sum(seg['duration'] for seg in segments):
+            return None, None
+    for segment, cut in zip(segments, copy_cuts):
+        if cut:
+            segment['start'], segment['duration'] = cut # Snapped to a keyframe / whole frames
+    return reference, copy_flags
+
+def _normalize_encode_params(reference, final_output_params):
+    """Returns the ffmpeg output kwargs that encode a segment to the reference format."""
+    sample_rate = int(reference['sample_rate'])
+    encode_params = {k: v for k, v in final_output_params.items()
+                     if k not in ('resolution', 'fps') and k not in AUDIO_OUTPUT_OPTIONS}
+    encode_params.update({'r': reference['fps'], 'pix_fmt': reference['pix_fmt'],
+                          'acodec': reference['audio_codec'], 'ar': sample_rate, 'ac': reference['channels']})
+    if 'audio_bitrate' in final_output_params:
+        encode_params['audio_bitrate'] = final_output_params['audio_bitrate']
+    if reference.get('profile'):
+        # Match the H.264/HEVC profile of the copied clips, e.g. 'High' -> 'high', 'Constrained Baseline' -> 'baseline'
+        encode_params['profile:v'] = reference['profile'].lower().replace('constrained ', '')
+    return encode_params
+
+def _normalized_segment_key(segment, reference, final_output_params):
+    """Segment cache key of a normalized intermediate: source content hash plus everything that shapes the encode."""
+    encode_params = {k: v for k, v in _normalize_encode_params(reference, final_output_params).items()
+                     if k not in NON_OUTPUT_AFFECTING_OPTIONS}
+    return segment_cache.make_key('normalized', probe_cache.get_content_hash(segment['path']),
+                                  segment['type'], segment['start'], segment['duration'], encode_params)
+
+def _cached_normalized_segment(segment, reference, final_output_params):
+    """
+    Returns the segment cache entry holding segment normalized to the reference format, rendering it
+    on a miss. Image entries are short clips with silent audio, keyed by (image, duration, format).
+    """
+    key = _normalized_segment_key(segment, reference, final_output_params)
+    return _cached_entry(
+        key, lambda tmp_path: _normalize_segment(segment, tmp_path, reference, final_output_params))
+
+def _normalize_segment(segment, normalized_path, reference, final_output_params):
+    """
+    Re-encodes a single segment (video or image) to the reference format, so it can be joined
+    with already-matching segments by stream copy.
+    """
+    width, height, fps = reference['width'], reference['height'], reference['fps']
+    sample_rate = int(reference['sample_rate'])
+    if segment['type'] == 'image':
+        source = ffmpeg.input(segment['path'], loop=1, framerate=fps, t=segment['duration'])
+        audio = _silent_audio(segment['duration'], sample_rate)
+    else:
+        source = _open_video_input(segment)
+        audio = source.audio if segment['has_audio'] else _silent_audio(segment['duration'], sample_rate)
+    video = ffmpeg.filter(_scale_and_pad(source.video, width, height), 'fps', fps=fps)
+    encode_params = _normalize_encode_params(reference, final_output_params)
+    _trace_encode(segment['duration'], width, height, fps, final_output_params)
+    _run_ffmpeg(ffmpeg.output(video, audio, normalized_path, **encode_params), normalized_path, segment['duration'])
+
+def _write_concat_list(file_paths, list_path, cuts=None):
+    """
+    Writes an ffmpeg concat demuxer list file. cuts optionally gives an (inpoint, outpoint) pair per file,
+    either of which may be None; with stream copy the inpoint must be a keyframe.
+    """
+    with open(list_path, 'w') as f:
+        for index, file_path in enumerate(file_paths):
+            escaped = os.path.abspath(file_path).replace("'", "'\\''")
+            f.write(f"file '{escaped}'\n")
+            inpoint, outpoint = cuts[index] if cuts else (None, None)
+            if inpoint:
+                f.write(f"inpoint {inpoint}\n")
+            if outpoint is not None:
+                f.write(f"outpoint {outpoint}\n")
+
+def _render_stream_copy(segments, copy_flags, reference, output_path, work_dir, final_output_params,
+                        watermark_path, watermark_params, output_width, soundtrack_path=None):
+    """
+    Fast path: joins segments with the concat demuxer. Segments already in the output format are
+    copied as-is, the others are first re-encoded individually (taken from / stored in the segment
+    cache when their spec allows it, else written to work_dir). The video stream is copied too unless
+    a watermark has to be burnt in; the audio is copied from the segments, or from soundtrack_path if
+    a pre-mixed soundtrack (BGM, voiceover) was rendered.
+    Returns False (without writing output_path) if the joined files turn out not to be copy-compatible.
+    """
+    files = []
+    cuts = [] # Subclips that are copied as-is are cut by the demuxer
+    cache_hits = 0
+    for index, (segment, can_copy) in enumerate(zip(segments, copy_flags)):
+        if can_copy:
+            files.append(segment['path'])
+            if segment['trimmed']:
+                # Round the outpoint down so float error never lets in the frame that starts exactly there
+                cuts.append((segment['start'], math.floor((segment['start'] + segment['duration']) * 1e6) / 1e6))
+            else:
+                cuts.append((None, None))
+            continue
+        if segment['cache'] and segment_cache.is_enabled():
+            cache_hits += segment_cache.lookup(_normalized_segment_key(segment, reference, final_output_params)) is not None
+            normalized_path = _cached_normalized_segment(segment, reference, final_output_params)
+        else:
+            normalized_path = os.path.join(work_dir, f"segment_{index:04d}.mp4")
+            _normalize_segment(segment, normalized_path, reference, final_output_params)
+        if _plan_trace is None and _copy_signature(probe_cache.get_media_summary(normalized_path)) != reference:
+            print(f"Normalized segment {segment['path']} does not match the copied clips' format. Falling back to full re-encode.")
+            return False
+        files.append(normalized_path)
+        cuts.append((None, None))
+
+    list_path = os.path.join(work_dir, "concat_list.txt")
+    _write_concat_list(files, list_path, cuts)
+    concat_input = ffmpeg.input(list_path, format='concat', safe=0)
+    video_stream, audio_stream = concat_input.video, concat_input.audio
+
+    output_kwargs = {k: final_output_params[k] for k in CONTAINER_OUTPUT_OPTIONS if k in final_output_params}
+    if watermark_path:
+        video_stream = _apply_watermark(video_stream, watermark_path, watermark_params, output_width)
+        _trace_encode(sum(seg['duration'] for seg in segments), reference['width'], reference['height'], reference['fps'],
+                      final_output_params)
+        output_kwargs.update({k: v for k, v in _translate_output_params(final_output_params).items()
+                              if k not in AUDIO_OUTPUT_OPTIONS})
+    else:
+        output_kwargs['vcodec'] = 'copy'
+    if soundtrack_path:
+        audio_stream = ffmpeg.input(soundtrack_path).audio
+    output_kwargs['acodec'] = 'copy'
+
+    print(f"Stream-copy fast path: {sum(copy_flags)} of {len(segments)} segment(s) copied without re-encoding, "
+          f"{cache_hits} served from the segment cache{', video re-encoded for watermark' if watermark_path else ''}.")
+    _run_ffmpeg(ffmpeg.output(video_stream, audio_stream, output_path, **output_kwargs), output_path,
+                sum(seg['duration'] for seg in segments), stage="encode" if watermark_path else "mux")
+    return True
+
+def _available_memory_bytes():
+    """MemAvailable from /proc/meminfo (free + reclaimable), falling back to the free physical pages; None if unknown."""
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
         pass
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        return None
 
-    if len(streams_for_final_output) == 1 and hasattr(streams_for_final_output[0], 'type') and streams_for_final_output[0].type == 'video':
-        if 'acodec' in final_output_params: del final_output_params['acodec']
-        if 'audio_bitrate' in final_output_params: del final_output_params['audio_bitrate']
-        if 'ar' in final_output_params: del final_output_params['ar']
+def _concat_group_size(segments, output_width, output_height, concurrent_graphs=1):
+    """
+    Largest number of segments one filter graph may open, bounded by MAX_CONCAT_GROUP_SEGMENTS, by the
+    soft RLIMIT_NOFILE of the ffmpeg process (DESCRIPTORS_PER_INPUT per input) and by the memory its
+    decoders need (DECODED_FRAMES_PER_INPUT frames of the largest source or output resolution per input),
+    with CONCAT_MEMORY_FRACTION of the available memory shared by concurrent_graphs graphs.
+    """
+    group_size = MAX_CONCAT_GROUP_SEGMENTS
+    if resource is not None:
+        soft_limit, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft_limit != resource.RLIM_INFINITY:
+            group_size = min(group_size, (soft_limit - RESERVED_DESCRIPTORS) // DESCRIPTORS_PER_INPUT)
+    available = _available_memory_bytes()
+    if available:
+        pixels = max([(seg['info'] or {}).get('width', 0) * (seg['info'] or {}).get('height', 0) for seg in segments]
+                     + [(output_width or 0) * (output_height or 0)])
+        bytes_per_input = pixels * 1.5 * DECODED_FRAMES_PER_INPUT + INPUT_OVERHEAD_BYTES # 1.5 bytes per yuv420p pixel
+        group_size = min(group_size, int(available * CONCAT_MEMORY_FRACTION / max(1, concurrent_graphs) // bytes_per_input))
+    return max(MIN_CONCAT_GROUP_SEGMENTS, group_size)
 
-    # Ensure 'fps' from config is translated to 'r' for ffmpeg-python output
-    if 'fps' in final_output_params:
-        final_output_params['r'] = final_output_params.pop('fps')
+def _split_into_groups(segments, group_size):
+    """Splits segments into contiguous runs of at most group_size segments, all of about the same length."""
+    num_groups = max(1, math.ceil(len(segments) / group_size))
+    bounds = [round(len(segments) * i / num_groups) for i in range(num_groups + 1)]
+    return [segments[bounds[i]:bounds[i + 1]] for i in range(num_groups)]
 
-    # Ensure 'resolution' from config is translated to 's' (size) for ffmpeg-python output
-    if 'resolution' in final_output_params:
-        res_val = final_output_params.pop('resolution')
-        if isinstance(res_val, (list, tuple)) and len(res_val) == 2:
-            final_output_params['s'] = f"{res_val[0]}x{res_val[1]}"
-        elif isinstance(res_val, str): # Allow "WxH" string format as well
-            final_output_params['s'] = res_val
+def _split_into_chunks(segments, num_chunks):
+    """Splits segments at segment boundaries into up to num_chunks contiguous runs of similar duration."""
+    num_chunks = max(1, min(num_chunks, len(segments)))
+    total_duration = sum(seg['duration'] for seg in segments)
+    chunks, current, elapsed = [], [], 0.0
+    for index, segment in enumerate(segments):
+        current.append(segment)
+        elapsed += segment['duration']
+        remaining_segments = len(segments) - index - 1
+        remaining_chunks = num_chunks - len(chunks) - 1
+        # Close the chunk once it reaches its share of the timeline, keeping one segment per remaining chunk
+        if remaining_chunks > 0 and (elapsed >= total_duration * (len(chunks) + 1) / num_chunks
+                                     or remaining_segments == remaining_chunks):
+            chunks.append(current)
+            current = []
+    if current:
+        chunks.append(current)
+    return chunks
 
+def _build_audio_track_stream(segments):
+    """
+    Builds the timeline's audio as one stream: each segment's own audio (silence for images and
+    silent videos), padded or trimmed to the segment's duration so it stays in sync with the video.
+    """
+    audio_streams = []
+    opened_videos = _open_video_segments(segments)
+    for index, segment in enumerate(segments):
+        if segment['type'] == 'video' and segment['has_audio']:
+            audio = opened_videos[index][1]
+            audio = ffmpeg.filter(ffmpeg.filter(audio, 'apad'), 'atrim', duration=segment['duration'])
+        else:
+            audio = _silent_audio(segment['duration'])
+        audio_streams.append(audio)
+    return ffmpeg.concat(*_split_repeated_streams(audio_streams, 'asplit'), v=0, a=1)
+
+def _resolve_renditions(renditions, final_output_params):
+    """
+    Turns rendition specs ({'output_path', 'resolution', ...output param overrides}) into
+    {'output_path', 'params' (final_output_params with the overrides), 'width', 'height', 'fps'}.
+    Renditions without a resolution get the main output's.
+    """
+    resolved = []
+    for rendition in renditions or []:
+        params = dict(final_output_params)
+        params.update({k: v for k, v in rendition.items() if k != 'output_path'})
+        width, height = _parse_resolution(params.get('resolution'))
+        resolved.append({'output_path': rendition['output_path'], 'params': params, 'width': width, 'height': height,
+                         'fps': params.get('fps', DEFAULT_FALLBACK_FPS)})
+    return resolved
 
+def _video_output_params(final_output_params):
+    """ffmpeg-python output kwargs for a video-only encode with final_output_params."""
+    return {k: v for k, v in _translate_output_params(final_output_params).items() if k not in AUDIO_OUTPUT_OPTIONS}
+
+def _rendition_outputs(video_stream, outputs, audio_stream=None):
+    """
+    Output node writing video_stream (with audio_stream, if given) to several files in one ffmpeg process.
+    outputs are (path, kwargs, size) tuples, size being (width, height) to scale/pad to or None to write the
+    stream as it is. The stream is decoded and composited once and fed to every encoder through split.
+    """
+    streams = video_stream.filter_multi_output('split', len(outputs)) if len(outputs) > 1 else None
+    nodes = []
+    for index, (path, kwargs, size) in enumerate(outputs):
+        stream = streams.stream(index) if streams else video_stream
+        if size:
+            stream = _scale_and_pad(stream, *size)
+        output_streams = [stream, audio_stream] if audio_stream is not None else [stream]
+        nodes.append(ffmpeg.output(*output_streams, path, **kwargs))
+    return ffmpeg.merge_outputs(*nodes) if len(nodes) > 1 else nodes[0]
+
+def _render_renditions_from(source_path, renditions, duration):
+    """
+    Renders renditions from an already written video (the stream-copy route has no decoded timeline to split):
+    the video is decoded once and scaled to every rendition, the audio is copied.
+    """
+    source = ffmpeg.input(source_path)
+    outputs = []
+    for rendition in renditions:
+        kwargs = _video_output_params(rendition['params'])
+        kwargs.update({k: rendition['params'][k] for k in CONTAINER_OUTPUT_OPTIONS if k in rendition['params']})
+        kwargs['acodec'] = 'copy'
+        outputs.append((rendition['output_path'], kwargs, (rendition['width'], rendition['height'])))
+        _trace_encode(duration, rendition['width'], rendition['height'], rendition['fps'], rendition['params'])
+    _run_ffmpeg(_rendition_outputs(source.video, outputs, source.audio), renditions[0]['output_path'], duration)
+
+def _render_reencoded(segments, num_chunks, output_path, work_dir, final_output_params, output_width, output_height,
+                      output_fps_val, watermark_path, watermark_params, soundtrack_path=None, soundtrack_args=None,
+                      renditions=None):
+    """
+    Full re-encode through the filter graph. The video is encoded without audio while the soundtrack is
+    pre-mixed in a separate process at the same time (unless soundtrack_path was already rendered, else
+    _render_soundtrack is called with soundtrack_args); both are then muxed by stream copy.
+    With num_chunks > 1 the timeline is split at segment boundaries into chunks whose video is encoded
+    concurrently with identical encoder settings (so every chunk starts on a keyframe and shares the same
+    GOP structure) and stitched with the concat demuxer. The watermark is a static overlay applied
+    identically in each chunk and the soundtrack covers the full timeline, so neither has seams.
+    Chunks with more segments than one graph may open (see _concat_group_size) are further split into
+    groups, encoded the same way with at most num_chunks running at once.
+    Renditions (see _resolve_renditions) are encoded by the same processes: each chunk's composited video
+    is split into the main encode and one scaled encode per rendition, and all outputs are muxed together.
+    """
+    renditions = renditions or []
+    concurrent_chunks = len(_split_into_chunks(segments, num_chunks))
+    group_size = _concat_group_size(segments, output_width, output_height, concurrent_chunks + 1)
+    chunks = [group for chunk in _split_into_chunks(segments, num_chunks) for group in _split_into_groups(chunk, group_size)]
+    threads_per_chunk = max(1, int(final_output_params.get('threads') or 1) // concurrent_chunks)
+    targets = [{'params': final_output_params, 'size': None, 'fps': output_fps_val,
+                'width': output_width, 'height': output_height}]
+    targets += [dict(rendition, size=(rendition['width'], rendition['height'])) for rendition in renditions]
+    for target in targets:
+        target['video_params'] = dict(_video_output_params(target['params']), threads=threads_per_chunk)
+
+    def render_chunk(index, chunk_segments):
+        chunk_duration = sum(seg['duration'] for seg in chunk_segments)
+        chunk_paths = [os.path.join(work_dir, f"chunk_{index:03d}.mp4")]
+        chunk_paths += [os.path.join(work_dir, f"chunk_{index:03d}_r{r}.mp4") for r in range(len(renditions))]
+        video_stream = _build_concat_filter_streams(chunk_segments, output_width, output_height, output_fps_val,
+                                                    final_output_params)
+        if watermark_path:
+            video_stream = _apply_watermark(video_stream, watermark_path, watermark_params, output_width)
+        for target in targets:
+            _trace_encode(chunk_duration, target['width'], target['height'], target['fps'], target['params'])
+        outputs = [(path, target['video_params'], target['size']) for path, target in zip(chunk_paths, targets)]
+        _run_ffmpeg(_rendition_outputs(video_stream, outputs), chunk_paths[0], chunk_duration)
+        return chunk_paths
+
+    if len(chunks) > 1:
+        print(f"Chunked encode: {len(segments)} segment(s) in {len(chunks)} chunk(s) of at most {group_size} segment(s), "
+              f"{concurrent_chunks} at a time with {threads_per_chunk} thread(s) each.")
+    # One extra worker renders the soundtrack alongside the video
+    with metrics.stage("encode"), ThreadPoolExecutor(max_workers=concurrent_chunks + 1) as executor:
+        audio_future = None
+        if not soundtrack_path:
+            soundtrack_path = os.path.join(work_dir, "soundtrack.mka")
+            audio_future = executor.submit(_render_soundtrack, segments, soundtrack_path, final_output_params, work_dir,
+                                           **(soundtrack_args or {}))
+        chunk_futures = [executor.submit(render_chunk, index, chunk) for index, chunk in enumerate(chunks)]
+        chunk_paths = [future.result() for future in chunk_futures]
+        if audio_future:
+            audio_future.result()
+
+    # One mux process joins the chunks of every output with the shared soundtrack
+    soundtrack = ffmpeg.input(soundtrack_path).audio
+    mux_nodes = []
+    output_paths = [output_path] + [rendition['output_path'] for rendition in renditions]
+    for target_index, (target_path, target) in enumerate(zip(output_paths, targets)):
+        target_chunks = [paths[target_index] for paths in chunk_paths]
+        if len(target_chunks) > 1:
+            list_path = os.path.join(work_dir, f"chunks_{target_index}.txt")
+            _write_concat_list(target_chunks, list_path)
+            video_stream = ffmpeg.input(list_path, format='concat', safe=0).video
+        else:
+            video_stream = ffmpeg.input(target_chunks[0]).video
+        mux_params = {k: target['params'][k] for k in CONTAINER_OUTPUT_OPTIONS if k in target['params']}
+        mux_nodes.append(ffmpeg.output(video_stream, soundtrack, target_path, vcodec='copy', acodec='copy', **mux_params))
+    _run_ffmpeg(ffmpeg.merge_outputs(*mux_nodes) if len(mux_nodes) > 1 else mux_nodes[0], output_path,
+                sum(seg['duration'] for seg in segments), stage="mux")
+
+def combine_videos_and_watermark(video_files_and_image_specs, output_path, watermark_path=None, watermark_params=None, output_params=None, bgm_path=None, bgm_volume=0.25, parallel_chunks=1,
+                                 voiceover_path=None, voiceover_volume=1.0, bgm_loudnorm=None, voiceover_loudnorm=None, renditions=None,
+                                 preview_proxies=False):
+    """
+    Combines multiple video files and images (as video segments) into one,
+    optionally adds a watermark, and optionally mixes in background music and a voiceover.
+
+    When segments already match the output format (codec, resolution, fps, pixel format, AAC stereo audio)
+    they are joined with the concat demuxer and stream-copied instead of being decoded and re-encoded
+    (see _render_stream_copy); the full filter graph is only used when it is actually needed.
+    Video and image specs marked {'cache': True} are normalized once into the segment cache
+    (see segment_cache.py) and reused by later renders.
+    The soundtrack is pre-mixed in its own pass (see _render_soundtrack) and only muxed with the video.
+    With parallel_chunks > 1 a full re-encode is split into that many chunks encoded concurrently
+    (see _render_reencoded). Renditions are further outputs of other sizes/encoder settings, scaled from the
+    composited video in the same ffmpeg processes (on the stream-copy route, from the finished output).
+
+    Args:
+        video_files_and_image_specs (list): List of either:
+            - strings (paths to video files)
+            - dicts {'path': 'path/to/image.png', 'type': 'image', 'duration': 3.0}
+            - dicts {'path': 'path/to/clip.mp4', 'type': 'video'}
+            Dict specs may add 'cache': True to allow the segment cache for them.
+        output_path (str): Path for the output video file.
+        watermark_path (str, optional): Path to the watermark image.
+        watermark_params (dict, optional): Parameters for watermark.
+        output_params (dict, optional): Parameters for output video encoding.
+        bgm_path (str, optional): Path to the background music audio file.
+        bgm_volume (float, optional): Volume for the background music (0.0 to 1.0+).
+        parallel_chunks (int, optional): Number of chunks to encode concurrently for a full re-encode (1 = off).
+        voiceover_path (str, optional): Path to a voiceover audio file, mixed in from the start of the video.
+        voiceover_volume (float, optional): Volume for the voiceover.
+        bgm_loudnorm / voiceover_loudnorm (dict, optional): loudnorm filter options with measured values
+            (see asset_manager.get_loudnorm_params), applied in a single linear pass.
+        renditions (list, optional): Additional outputs, dicts {'output_path': ..., 'resolution': [w, h]} plus
+            any output_params to override for them (e.g. 'crf', 'preset'). They share the soundtrack and are
+            letterboxed when their aspect ratio differs from the main output's.
+        preview_proxies (bool, optional): Read video clips from low-resolution proxies at the output resolution
+            and fps (see _preview_proxy) instead of the source files, for fast previews.
+
+    Progress of the ffmpeg commands goes to the callback set with set_progress_callback; the stats of the
+    finished render are available from get_last_render_stats.
+
+    Returns the route taken: 'stream_copy' or 'reencode'.
+    """
+    if not video_files_and_image_specs:
+        raise ValueError("No video files or image specifications provided.")
+
+    # Default output parameters if not provided
+    final_output_params = {
+        'vcodec': 'libx264', 'acodec': 'aac', 'pix_fmt': 'yuv420p',
+        'threads': os.cpu_count() or 1 # Ensure at least 1 thread
+    }
+    if output_params:
+        final_output_params.update(output_params)
+
+    output_width, output_height = _parse_resolution(final_output_params.get('resolution'))
+    output_fps_val = final_output_params.get('fps', DEFAULT_FALLBACK_FPS)
+    renditions = _resolve_renditions(renditions, final_output_params)
+    if preview_proxies and output_width and output_height: # Proxies are scaled to fit the output size
+        video_files_and_image_specs = [_proxy_spec(item, output_width, output_height, output_fps_val)
+                                       for item in video_files_and_image_specs]
+
+    segments = _resolve_segments(video_files_and_image_specs)
+    if not segments:
+        raise ValueError("No valid video or image inputs to process after filtering.")
+
+    if watermark_path and not os.path.exists(watermark_path):
+        watermark_path = None
+    if bgm_path and not os.path.exists(bgm_path):
+        bgm_path = None
+    if voiceover_path and not os.path.exists(voiceover_path):
+        print(f"Warning: Voiceover file not found: {voiceover_path}. Rendering without it.")
+        voiceover_path = None
+    soundtrack_args = {'bgm_path': bgm_path, 'bgm_volume': bgm_volume, 'bgm_loudnorm': bgm_loudnorm,
+                       'voiceover_path': voiceover_path, 'voiceover_volume': voiceover_volume,
+                       'voiceover_loudnorm': voiceover_loudnorm}
+
+    global _last_render_stats
+    del _command_stats[:]
+    render_started = time.time()
+    work_dir = tempfile.mkdtemp(prefix=".render_", dir=os.path.dirname(os.path.abspath(output_path)))
     try:
-        final_node = ffmpeg.output(*streams_for_final_output, output_path, **final_output_params)
-        # For debugging: print("FFmpeg Command:", " ".join(final_node.compile()))
-        final_node.run(overwrite_output=True, capture_stdout=True, capture_stderr=True)
-        print(f"Video successfully created: {output_path}")
-    except ffmpeg.Error as e:
-        print(f"Error during ffmpeg processing for {output_path}:")
-        cmd_str = "ffmpeg " + " ".join(e.cmd) if hasattr(e, 'cmd') and e.cmd else "Unknown command"
-        print("FFmpeg command:", cmd_str)
-        print("FFmpeg stdout:", e.stdout.decode('utf8') if hasattr(e, 'stdout') and e.stdout else "N/A")
-        print("FFmpeg stderr:", e.stderr.decode('utf8') if hasattr(e, 'stderr') and e.stderr else "N/A")
+        soundtrack_path = None
+        reference, copy_flags = _plan_stream_copy(segments, final_output_params, output_width, output_height,
+                                                  output_fps_val, watermark_path)
+        if _plan_trace is not None:
+            _plan_trace['segments'] = segments # With the copy cuts applied
+        route = 'reencode'
+        if reference:
+            if bgm_path or voiceover_path: # Otherwise the segments' audio is copied as-is
+                soundtrack_path = _render_soundtrack(segments, os.path.join(work_dir, "soundtrack.mka"),
+                                                     final_output_params, work_dir, **soundtrack_args)
+            if _render_stream_copy(segments, copy_flags, reference, output_path, work_dir, final_output_params,
+                                   watermark_path, watermark_params, output_width, soundtrack_path):
+                route = 'stream_copy'
+                if renditions:
+                    _render_renditions_from(output_path, renditions, sum(seg['duration'] for seg in segments))
+
+        if route == 'reencode':
+            _render_reencoded(segments, parallel_chunks or 1, output_path, work_dir, final_output_params, output_width,
+                              output_height, output_fps_val, watermark_path, watermark_params, soundtrack_path, soundtrack_args,
+                              renditions)
+        if _plan_trace is None:
+            _last_render_stats = _summarize_render_stats(route, time.time() - render_started,
+                                                         sum(seg['duration'] for seg in segments))
+            print(f"Video successfully created: {output_path}")
+            for rendition in renditions:
+                print(f"Rendition created: {rendition['output_path']}")
+        return route
+    except ffmpeg.Error:
         raise
     except Exception as ex:
         print(f"An unexpected error occurred in video_engine: {ex}")
         raise
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+        segment_cache.release()
+
+def _filter_node_count(argv):
+    """Number of filter nodes in a compiled command (ffmpeg-python writes one ';'-separated entry per node)."""
+    if '-filter_complex' not in argv:
+        return 0
+    return len(argv[argv.index('-filter_complex') + 1].split(';'))
+
+def plan_render(video_files_and_image_specs, output_path, **render_args):
+    """
+    Dry run of combine_videos_and_watermark (same arguments): resolves the segments and takes every decision
+    a render would, but records the ffmpeg commands instead of running them. Segment cache entries that
+    already exist are used as they are; missing ones appear as the commands that would render them.
+    Paths in the render's temporary work folder (.render_*) only exist while a render runs.
+
+    Returns a JSON-serializable dict: 'route', 'segments' (path, type, start, duration as they would be cut),
+    'expected_duration', 'commands' ([{'output', 'argv'}] in execution order; chunks and the soundtrack run
+    concurrently), total 'inputs' and 'filter_nodes' over all commands, and 'estimated_encode_seconds'
+    (from ENCODE_PIXEL_RATES; copying and audio are not counted).
+    """
+    global _plan_trace
+    _plan_trace = {'commands': [], 'segments': [], 'encode_seconds': 0.0}
+    try:
+        route = combine_videos_and_watermark(video_files_and_image_specs, output_path, **render_args)
+        trace = _plan_trace
+    finally:
+        _plan_trace = None
+
+    segments = [{'path': seg['path'], 'type': seg['type'], 'start': seg['start'], 'duration': round(seg['duration'], 6)}
+                for seg in trace['segments']]
+    return {
+        'route': route,
+        'segments': segments,
+        'expected_duration': round(sum(seg['duration'] for seg in segments), 3),
+        'commands': trace['commands'],
+        'inputs': sum(cmd['argv'].count('-i') for cmd in trace['commands']),
+        'filter_nodes': sum(_filter_node_count(cmd['argv']) for cmd in trace['commands']),
+        'estimated_encode_seconds': round(trace['encode_seconds'], 1),
+    }
 
 if __name__ == '__main__':
     print("video_engine.py loaded. Contains core video processing functions.")
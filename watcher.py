@@ -0,0 +1,59 @@
+import os
+import time
+
+import asset_index
+
+# Polling watcher for daemon mode (batch_processor.py --watch): reports files that appeared or changed in a
+# set of folders once they are complete, i.e. their size and mtime have stayed the same for settle_seconds
+# (a TTS job or a copy still writing a file keeps changing both). Polling needs no extra dependency and also
+# works on network mounts where inotify sees nothing; a poll costs one os.stat per folder (listings come from
+# asset_index, which re-reads a folder only when its mtime changes) plus one per file.
+DEFAULT_POLL_SECONDS = 5.0
+DEFAULT_SETTLE_SECONDS = 10.0
+
+_files = {} # abs path -> {'size': int, 'mtime_ns': int, 'stable_since': float, 'reported': bool}
+
+
+def reset():
+    """Forgets every file seen, so all of them are reported again once complete."""
+    _files.clear()
+
+
+def forget(folder):
+    """Forgets the files seen in folder (e.g. after its project's config changed), so they are reported again."""
+    prefix = os.path.join(os.path.abspath(folder), "")
+    for path in [p for p in _files if p.startswith(prefix)]:
+        del _files[path]
+
+
+def poll(folders, extensions, settle_seconds=DEFAULT_SETTLE_SECONDS):
+    """
+    Checks folders for files with the given extensions and returns the ones (paths as listed, sorted) that
+    became complete since the last poll. A file is complete when it had the same size and mtime in the
+    previous poll and either has kept them for settle_seconds or was last modified longer ago than that
+    (files already there when watching starts). Each version of a file is returned once: a file that
+    changes again is returned again after it settles. Files that disappear are forgotten.
+    """
+    now = time.time()
+    ready = []
+    listed = set()
+    for folder in folders:
+        prefix = os.path.join(os.path.abspath(folder), "")
+        for path in asset_index.list_files(folder, extensions):
+            abs_path = os.path.abspath(path)
+            listed.add(abs_path)
+            try:
+                st = os.stat(path)
+            except OSError: # Removed since the folder was listed
+                continue
+            record = _files.get(abs_path)
+            if record is None or (record['size'], record['mtime_ns']) != (st.st_size, st.st_mtime_ns):
+                _files[abs_path] = {'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'stable_since': now, 'reported': False}
+                continue # Seen for the first time in this state: wait for the next poll
+            if not record['reported'] and (now - record['stable_since'] >= settle_seconds or
+                                           now - st.st_mtime_ns / 1e9 >= settle_seconds):
+                record['reported'] = True
+                ready.append(path)
+        for path in [p for p in _files if p.startswith(prefix) and p not in listed]:
+            del _files[path]
+    return sorted(ready)